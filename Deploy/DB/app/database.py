@@ -5,8 +5,8 @@ Database module для логирования запросов и результ
 
 import os
 import sqlite3
-from datetime import datetime
-from typing import Optional, Dict, Any, List
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List, Tuple
 from contextlib import contextmanager
 import json
 import logging
@@ -16,6 +16,34 @@ logger = logging.getLogger(__name__)
 # Путь к базе данных (в volume)
 DB_PATH = os.getenv("DB_PATH", "/data/requests.db")
 
+# Перцептивный хэш (64 бита) индексируется полосами по 8 бит: при
+# расстоянии Хэмминга меньше 8 хотя бы одна полоса совпадает точно
+PHASH_BANDS = 8
+PHASH_BAND_BITS = 64 // PHASH_BANDS
+
+# Сколько кандидатов по полосам проверять при поиске похожего изображения
+PHASH_MAX_CANDIDATES = 500
+
+# Хэшей в одном SQL запросе при поиске пачкой (лимит параметров SQLite - 999)
+HASH_LOOKUP_CHUNK = 500
+
+
+def ensure_columns(cursor: sqlite3.Cursor, table: str, columns: Dict[str, str]):
+    """
+    Добавляет недостающие колонки в существующую таблицу (миграция схемы)
+    
+    Args:
+        table: Имя таблицы
+        columns: Словарь {имя колонки: SQL тип}
+    """
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in cursor.fetchall()}
+    
+    for name, column_type in columns.items():
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+            logger.info(f"🔧 Добавлена колонка {table}.{name}")
+
 
 def init_database():
     """
@@ -76,12 +104,53 @@ def init_database():
         )
     """)
     
+    # Колонки, добавленные после первой версии схемы
+    ensure_columns(cursor, "inference_logs", {
+        "model_key": "TEXT",
+        "phash": "TEXT",
+        "trace_id": "TEXT",
+        # Бюджеты, использованные VLM сервисом под нагрузкой
+        "effective_max_tokens": "INTEGER",
+        "effective_max_pixels": "INTEGER",
+        "degraded": "BOOLEAN",
+        # Идентификатор записи от Backend: повторная отправка пачки не создает дублей
+        "record_id": "TEXT"
+    })
+    
+    # Индекс полос перцептивного хэша для поиска по расстоянию Хэмминга
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS phash_bands (
+            band INTEGER NOT NULL,
+            value INTEGER NOT NULL,
+            log_id INTEGER NOT NULL,
+            PRIMARY KEY (band, value, log_id)
+        ) WITHOUT ROWID
+    """)
+    
     # Создаем индексы для оптимизации запросов
     cursor.execute("""
         CREATE INDEX IF NOT EXISTS idx_file_hash 
         ON inference_logs(file_hash)
     """)
     
+    # Поиск готового результата по хэшу (в том числе пачкой): все условия
+    # отбора есть в индексе, а id последней записи берется из него же
+    cursor.execute("DROP INDEX IF EXISTS idx_hash_model_key")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_hash_lookup 
+        ON inference_logs(file_hash, model_key, status, degraded)
+    """)
+    
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_record_id 
+        ON inference_logs(record_id)
+    """)
+    
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_trace_id 
+        ON inference_logs(trace_id)
+    """)
+    
     cursor.execute("""
         CREATE INDEX IF NOT EXISTS idx_timestamp 
         ON inference_logs(request_timestamp)
@@ -97,6 +166,11 @@ def init_database():
         ON inference_logs(model_name, device_type)
     """)
     
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_phash_bands_log_id 
+        ON phash_bands(log_id)
+    """)
+    
     conn.commit()
     conn.close()
     
@@ -121,7 +195,23 @@ def get_db_connection():
         conn.close()
 
 
-def log_inference_request(
+def split_phash_bands(phash: str) -> List[int]:
+    """Разбивает 64-битный перцептивный хэш (hex) на полосы"""
+    value = int(phash, 16)
+    mask = (1 << PHASH_BAND_BITS) - 1
+    return [
+        (value >> (PHASH_BAND_BITS * (PHASH_BANDS - 1 - band))) & mask
+        for band in range(PHASH_BANDS)
+    ]
+
+
+def hamming_distance(a: str, b: str) -> int:
+    """Число различающихся бит двух хэшей в hex"""
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def _insert_inference_log(
+    cursor: sqlite3.Cursor,
     file_name: str,
     file_type: str,
     file_size: int,
@@ -139,49 +229,86 @@ def log_inference_request(
     torch_dtype: Optional[str] = None,
     status: str = "success",
     error_message: Optional[str] = None,
-    metadata: Optional[Dict[str, Any]] = None
+    metadata: Optional[Dict[str, Any]] = None,
+    model_key: Optional[str] = None,
+    phash: Optional[str] = None,
+    trace_id: Optional[str] = None,
+    effective_max_tokens: Optional[int] = None,
+    effective_max_pixels: Optional[int] = None,
+    degraded: Optional[bool] = None,
+    record_id: Optional[str] = None
 ) -> int:
+    """
+    Вставляет одну запись в inference_logs в рамках открытой транзакции
+    
+    Запись с уже сохраненным record_id не вставляется повторно: Backend
+    переотправляет пачку, ответ на которую не дошел до него.
+    
+    Returns:
+        ID созданной (или ранее сохраненной) записи
+    """
+    # Подготавливаем данные
+    timestamp = datetime.utcnow().isoformat()
+    description_length = len(description) if description else 0
+    image_width = image_size[0] if image_size else None
+    image_height = image_size[1] if image_size else None
+    metadata_json = json.dumps(metadata) if metadata else None
+    
+    # Вставляем запись
+    cursor.execute("""
+        INSERT OR IGNORE INTO inference_logs (
+            request_timestamp, file_name, file_type, file_size_bytes, file_hash,
+            was_converted, conversion_time_sec,
+            model_name, device_type,
+            max_tokens, torch_dtype,
+            description_text, description_length,
+            inference_time_sec, generation_time_sec, total_processing_time_sec,
+            image_width, image_height,
+            status, error_message, metadata, model_key, phash, trace_id,
+            effective_max_tokens, effective_max_pixels, degraded, record_id
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (
+        timestamp, file_name, file_type, file_size, file_hash,
+        was_converted, conversion_time,
+        model_name, device_type,
+        max_tokens, torch_dtype,
+        description, description_length,
+        inference_time, generation_time, total_time,
+        image_width, image_height,
+        status, error_message, metadata_json, model_key, phash, trace_id,
+        effective_max_tokens, effective_max_pixels, degraded, record_id
+    ))
+    if cursor.rowcount == 0:
+        # Запись уже сохранена при предыдущей отправке
+        cursor.execute("SELECT id FROM inference_logs WHERE record_id = ?", (record_id,))
+        row = cursor.fetchone()
+        return row[0] if row else -1
+    log_id = cursor.lastrowid
+    
+    # Искать похожие имеет смысл только среди успешных распознаваний
+    # полного качества
+    if phash and status == "success" and not degraded:
+        cursor.executemany(
+            "INSERT OR IGNORE INTO phash_bands (band, value, log_id) VALUES (?, ?, ?)",
+            [(band, value, log_id) for band, value in enumerate(split_phash_bands(phash))]
+        )
+    
+    return log_id
+
+
+def log_inference_request(**record: Any) -> int:
     """
     Логирует запрос на инференс в базу данных
     
+    Args:
+        record: Поля записи (см. _insert_inference_log)
+    
     Returns:
         ID созданной записи
     """
     try:
         with get_db_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Подготавливаем данные
-            timestamp = datetime.utcnow().isoformat()
-            description_length = len(description) if description else 0
-            image_width = image_size[0] if image_size else None
-            image_height = image_size[1] if image_size else None
-            metadata_json = json.dumps(metadata) if metadata else None
-            
-            # Вставляем запись
-            cursor.execute("""
-                INSERT INTO inference_logs (
-                    request_timestamp, file_name, file_type, file_size_bytes, file_hash,
-                    was_converted, conversion_time_sec,
-                    model_name, device_type,
-                    max_tokens, torch_dtype,
-                    description_text, description_length,
-                    inference_time_sec, generation_time_sec, total_processing_time_sec,
-                    image_width, image_height,
-                    status, error_message, metadata
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                timestamp, file_name, file_type, file_size, file_hash,
-                was_converted, conversion_time,
-                model_name, device_type,
-                max_tokens, torch_dtype,
-                description, description_length,
-                inference_time, generation_time, total_time,
-                image_width, image_height,
-                status, error_message, metadata_json
-            ))
-            
-            log_id = cursor.lastrowid
+            log_id = _insert_inference_log(conn.cursor(), **record)
             
             logger.info(f"📝 Запрос залогирован в БД (ID: {log_id})")
             return log_id
@@ -192,10 +319,54 @@ def log_inference_request(
         return -1
 
 
-def get_request_by_hash(file_hash: str) -> Optional[Dict[str, Any]]:
+def log_inference_requests_batch(
+    records: List[Dict[str, Any]]
+) -> Tuple[List[int], List[Dict[str, Any]]]:
+    """
+    Логирует пачку запросов одной транзакцией
+    
+    Каждая запись вставляется в своей точке сохранения: запись, которую
+    не удалось вставить, пропускается, а остальные сохраняются. Иначе
+    одна некорректная запись не давала бы сохранить пачку никогда.
+    
+    Args:
+        records: Список записей (поля как у _insert_inference_log)
+    
+    Returns:
+        Кортеж (ID сохраненных записей, пропущенные записи в виде
+        {"index": номер в пачке, "error": текст ошибки})
+    """
+    log_ids = []
+    failed = []
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        for index, record in enumerate(records):
+            cursor.execute("SAVEPOINT log_record")
+            try:
+                log_ids.append(_insert_inference_log(cursor, **record))
+            except Exception as e:
+                cursor.execute("ROLLBACK TO log_record")
+                failed.append({"index": index, "error": str(e)})
+                logger.error(f"❌ Запись {index} пачки не сохранена: {e}")
+            cursor.execute("RELEASE log_record")
+    
+    logger.info(f"📝 Залогировано записей в БД: {len(log_ids)}, пропущено: {len(failed)}")
+    return log_ids, failed
+
+
+def get_request_by_hash(
+    file_hash: str,
+    model_key: Optional[str] = None
+) -> Optional[Dict[str, Any]]:
     """
     Получает последний запрос с таким же хэшем файла (для дедупликации)
     
+    Args:
+        file_hash: SHA256 хэш файла
+        model_key: Ключ версии модели; если указан, учитываются только
+            результаты, полученные той же моделью с теми же параметрами
+    
     Returns:
         Словарь с данными запроса или None если не найдено
     """
@@ -203,12 +374,22 @@ def get_request_by_hash(file_hash: str) -> Optional[Dict[str, Any]]:
         with get_db_connection() as conn:
             cursor = conn.cursor()
             
-            cursor.execute("""
-                SELECT * FROM inference_logs 
-                WHERE file_hash = ? AND status = 'success'
-                ORDER BY request_timestamp DESC 
-                LIMIT 1
-            """, (file_hash,))
+            if model_key:
+                cursor.execute("""
+                    SELECT * FROM inference_logs 
+                    WHERE file_hash = ? AND model_key = ? AND status = 'success'
+                        AND NOT COALESCE(degraded, 0)
+                    ORDER BY request_timestamp DESC 
+                    LIMIT 1
+                """, (file_hash, model_key))
+            else:
+                cursor.execute("""
+                    SELECT * FROM inference_logs 
+                    WHERE file_hash = ? AND status = 'success'
+                        AND NOT COALESCE(degraded, 0)
+                    ORDER BY request_timestamp DESC 
+                    LIMIT 1
+                """, (file_hash,))
             
             row = cursor.fetchone()
             
@@ -221,6 +402,107 @@ def get_request_by_hash(file_hash: str) -> Optional[Dict[str, Any]]:
         return None
 
 
+def get_requests_by_hashes(
+    file_hashes: List[str],
+    model_key: Optional[str] = None
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Получает последние успешные запросы для нескольких хэшей файлов
+    
+    Для каждой порции хэшей выполняется один запрос: id последней записи
+    каждого хэша выбирается по индексу idx_hash_lookup, затем читаются
+    только эти записи.
+    
+    Args:
+        file_hashes: SHA256 хэши файлов
+        model_key: Ключ версии модели (как у get_request_by_hash)
+    
+    Returns:
+        Словарь хэш -> данные запроса (только для найденных хэшей)
+    """
+    unique_hashes = list(dict.fromkeys(file_hashes))
+    model_filter = "AND model_key = ?" if model_key else ""
+    results: Dict[str, Dict[str, Any]] = {}
+    
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        for start in range(0, len(unique_hashes), HASH_LOOKUP_CHUNK):
+            chunk = unique_hashes[start:start + HASH_LOOKUP_CHUNK]
+            placeholders = ", ".join("?" * len(chunk))
+            params = [*chunk, model_key] if model_key else chunk
+            cursor.execute(f"""
+                SELECT l.* FROM inference_logs l
+                JOIN (
+                    SELECT MAX(id) AS id FROM inference_logs
+                    WHERE file_hash IN ({placeholders}) {model_filter}
+                        AND status = 'success' AND NOT COALESCE(degraded, 0)
+                    GROUP BY file_hash
+                ) latest ON latest.id = l.id
+            """, params)
+            for row in cursor.fetchall():
+                results[row["file_hash"]] = dict(row)
+    
+    return results
+
+
+def get_request_by_phash(
+    phash: str,
+    model_key: str,
+    max_distance: int,
+    max_age_hours: float
+) -> Optional[Dict[str, Any]]:
+    """
+    Ищет успешный запрос с похожим изображением (по перцептивному хэшу)
+    
+    Кандидаты выбираются по точному совпадению хотя бы одной полосы хэша,
+    затем среди них считается точное расстояние Хэмминга.
+    
+    Args:
+        phash: Перцептивный хэш изображения (64 бита, hex)
+        model_key: Ключ версии модели - результат должен быть получен той же моделью
+        max_distance: Максимальное расстояние Хэмминга (не больше PHASH_BANDS - 1)
+        max_age_hours: Учитываются только записи не старше указанного времени
+    
+    Returns:
+        Данные ближайшего запроса с полем phash_distance или None
+    """
+    max_distance = min(max_distance, PHASH_BANDS - 1)
+    cutoff = (datetime.utcnow() - timedelta(hours=max_age_hours)).isoformat()
+    bands = split_phash_bands(phash)
+    band_filter = " OR ".join(["(b.band = ? AND b.value = ?)"] * PHASH_BANDS)
+    params = [item for band, value in enumerate(bands) for item in (band, value)]
+    
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT DISTINCT l.* FROM phash_bands b
+                JOIN inference_logs l ON l.id = b.log_id
+                WHERE ({band_filter})
+                    AND l.model_key = ? AND l.status = 'success'
+                    AND NOT COALESCE(l.degraded, 0)
+                    AND l.request_timestamp >= ?
+                ORDER BY l.request_timestamp DESC
+                LIMIT ?
+            """, (*params, model_key, cutoff, PHASH_MAX_CANDIDATES))
+            
+            best = None
+            best_distance = max_distance + 1
+            for row in cursor.fetchall():
+                distance = hamming_distance(phash, row["phash"])
+                # Записи идут от новых к старым: при равном расстоянии берем свежую
+                if distance < best_distance:
+                    best, best_distance = row, distance
+            
+            if best is None:
+                return None
+            return {**dict(best), "phash_distance": best_distance}
+            
+    except Exception as e:
+        logger.error(f"❌ Ошибка при поиске по перцептивному хэшу: {e}")
+        return None
+
+
 def get_statistics() -> Dict[str, Any]:
     """
     Получает статистику по всем запросам
@@ -311,7 +593,8 @@ def get_recent_requests(limit: int = 10) -> List[Dict[str, Any]]:
                 SELECT 
                     id, request_timestamp, file_name, file_type,
                     model_name, device_type, status,
-                    total_processing_time_sec, description_length
+                    total_processing_time_sec, description_length, trace_id,
+                    effective_max_tokens, effective_max_pixels, degraded
                 FROM inference_logs
                 ORDER BY request_timestamp DESC
                 LIMIT ?
@@ -348,6 +631,11 @@ def cleanup_old_records(days: int = 30):
             
             deleted_count = cursor.rowcount
             
+            cursor.execute("""
+                DELETE FROM phash_bands
+                WHERE log_id NOT IN (SELECT id FROM inference_logs)
+            """)
+            
             logger.info(f"🗑️  Удалено {deleted_count} старых записей (старше {days} дней)")
             
     except Exception as e:
@@ -4,18 +4,25 @@ Database Service - FastAPI сервис для работы с SQLite базой
 """
 
 import os
+import time
 import logging
 from typing import Optional, List
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager
 
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel
+from prometheus_client import Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+from tracing import TraceMiddleware, TraceIdLogFilter, configure_tracing, shutdown_tracing, span
 
 from database import (
     init_database,
     log_inference_request,
+    log_inference_requests_batch,
     get_request_by_hash,
+    get_requests_by_hashes,
+    get_request_by_phash,
     get_statistics,
     get_recent_requests
 )
@@ -23,10 +30,38 @@ from database import (
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s'
 )
+for handler in logging.getLogger().handlers:
+    handler.addFilter(TraceIdLogFilter())
 logger = logging.getLogger(__name__)
 
+# Prometheus гистограмма длительности операций с базой
+QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds",
+    "Длительность операции с базой данных",
+    ["operation", "status"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+
+
+@contextmanager
+def query_timer(operation: str):
+    """
+    Замеряет операцию в гистограмме и как span трассировки; исключение
+    внутри блока записывается со статусом error
+    """
+    start = time.perf_counter()
+    status = "success"
+    try:
+        with span(f"db.{operation}"):
+            yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        QUERY_SECONDS.labels(operation, status).observe(time.perf_counter() - start)
+
 
 # Pydantic модели для валидации
 class LogRequest(BaseModel):
@@ -47,6 +82,28 @@ class LogRequest(BaseModel):
     torch_dtype: Optional[str] = None
     status: str = "success"
     error_message: Optional[str] = None
+    model_key: Optional[str] = None
+    phash: Optional[str] = None
+    trace_id: Optional[str] = None
+    effective_max_tokens: Optional[int] = None
+    effective_max_pixels: Optional[int] = None
+    degraded: Optional[bool] = None
+    record_id: Optional[str] = None
+    
+    def to_record(self) -> dict:
+        """Преобразует запрос в аргументы функций логирования"""
+        record = self.model_dump()
+        record["image_size"] = tuple(self.image_size) if self.image_size else None
+        return record
+
+
+class LogBatchRequest(BaseModel):
+    records: List[LogRequest]
+
+
+class HashLookupRequest(BaseModel):
+    file_hashes: List[str]
+    model_key: Optional[str] = None
 
 
 @asynccontextmanager
@@ -56,6 +113,7 @@ async def lifespan(app: FastAPI):
     logger.info("=" * 60)
     logger.info("🚀 Запуск Database Service")
     logger.info("=" * 60)
+    configure_tracing("database")
     
     # Инициализация базы данных
     init_database()
@@ -66,6 +124,7 @@ async def lifespan(app: FastAPI):
     
     # Shutdown
     logger.info("🛑 Остановка Database Service")
+    shutdown_tracing()
 
 
 # Создание FastAPI приложения
@@ -76,6 +135,9 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# Span на каждый запрос (контекст приходит от Backend в заголовке traceparent)
+app.add_middleware(TraceMiddleware)
+
 
 @app.get("/")
 async def root():
@@ -86,9 +148,14 @@ async def root():
         "status": "running",
         "endpoints": {
             "log": "/log (POST)",
+            "log_batch": "/log/batch (POST)",
             "statistics": "/statistics (GET)",
             "recent": "/recent (GET)",
-            "health": "/health (GET)"
+            "by_hash": "/by_hash/{file_hash} (GET)",
+            "by_hash_bulk": "/by_hash/bulk (POST)",
+            "by_phash": "/by_phash/{phash} (GET)",
+            "health": "/health (GET)",
+            "metrics_prometheus": "/metrics/prometheus (GET)"
         }
     }
 
@@ -102,6 +169,12 @@ async def health_check():
     }
 
 
+@app.get("/metrics/prometheus")
+async def get_prometheus_metrics():
+    """Гистограммы длительности операций с базой в формате Prometheus"""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.post("/log")
 async def log_request(data: LogRequest):
     """
@@ -114,25 +187,8 @@ async def log_request(data: LogRequest):
         ID созданной записи
     """
     try:
-        log_id = log_inference_request(
-            file_name=data.file_name,
-            file_type=data.file_type,
-            file_size=data.file_size,
-            file_hash=data.file_hash,
-            was_converted=data.was_converted,
-            conversion_time=data.conversion_time,
-            model_name=data.model_name,
-            device_type=data.device_type,
-            description=data.description,
-            inference_time=data.inference_time,
-            generation_time=data.generation_time,
-            total_time=data.total_time,
-            image_size=tuple(data.image_size) if data.image_size else None,
-            max_tokens=data.max_tokens,
-            torch_dtype=data.torch_dtype,
-            status=data.status,
-            error_message=data.error_message
-        )
+        with query_timer("log"):
+            log_id = log_inference_request(**data.to_record())
         
         return {"id": log_id, "status": "logged"}
         
@@ -144,6 +200,33 @@ async def log_request(data: LogRequest):
         )
 
 
+@app.post("/log/batch")
+async def log_requests_batch(data: LogBatchRequest):
+    """
+    Логирует пачку запросов одной транзакцией
+    
+    Args:
+        data: Список записей для логирования
+    
+    Returns:
+        ID сохраненных записей и пропущенные записи (номер в пачке и
+        ошибка), которые не удалось вставить
+    """
+    try:
+        with query_timer("log_batch"):
+            log_ids, failed = log_inference_requests_batch(
+                [record.to_record() for record in data.records]
+            )
+        return {"ids": log_ids, "failed": failed, "status": "logged"}
+        
+    except Exception as e:
+        logger.error(f"❌ Ошибка при пакетном логировании: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Ошибка при логировании: {str(e)}"
+        )
+
+
 @app.get("/statistics")
 async def get_stats():
     """
@@ -153,7 +236,8 @@ async def get_stats():
         Статистика
     """
     try:
-        stats = get_statistics()
+        with query_timer("statistics"):
+            stats = get_statistics()
         return JSONResponse(content=stats)
     except Exception as e:
         logger.error(f"❌ Ошибка при получении статистики: {e}")
@@ -175,7 +259,8 @@ async def get_recent(limit: int = 20):
         Список последних запросов
     """
     try:
-        recent = get_recent_requests(limit=limit)
+        with query_timer("recent"):
+            recent = get_recent_requests(limit=limit)
         return JSONResponse(content={"requests": recent})
     except Exception as e:
         logger.error(f"❌ Ошибка при получении последних запросов: {e}")
@@ -186,18 +271,20 @@ async def get_recent(limit: int = 20):
 
 
 @app.get("/by_hash/{file_hash}")
-async def get_by_hash(file_hash: str):
+async def get_by_hash(file_hash: str, model_key: Optional[str] = None):
     """
     Получает запрос по хэшу файла (для дедупликации)
     
     Args:
         file_hash: SHA256 хэш файла
+        model_key: Ключ версии модели (опционально)
     
     Returns:
         Данные запроса или None
     """
     try:
-        result = get_request_by_hash(file_hash)
+        with query_timer("by_hash"):
+            result = get_request_by_hash(file_hash, model_key=model_key)
         if result:
             return JSONResponse(content=result)
         else:
@@ -210,6 +297,70 @@ async def get_by_hash(file_hash: str):
         )
 
 
+@app.post("/by_hash/bulk")
+async def get_by_hashes(data: HashLookupRequest):
+    """
+    Получает последние успешные запросы для нескольких хэшей файлов
+    
+    Args:
+        data: Хэши файлов и ключ версии модели (опционально)
+    
+    Returns:
+        {"results": {хэш: данные запроса}} - только для найденных хэшей
+    """
+    try:
+        with query_timer("by_hash_bulk"):
+            results = get_requests_by_hashes(data.file_hashes, model_key=data.model_key)
+        return JSONResponse(content={"results": results})
+    except Exception as e:
+        logger.error(f"❌ Ошибка при поиске по хэшам: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Ошибка при поиске: {str(e)}"
+        )
+
+
+@app.get("/by_phash/{phash}")
+async def get_by_phash(
+    phash: str,
+    model_key: str,
+    max_distance: int = 4,
+    max_age_hours: float = 168
+):
+    """
+    Получает запрос с похожим изображением (поиск почти одинаковых диаграмм)
+    
+    Args:
+        phash: Перцептивный хэш изображения (64 бита, hex)
+        model_key: Ключ версии модели
+        max_distance: Максимальное расстояние Хэмминга (0-7)
+        max_age_hours: Максимальный возраст записи в часах
+    
+    Returns:
+        Данные ближайшего запроса с полем phash_distance или {"found": false}
+    """
+    if len(phash) != 16 or any(c not in "0123456789abcdef" for c in phash.lower()):
+        raise HTTPException(
+            status_code=400,
+            detail="Перцептивный хэш должен состоять из 16 hex символов"
+        )
+    try:
+        with query_timer("by_phash"):
+            result = get_request_by_phash(
+                phash.lower(), model_key, max_distance, max_age_hours
+            )
+        if result:
+            return JSONResponse(content=result)
+        else:
+            return JSONResponse(content={"found": False})
+    except Exception as e:
+        logger.error(f"❌ Ошибка при поиске по перцептивному хэшу: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Ошибка при поиске: {str(e)}"
+        )
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8003)
\ No newline at end of file
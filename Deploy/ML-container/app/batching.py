@@ -0,0 +1,141 @@
+"""
+Динамическое объединение запросов в батчи
+Одновременные запросы собираются в течение короткого окна (не дольше
+max_wait, не больше max_batch_size) и обрабатываются одним вызовом.
+Каждый запрос получает свой результат через Future.
+"""
+
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class BatchEntry:
+    """Запрос в очереди батчинга"""
+
+    def __init__(self, payload: Any, future: asyncio.Future):
+        self.payload = payload
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+
+    def set_result(self, result: Any):
+        if not self.future.done():
+            self.future.set_result(result)
+
+    def set_exception(self, error: BaseException):
+        if not self.future.done():
+            self.future.set_exception(error)
+
+
+class BatchScheduler:
+    """
+    Собирает запросы в батчи для run_batch
+
+    Пока модель занята, новые запросы накапливаются и уходят следующим
+    батчем без ожидания. Окно max_wait ждет только первый запрос после
+    простоя, поэтому добавка к задержке одиночного запроса ограничена им.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[List[BatchEntry]], Awaitable[None]],
+        max_batch_size: int,
+        max_wait: float
+    ):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        # Батч собирается или обрабатывается
+        self._busy = False
+
+        # Метрики
+        self.batches = 0
+        self.requests = 0
+        self.max_observed = 0
+        self.total_wait = 0.0
+
+    @property
+    def pending(self) -> int:
+        """Запросы, еще не попавшие в батч"""
+        return self._queue.qsize()
+
+    @property
+    def idle(self) -> bool:
+        """Нет ни ожидающих запросов, ни батча в работе"""
+        return not self._busy and self._queue.empty()
+
+    def submit(self, payload: Any) -> asyncio.Future:
+        """Ставит запрос в очередь; результат придет в возвращенный Future"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(BatchEntry(payload, future))
+        return future
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает обработку; запросы из очереди получают ошибку"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        while not self._queue.empty():
+            self._queue.get_nowait().set_exception(RuntimeError("Сервис останавливается"))
+
+    async def _collect(self) -> List[BatchEntry]:
+        batch = [await self._queue.get()]
+        self._busy = True
+        window_end = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = window_end - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+
+            started = time.perf_counter()
+            self.batches += 1
+            self.requests += len(batch)
+            self.max_observed = max(self.max_observed, len(batch))
+            self.total_wait += sum(started - entry.enqueued_at for entry in batch)
+
+            try:
+                await self.run_batch(batch)
+            except asyncio.CancelledError:
+                for entry in batch:
+                    entry.set_exception(RuntimeError("Сервис останавливается"))
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка при обработке батча: {e}")
+                for entry in batch:
+                    entry.set_exception(e)
+            finally:
+                self._busy = False
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики батчинга"""
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "batches": self.batches,
+            "requests": self.requests,
+            "pending": self.pending,
+            "avg_batch_size": round(self.requests / self.batches, 2) if self.batches else 0,
+            "max_observed_batch_size": self.max_observed,
+            "avg_wait_ms": round(self.total_wait / self.requests * 1000, 1) if self.requests else 0
+        }
@@ -0,0 +1,122 @@
+"""
+Готовый к загрузке бандл модели
+Бандл собирается заранее (docker-volumes/base-model/build_bundle.py):
+LoRA адаптеры объединены с весами базовой модели, веса приведены к
+целевому типу и сохранены в safetensors вместе с конфигом процессора.
+Манифест хранит контрольные суммы файлов и версию адаптеров, поэтому
+сервис загружает бандл без PEFT и без пересчета версии.
+"""
+
+import os
+import json
+import hashlib
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+MANIFEST_NAME = "bundle_manifest.json"
+MANIFEST_FORMAT = 1
+
+# Способы проверки бандла при загрузке
+VERIFY_NONE = "none"
+VERIFY_SIZE = "size"
+VERIFY_SHA256 = "sha256"
+
+
+class BundleError(Exception):
+    """Бандл поврежден или несовместим с сервисом"""
+
+
+def adapter_files_version(adapter_path: str) -> str:
+    """
+    Версия LoRA адаптеров по конфигам и весам в каталоге адаптера
+    (конфиги хэшируются целиком, для весов - имя, размер и время изменения)
+    """
+    if not os.path.isdir(adapter_path):
+        return "none"
+
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(adapter_path)):
+        path = os.path.join(adapter_path, name)
+        if not os.path.isfile(path):
+            continue
+        if name.endswith(".json"):
+            # Конфиги небольшие - хэшируем содержимое целиком
+            with open(path, "rb") as f:
+                digest.update(name.encode("utf-8") + f.read())
+        else:
+            # Для весов достаточно имени, размера и времени изменения
+            stat = os.stat(path)
+            digest.update(f"{name}:{stat.st_size}:{int(stat.st_mtime)}".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def file_sha256(path: str, chunk_size: int = 8 * 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_manifest(
+    bundle_path: str,
+    base_model: str,
+    adapter_version: str,
+    torch_dtype: str
+) -> Dict[str, Any]:
+    """Записывает манифест с контрольными суммами всех файлов бандла"""
+    files = {}
+    for name in sorted(os.listdir(bundle_path)):
+        path = os.path.join(bundle_path, name)
+        if name == MANIFEST_NAME or not os.path.isfile(path):
+            continue
+        files[name] = {"size": os.path.getsize(path), "sha256": file_sha256(path)}
+
+    manifest = {
+        "format": MANIFEST_FORMAT,
+        "base_model": base_model,
+        "adapter_version": adapter_version,
+        "torch_dtype": torch_dtype,
+        "lora_merged": True,
+        "created_at": datetime.utcnow().isoformat(),
+        "files": files
+    }
+    with open(os.path.join(bundle_path, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+def read_manifest(bundle_path: str) -> Optional[Dict[str, Any]]:
+    """Манифест бандла или None, если в каталоге нет бандла"""
+    path = os.path.join(bundle_path, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format") != MANIFEST_FORMAT:
+        raise BundleError(f"Неподдерживаемый формат бандла: {manifest.get('format')}")
+    return manifest
+
+
+def verify_bundle(bundle_path: str, manifest: Dict[str, Any], mode: str):
+    """
+    Сверяет файлы бандла с манифестом
+
+    Args:
+        mode: VERIFY_SIZE - наличие и размер файлов (быстро),
+            VERIFY_SHA256 - контрольные суммы (читает все веса),
+            VERIFY_NONE - без проверки
+
+    Raises:
+        BundleError: файл отсутствует или не совпадает с манифестом
+    """
+    if mode == VERIFY_NONE:
+        return
+    for name, expected in manifest["files"].items():
+        path = os.path.join(bundle_path, name)
+        if not os.path.isfile(path):
+            raise BundleError(f"В бандле нет файла {name}")
+        if os.path.getsize(path) != expected["size"]:
+            raise BundleError(f"Размер {name} не совпадает с манифестом")
+        if mode == VERIFY_SHA256 and file_sha256(path) != expected["sha256"]:
+            raise BundleError(f"Контрольная сумма {name} не совпадает с манифестом")
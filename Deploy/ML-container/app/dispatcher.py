@@ -0,0 +1,425 @@
+"""
+VLM Dispatcher - несколько процессов инференса на одном CPU хосте
+Запускает VLM_WORKERS реплик VLM Service (main.py), каждая на своем наборе
+ядер со своим числом потоков intra-op. Веса объединяются с LoRA один раз и
+отображаются всеми репликами в память из одного файла. Запросы /infer и
+/infer/stream направляются реплике с наименьшим числом выполняющихся
+запросов; API совпадает с VLM Service.
+
+    uvicorn dispatcher:app --host 0.0.0.0 --port 8002
+"""
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import asyncio
+import logging
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Dict, Optional
+
+import httpx
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+from starlette.requests import ClientDisconnect
+from prometheus_client import (
+    CollectorRegistry, Gauge, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+)
+
+from bundle import adapter_files_version, read_manifest
+from replicas import NoReplicaAvailable, ReplicaPool, WorkerReplica, parse_cores, split_cores
+from tracing import (
+    TraceMiddleware, TraceIdLogFilter, configure_tracing, shutdown_tracing, trace_headers
+)
+
+# Настройка логирования
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s'
+)
+for handler in logging.getLogger().handlers:
+    handler.addFilter(TraceIdLogFilter())
+logger = logging.getLogger(__name__)
+
+# Конфигурация из переменных окружения
+VLM_WORKERS = int(os.getenv("VLM_WORKERS", "2"))
+# Ядра для реплик ("0-63"), по умолчанию все доступные процессу
+VLM_WORKER_CORES = os.getenv("VLM_WORKER_CORES", "")
+SHARED_WEIGHTS_PATH = os.getenv("SHARED_WEIGHTS_PATH", "/tmp/vlm-shared/weights.pt")
+REPLICA_RUN_DIR = os.getenv("REPLICA_RUN_DIR", "/tmp/vlm-replicas")
+REPLICA_START_TIMEOUT = float(os.getenv("REPLICA_START_TIMEOUT", "600"))
+INFERENCE_DRAIN_TIMEOUT = float(os.getenv("INFERENCE_DRAIN_TIMEOUT", "60"))
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.5"))
+QUANTIZATION = os.getenv("QUANTIZATION", "none").lower()
+# Параметры модели, от которых зависят общие веса (как в main.py)
+BASE_MODEL_ID = os.getenv("BASE_MODEL_ID", "Qwen/Qwen3-VL-2B-Instruct")
+ADAPTER_PATH = os.getenv("ADAPTER_PATH", "/app/models/weights")
+ADAPTER_VERSION = os.getenv("ADAPTER_VERSION", "")
+MODEL_BUNDLE_PATH = os.getenv("MODEL_BUNDLE_PATH", "/app/models/bundle")
+TORCH_DTYPE = os.getenv("TORCH_DTYPE", "float16")
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+# Метрики Prometheus реплик пишутся в файлы и собираются здесь
+METRICS_DIR = os.path.join(REPLICA_RUN_DIR, "prometheus")
+
+# Заголовки запроса, передаваемые реплике (трассировка добавляется отдельно)
+FORWARDED_HEADERS = ("content-type", "content-length", "x-request-timeout-ms")
+
+pool: Optional[ReplicaPool] = None
+draining = False
+
+REPLICA_IN_FLIGHT = Gauge(
+    "vlm_dispatcher_in_flight",
+    "Запросы, выполняющиеся на реплике",
+    ["worker"]
+)
+
+
+def shared_weights_key() -> str:
+    """
+    Ключ версии общих весов: базовая модель, версия адаптеров (или файлы
+    бандла) и тип весов. Файл с тем же ключом пересобирать не нужно.
+    """
+    manifest = read_manifest(MODEL_BUNDLE_PATH)
+    key_fields = {
+        "model": BASE_MODEL_ID,
+        "torch_dtype": TORCH_DTYPE,
+        "adapter_version": ADAPTER_VERSION or adapter_files_version(ADAPTER_PATH),
+        "bundle": {name: f["sha256"] for name, f in manifest["files"].items()} if manifest else None
+    }
+    payload = json.dumps(key_fields, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def read_shared_weights_key(path: str) -> Optional[str]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+async def prepare_shared_weights():
+    """
+    Загружает модель с LoRA в отдельном процессе и сохраняет объединенные
+    веса в SHARED_WEIGHTS_PATH (память процесса освобождается после записи).
+    Если файл собран для той же модели и адаптеров, он используется повторно.
+
+    Raises:
+        RuntimeError: процесс подготовки завершился с ошибкой
+    """
+    key = shared_weights_key()
+    key_path = f"{SHARED_WEIGHTS_PATH}.key"
+    if os.path.exists(SHARED_WEIGHTS_PATH) and read_shared_weights_key(key_path) == key:
+        size_gb = os.path.getsize(SHARED_WEIGHTS_PATH) / (1024**3)
+        logger.info(f"✅ Общие веса актуальны (ключ {key}, {size_gb:.2f} GB), пересборка не нужна")
+        return
+
+    logger.info(f"⏳ Подготовка общих весов: {SHARED_WEIGHTS_PATH} (ключ {key})")
+    # Ключ удаляется до записи: недописанный файл не примут за актуальный
+    if os.path.exists(key_path):
+        os.unlink(key_path)
+    env = {
+        name: value for name, value in os.environ.items()
+        if name not in ("SHARED_WEIGHTS_PATH", "CPU_AFFINITY")
+    }
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "shared_weights.py", SHARED_WEIGHTS_PATH, cwd=APP_DIR, env=env
+    )
+    if await process.wait() != 0:
+        raise RuntimeError(f"Не удалось подготовить общие веса (код {process.returncode})")
+    tmp_key_path = f"{key_path}.tmp"
+    with open(tmp_key_path, "w", encoding="utf-8") as f:
+        f.write(key)
+    os.replace(tmp_key_path, key_path)
+    size_gb = os.path.getsize(SHARED_WEIGHTS_PATH) / (1024**3)
+    logger.info(f"✅ Общие веса готовы: {size_gb:.2f} GB")
+
+
+def build_pool() -> ReplicaPool:
+    """Реплики на непересекающихся наборах ядер"""
+    cores = parse_cores(VLM_WORKER_CORES) if VLM_WORKER_CORES else sorted(os.sched_getaffinity(0))
+    env = {
+        "SHARED_WEIGHTS_PATH": SHARED_WEIGHTS_PATH,
+        "DEVICE": "cpu",
+        "PROMETHEUS_MULTIPROC_DIR": METRICS_DIR
+    }
+    replicas = [
+        WorkerReplica(index, core_set, os.path.join(REPLICA_RUN_DIR, f"worker-{index}.sock"), APP_DIR, env)
+        for index, core_set in enumerate(split_cores(cores, VLM_WORKERS))
+    ]
+    return ReplicaPool(
+        replicas,
+        REPLICA_START_TIMEOUT,
+        on_exit=lambda pid: multiprocess.mark_process_dead(pid, METRICS_DIR)
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Управление жизненным циклом: общие веса, запуск и остановка реплик"""
+    global pool, draining
+
+    # Startup
+    logger.info("=" * 60)
+    logger.info(f"🚀 Запуск VLM Dispatcher: {VLM_WORKERS} реплик")
+    logger.info("=" * 60)
+    configure_tracing("vlm-dispatcher")
+
+    if QUANTIZATION != "none":
+        # Каждая реплика держала бы свою квантованную копию декодера
+        raise RuntimeError(
+            f"QUANTIZATION={QUANTIZATION} не поддерживается с dispatcher:app: "
+            "реплики используют общие неквантованные веса через mmap"
+        )
+
+    # Файлы метрик прошлого запуска только исказили бы счетчики
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+    os.makedirs(METRICS_DIR, exist_ok=True)
+
+    await prepare_shared_weights()
+    pool = build_pool()
+    await pool.start()
+    monitor_task = asyncio.create_task(pool.monitor())
+    logger.info("✅ VLM Dispatcher готов к работе")
+
+    yield
+
+    # Shutdown: реплики дорабатывают принятые запросы
+    logger.info("🛑 Остановка реплик...")
+    draining = True
+    monitor_task.cancel()
+    await pool.stop(INFERENCE_DRAIN_TIMEOUT + 10)
+    shutdown_tracing()
+
+
+# Создание FastAPI приложения
+app = FastAPI(
+    title="VLM Dispatcher",
+    description="Несколько процессов VLM Service с общими весами на одном CPU хосте",
+    version="1.0.0",
+    lifespan=lifespan
+)
+
+app.add_middleware(TraceMiddleware)
+
+
+def forwarded_headers(request: Request) -> Dict[str, str]:
+    """Заголовки для реплики: тип тела, дедлайн и контекст трассировки"""
+    headers = {name: request.headers[name] for name in FORWARDED_HEADERS if name in request.headers}
+    headers.update(trace_headers())
+    return headers
+
+
+class BodyRelay:
+    """
+    Тело запроса клиента, передаваемое реплике по мере получения, без
+    буферизации загрузки в памяти диспетчера
+    """
+
+    def __init__(self, request: Request):
+        self.request = request
+        self.complete = False
+
+    async def __aiter__(self):
+        async for chunk in self.request.stream():
+            yield chunk
+        self.complete = True
+
+
+def replica_response(response: httpx.Response) -> Response:
+    """Ответ реплики без изменений (статус, тело, Retry-After)"""
+    headers = {}
+    if "retry-after" in response.headers:
+        headers["Retry-After"] = response.headers["retry-after"]
+    return Response(
+        content=response.content,
+        status_code=response.status_code,
+        media_type=response.headers.get("content-type"),
+        headers=headers
+    )
+
+
+def no_replica_error(e: NoReplicaAvailable) -> HTTPException:
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+
+
+@app.get("/")
+async def root():
+    """Корневой эндпоинт с информацией о сервисе"""
+    return {
+        "service": "VLM Dispatcher",
+        "version": "1.0.0",
+        "workers": VLM_WORKERS,
+        "endpoints": {
+            "infer": "/infer (POST)",
+            "infer_stream": "/infer/stream (POST)",
+            "model_info": "/model_info (GET)",
+            "health": "/health (GET)",
+            "metrics": "/metrics (GET)",
+            "metrics_prometheus": "/metrics/prometheus (GET)",
+            "docs": "/docs"
+        }
+    }
+
+
+@app.get("/health")
+async def health_check():
+    """
+    Проверка здоровья: healthy, пока хотя бы одна реплика готова
+    """
+    replicas = pool.replicas if pool else []
+    ready = sum(1 for replica in replicas if replica.ready)
+    if draining:
+        status = "draining"
+    elif ready:
+        status = "healthy"
+    else:
+        status = "initializing"
+    return {
+        "status": status,
+        "model_loaded": ready > 0,
+        "device": "cpu",
+        "workers": len(replicas),
+        "workers_ready": ready,
+        "queue_depth": sum(replica.in_flight for replica in replicas)
+    }
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Метрики диспетчера и каждой реплики (ее /metrics)
+    """
+    replicas = pool.replicas if pool else []
+
+    async def replica_metrics(replica: WorkerReplica):
+        if not replica.ready:
+            return None
+        try:
+            response = await replica.client.get("/metrics", timeout=5)
+            return response.json()
+        except (httpx.HTTPError, ValueError):
+            return None
+
+    metrics = await asyncio.gather(*(replica_metrics(replica) for replica in replicas))
+    return {
+        "workers": {
+            replica.key: {**replica.stats(), "metrics": replica_metrics_data}
+            for replica, replica_metrics_data in zip(replicas, metrics)
+        },
+        "inference_count": sum(m["inference_count"] for m in metrics if m),
+        "queue_depth": sum(replica.in_flight for replica in replicas)
+    }
+
+
+@app.get("/metrics/prometheus")
+async def get_prometheus_metrics():
+    """
+    Метрики всех реплик (суммируются по процессам) и диспетчера
+    """
+    for replica in (pool.replicas if pool else []):
+        REPLICA_IN_FLIGHT.labels(replica.key).set(replica.in_flight)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=METRICS_DIR)
+    body = generate_latest(registry) + generate_latest()
+    return Response(content=body, media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/model_info")
+async def model_info():
+    """
+    Информация о модели (у всех реплик одинаковая)
+    """
+    try:
+        replica = pool.select()
+    except NoReplicaAvailable as e:
+        raise no_replica_error(e)
+    response = await replica.client.get("/model_info")
+    return replica_response(response)
+
+
+@app.post("/infer")
+async def infer(request: Request):
+    """
+    Инференс на наименее загруженной реплике
+
+    Если клиент закрыл соединение, соединение с репликой тоже закрывается,
+    и она прерывает генерацию.
+    """
+    body = BodyRelay(request)
+    try:
+        async with pool.acquire() as replica:
+            call = asyncio.ensure_future(
+                replica.client.post("/infer", content=body, headers=forwarded_headers(request))
+            )
+            try:
+                while True:
+                    done, _ = await asyncio.wait([call], timeout=DISCONNECT_POLL_INTERVAL)
+                    if done:
+                        return replica_response(call.result())
+                    # Пока тело передается, проверка соединения забрала бы его часть;
+                    # отключение клиента в это время прерывает чтение тела
+                    if body.complete and await request.is_disconnected():
+                        raise HTTPException(
+                            status_code=499,
+                            detail="Клиент закрыл соединение, генерация прервана"
+                        )
+            finally:
+                call.cancel()
+    except NoReplicaAvailable as e:
+        raise no_replica_error(e)
+    except ClientDisconnect:
+        raise HTTPException(status_code=499, detail="Клиент закрыл соединение, генерация прервана")
+    except httpx.RequestError as e:
+        logger.error(f"❌ Реплика недоступна: {e}")
+        raise HTTPException(status_code=502, detail=f"Реплика недоступна: {e}")
+
+
+@app.post("/infer/stream")
+async def infer_stream(request: Request):
+    """
+    Потоковый инференс на наименее загруженной реплике: NDJSON поток
+    реплики передается клиенту как есть
+    """
+    stack = AsyncExitStack()
+    try:
+        replica = await stack.enter_async_context(pool.acquire())
+        upstream = replica.client.build_request(
+            "POST", "/infer/stream", content=BodyRelay(request), headers=forwarded_headers(request)
+        )
+        response = await replica.client.send(upstream, stream=True)
+    except NoReplicaAvailable as e:
+        await stack.aclose()
+        raise no_replica_error(e)
+    except ClientDisconnect:
+        await stack.aclose()
+        raise HTTPException(status_code=499, detail="Клиент закрыл соединение, генерация прервана")
+    except httpx.RequestError as e:
+        await stack.aclose()
+        logger.error(f"❌ Реплика недоступна: {e}")
+        raise HTTPException(status_code=502, detail=f"Реплика недоступна: {e}")
+
+    if response.status_code != 200:
+        # Ошибка до начала потока (400, 503...) - отдаем с тем же статусом
+        await response.aread()
+        await response.aclose()
+        await stack.aclose()
+        return replica_response(response)
+
+    async def relay():
+        # При отключении клиента поток закрывается, и реплика прерывает генерацию
+        try:
+            async for chunk in response.aiter_raw():
+                yield chunk
+        finally:
+            await response.aclose()
+            await stack.aclose()
+
+    return StreamingResponse(relay(), media_type=response.headers.get("content-type"))
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=8002)
@@ -4,26 +4,56 @@ VLM Inference Service - FastAPI сервис для распознавания 
 """
 
 import os
+import sys
+import json
+import mmap
 import time
+import hashlib
+import asyncio
+import resource
 import logging
-from typing import Optional
+from typing import List, Optional, Union
 from contextlib import asynccontextmanager
 
 import torch
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, Form, Request, UploadFile, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from PIL import Image
 from io import BytesIO
 
-from transformers import Qwen3VLForConditionalGeneration, AutoProcessor
+from transformers import (
+    Qwen3VLForConditionalGeneration,
+    AutoProcessor,
+    AsyncTextIteratorStreamer,
+    StoppingCriteria,
+    StoppingCriteriaList
+)
 from peft import PeftModel
 from qwen_vl_utils import process_vision_info
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+from quality import QualityPolicy, QualitySettings, PIXELS_PER_TOKEN
+from batching import BatchEntry, BatchScheduler
+from worker import InferenceWorker, WorkerBusy
+from shared_weights import load_snapshot
+from bundle import BundleError, adapter_files_version, read_manifest, verify_bundle
+from quantization import (
+    QUANTIZATION_NONE, compute_dtype, measure_forward_latency,
+    model_memory_bytes, quantize_model
+)
+from prefix_cache import PrefixCache
+from replicas import format_cores, parse_cores
+from tracing import (
+    TraceMiddleware, TraceIdLogFilter, configure_tracing, shutdown_tracing, record_span
+)
 
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s'
 )
+for handler in logging.getLogger().handlers:
+    handler.addFilter(TraceIdLogFilter())
 logger = logging.getLogger(__name__)
 
 # Конфигурация из переменных окружения
@@ -32,30 +62,390 @@ ADAPTER_PATH = os.getenv("ADAPTER_PATH", "/app/models/weights")
 DEVICE = os.getenv("DEVICE", "cpu")
 TORCH_DTYPE = os.getenv("TORCH_DTYPE", "float16")
 MAX_NEW_TOKENS = int(os.getenv("MAX_NEW_TOKENS", "384"))
+# Бюджет токенов изображения (1 токен = 28x28 пикселей)
+IMAGE_MIN_TOKENS = int(os.getenv("IMAGE_MIN_TOKENS", "256"))
+IMAGE_MAX_TOKENS = int(os.getenv("IMAGE_MAX_TOKENS", "512"))
+# Снижение бюджетов под нагрузкой: от QUALITY_QUEUE_LOW ожидающих запросов
+# и до минимумов при QUALITY_QUEUE_HIGH
+QUALITY_DEGRADATION_ENABLED = os.getenv("QUALITY_DEGRADATION_ENABLED", "true").lower() == "true"
+QUALITY_QUEUE_LOW = int(os.getenv("QUALITY_QUEUE_LOW", "1"))
+QUALITY_QUEUE_HIGH = int(os.getenv("QUALITY_QUEUE_HIGH", "6"))
+IMAGE_TOKENS_FLOOR = int(os.getenv("IMAGE_TOKENS_FLOOR", str(IMAGE_MIN_TOKENS)))
+MAX_NEW_TOKENS_FLOOR = int(os.getenv("MAX_NEW_TOKENS_FLOOR", "256"))
+ADAPTER_VERSION = os.getenv("ADAPTER_VERSION", "")
+# Бандл модели (build_bundle.py): LoRA объединены с весами, тип уже приведен;
+# если в каталоге есть манифест, модель загружается из него.
+# BUNDLE_VERIFY: size (наличие и размер файлов), sha256 или none
+MODEL_BUNDLE_PATH = os.getenv("MODEL_BUNDLE_PATH", "/app/models/bundle")
+BUNDLE_VERIFY = os.getenv("BUNDLE_VERIFY", "size")
+# Общий с Backend том с файлами, адресуемыми по SHA256 (пусто - не используется)
+BLOB_STORE_PATH = os.getenv("BLOB_STORE_PATH", "")
+# Период проверки, не закрыл ли клиент соединение во время генерации
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.5"))
+# Батчинг /infer: до BATCH_MAX_SIZE одновременных запросов в одном generate,
+# первый запрос ждет остальные не дольше BATCH_MAX_WAIT_MS (1 - без батчинга)
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "4"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "20"))
+# Очередь к потоку инференса: сверх INFERENCE_QUEUE_SIZE ожидающих запросов - 503;
+# при остановке принятые запросы дорабатываются не дольше INFERENCE_DRAIN_TIMEOUT
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "32"))
+INFERENCE_DRAIN_TIMEOUT = float(os.getenv("INFERENCE_DRAIN_TIMEOUT", "60"))
+# Реплика диспетчера (dispatcher.py): веса из общего файла в режиме mmap,
+# процесс привязан к ядрам CPU_AFFINITY ("0-7,16-23") с TORCH_NUM_THREADS потоками
+SHARED_WEIGHTS_PATH = os.getenv("SHARED_WEIGHTS_PATH", "")
+CPU_AFFINITY = os.getenv("CPU_AFFINITY", "")
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", "0"))
+# Квантизация линейных слоев декодера на CPU после подключения LoRA:
+# none, int8 (динамическая, float32) или int4 (только веса, torchao, bfloat16)
+QUANTIZATION = os.getenv("QUANTIZATION", "none").lower()
+INT4_GROUP_SIZE = int(os.getenv("INT4_GROUP_SIZE", "128"))
+# Замер прямого прохода при старте для /health (0 - не замерять)
+LATENCY_PROBE_TOKENS = int(os.getenv("LATENCY_PROBE_TOKENS", "64"))
+# Порядок промпта: image_first (как при дообучении адаптеров) или text_first -
+# SYSTEM_PROMPT перед изображением попадает в KV кэш постоянного начала.
+# KV кэш начала промпта используется только с text_first: при image_first
+# до изображения стоит лишь разметка роли, и экономить нечего
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "image_first")
+PREFIX_CACHE_ENABLED = os.getenv("PREFIX_CACHE_ENABLED", "true").lower() == "true"
 #os.environ["HF_ENDPOINT"] = "https://hf-mirror.com"
 
 # Глобальные переменные для модели
 model = None
 processor = None
 model_load_time = None
+adapter_version = None
+# Тип весов загруженной модели (у бандла - заданный при сборке)
+model_dtype = TORCH_DTYPE
+# Манифест загруженного бандла (None - модель собрана из базовой и LoRA)
+bundle_manifest = None
+# Примененная квантизация, память весов и замер прямого прохода при старте
+quantization = QUANTIZATION_NONE
+model_memory = None
+forward_latency = None
+# KV кэш постоянного начала промпта (None - выключен или не прошел проверку)
+prefix_cache: Optional[PrefixCache] = None
 
 # Промпт для модели
 SYSTEM_PROMPT = (
     "Ты эксперт по BPMN. Выдавай ответ строго в формате Markdown-таблицы. "
     "Заголовок таблицы должен быть точно: | № | Наименование действия | Роль |."
 )
+PROMPT_LAYOUT_IMAGE_FIRST = "image_first"
+PROMPT_LAYOUT_TEXT_FIRST = "text_first"
+# Порядок промпта меняет ответы и входит в хэш (для image_first хэш прежний)
+PROMPT_KEY = SYSTEM_PROMPT if PROMPT_LAYOUT == PROMPT_LAYOUT_IMAGE_FIRST else f"{PROMPT_LAYOUT}:{SYSTEM_PROMPT}"
+PROMPT_HASH = hashlib.sha256(PROMPT_KEY.encode("utf-8")).hexdigest()[:16]
 
 # Метрики
 inference_count = 0
 total_inference_time = 0.0
+# Генерации, прерванные по дедлайну или из-за отключения клиента
+cancelled_generations = {"deadline": 0, "client_disconnect": 0}
+
+# Модель обслуживает одну генерацию за раз в выделенном потоке
+inference_worker = InferenceWorker(INFERENCE_QUEUE_SIZE)
+# Сервис останавливается: новые запросы не принимаются
+draining = False
+
+# Сборщик батчей для /infer (создается при старте, если BATCH_MAX_SIZE > 1)
+batch_scheduler: Optional[BatchScheduler] = None
+
+# Бюджеты изображения и генерации в зависимости от очереди
+quality_policy = QualityPolicy(
+    max_image_tokens=IMAGE_MAX_TOKENS,
+    image_tokens_floor=IMAGE_TOKENS_FLOOR,
+    max_new_tokens=MAX_NEW_TOKENS,
+    max_new_tokens_floor=MAX_NEW_TOKENS_FLOOR,
+    queue_low=QUALITY_QUEUE_LOW,
+    queue_high=QUALITY_QUEUE_HIGH,
+    enabled=QUALITY_DEGRADATION_ENABLED
+)
+
+# Prometheus гистограммы по этапам инференса
+LATENCY_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 20, 30, 60, 120, 300
+)
+STAGE_SECONDS = Histogram(
+    "vlm_stage_duration_seconds",
+    "Длительность этапа инференса",
+    ["stage", "model", "status"],
+    buckets=LATENCY_BUCKETS
+)
+GENERATED_TOKENS = Histogram(
+    "vlm_generated_tokens",
+    "Число сгенерированных токенов на запрос",
+    ["model", "status"],
+    buckets=(8, 16, 32, 64, 128, 192, 256, 384, 512, 1024)
+)
+DEGRADED_REQUESTS = Counter(
+    "vlm_degraded_requests_total",
+    "Запросы, обработанные с уменьшенными бюджетами изображения и генерации"
+)
+BATCH_SIZE = Histogram(
+    "vlm_batch_size",
+    "Число запросов в одном вызове generate (/infer)",
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16, 32)
+)
+BATCH_WAIT_SECONDS = Histogram(
+    "vlm_batch_wait_seconds",
+    "Время от поступления запроса до формирования его батча",
+    buckets=LATENCY_BUCKETS
+)
+REJECTED_REQUESTS = Counter(
+    "vlm_rejected_requests_total",
+    "Запросы, отклоненные из-за заполненной очереди или остановки сервиса"
+)
+QUEUE_DEPTH = Gauge(
+    "vlm_queue_depth",
+    "Запросы, ожидающие модель"
+)
+CANCELLED_GENERATIONS = Counter(
+    "vlm_cancelled_generations_total",
+    "Генерации, прерванные по дедлайну или из-за отключения клиента",
+    ["reason", "stage"]
+)
+PREFIX_CACHE_TOKENS = Counter(
+    "vlm_prefix_cache_tokens_total",
+    "Токены промпта, взятые из KV кэша постоянного начала вместо prefill"
+)
+
+# Этапы инференса
+STAGE_QUEUE_WAIT = "queue_wait"
+STAGE_PREPROCESSING = "preprocessing"
+STAGE_PREFILL = "prefill"
+STAGE_DECODE = "decode"
+STAGE_TOTAL = "total"
+STAGE_GENERATION = "generation"
+
+# Заголовок Backend с оставшимся до дедлайна запроса временем
+DEADLINE_HEADER = "X-Request-Timeout-Ms"
+
+# Причины прерывания генерации
+CANCEL_DEADLINE = "deadline"
+CANCEL_DISCONNECT = "client_disconnect"
+
+
+def observe_stage(stage: str, status: str, seconds: float, end: Optional[float] = None):
+    """
+    Записывает этап в гистограмму и как span трассировки
+    
+    Args:
+        end: Момент окончания этапа (time.time()), по умолчанию - сейчас
+    """
+    STAGE_SECONDS.labels(stage, BASE_MODEL_ID, status).observe(seconds)
+    end = end or time.time()
+    record_span(stage, end - seconds, end, "error" if status == "error" else "ok")
+
+
+class TokenTimer(StoppingCriteria):
+    """
+    Отмечает время генерации токенов, не останавливая генерацию
+    
+    generate вызывает критерии после каждого шага: первый вызов -
+    конец prefill (обработки промпта и изображения), дальше идет decode.
+    """
+    
+    def __init__(self):
+        self.started = time.time()
+        self.first_token_at: Optional[float] = None
+        self.tokens = 0
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.first_token_at is None:
+            self.first_token_at = time.time()
+        self.tokens += 1
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+    
+    def observe(self, status: str):
+        """Записывает длительность prefill и decode в гистограммы"""
+        now = time.time()
+        if self.first_token_at is None:
+            observe_stage(STAGE_PREFILL, status, now - self.started, end=now)
+        else:
+            observe_stage(
+                STAGE_PREFILL, status, self.first_token_at - self.started, end=self.first_token_at
+            )
+            observe_stage(STAGE_DECODE, status, now - self.first_token_at, end=now)
+        GENERATED_TOKENS.labels(BASE_MODEL_ID, status).observe(self.tokens)
+
+
+class GenerationControl(StoppingCriteria):
+    """
+    Останавливает генерацию после истечения дедлайна запроса или отмены
+    (клиент закрыл соединение)
+    
+    Проверяется после каждого токена, поэтому генерация прекращается на
+    следующем шаге decode; prefill прервать нельзя.
+    """
+    
+    def __init__(self, deadline: Optional[float]):
+        self.deadline = deadline
+        self.reason: Optional[str] = None
+    
+    def cancel(self, reason: str):
+        if self.reason is None:
+            self.reason = reason
+    
+    def expired(self) -> bool:
+        """Прервана ли генерация (истечение дедлайна проверяется здесь же)"""
+        if self.reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.reason = CANCEL_DEADLINE
+        return self.reason is not None
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full(
+            (input_ids.shape[0],), self.expired(), dtype=torch.bool, device=input_ids.device
+        )
+
+
+class BatchControl(StoppingCriteria):
+    """
+    Прерывание генерации по строкам батча: строка отмененного запроса
+    останавливается, остальные продолжают генерацию
+    """
+    
+    def __init__(self, controls: List[GenerationControl]):
+        self.controls = controls
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.tensor(
+            [control.expired() for control in self.controls], dtype=torch.bool, device=input_ids.device
+        )
+
+
+class GenerationCancelled(Exception):
+    """Генерация прервана: ее результат уже никто не ждет"""
+    
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def record_cancellation(reason: str, stage: str):
+    """Учитывает прерванную генерацию в метриках"""
+    cancelled_generations[reason] += 1
+    CANCELLED_GENERATIONS.labels(reason, stage).inc()
+    logger.warning(f"🛑 Генерация прервана ({reason}) на этапе {stage}")
+
+
+def cancelled_error(e: GenerationCancelled) -> HTTPException:
+    """HTTP ответ для прерванной генерации"""
+    if e.reason == CANCEL_DEADLINE:
+        return HTTPException(status_code=504, detail="Дедлайн запроса истек, генерация прервана")
+    return HTTPException(status_code=499, detail="Клиент закрыл соединение, генерация прервана")
+
+
+def get_request_deadline(request: Request) -> Optional[float]:
+    """
+    Дедлайн запроса (time.monotonic()) из заголовка X-Request-Timeout-Ms
+    
+    Returns:
+        Момент, после которого генерация прерывается, или None без заголовка
+    """
+    value = request.headers.get(DEADLINE_HEADER)
+    if not value:
+        return None
+    try:
+        timeout_ms = int(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Некорректный заголовок {DEADLINE_HEADER}")
+    return time.monotonic() + max(0, timeout_ms) / 1000
+
+
+def compute_adapter_version() -> str:
+    """
+    Определяет версию LoRA адаптеров.
+    Берется из ADAPTER_VERSION, затем из манифеста бандла, иначе считается
+    по конфигу и весам адаптера.
+    """
+    if ADAPTER_VERSION:
+        return ADAPTER_VERSION
+    if bundle_manifest:
+        return bundle_manifest["adapter_version"]
+    return adapter_files_version(ADAPTER_PATH)
+
+
+def load_bundle_manifest() -> Optional[dict]:
+    """
+    Манифест бандла из MODEL_BUNDLE_PATH (None - бандла нет)
+    
+    Raises:
+        BundleError: бандл собран для другой базовой модели
+    """
+    manifest = read_manifest(MODEL_BUNDLE_PATH)
+    if manifest is None:
+        return None
+    if manifest["base_model"] != BASE_MODEL_ID:
+        raise BundleError(
+            f"Бандл собран для {manifest['base_model']}, а BASE_MODEL_ID={BASE_MODEL_ID}"
+        )
+    if manifest["torch_dtype"] != TORCH_DTYPE:
+        logger.warning(
+            f"⚠️  Бандл сохранен в {manifest['torch_dtype']}, TORCH_DTYPE={TORCH_DTYPE} не применяется"
+        )
+    return manifest
 
 
-def load_model_and_processor():
+def get_model_info() -> dict:
+    """Параметры, от которых зависит результат инференса (используются как ключ кэша)"""
+    return {
+        "model": BASE_MODEL_ID,
+        "adapter_version": adapter_version,
+        "prompt_hash": PROMPT_HASH,
+        "max_tokens": MAX_NEW_TOKENS,
+        "torch_dtype": model_dtype,
+        "quantization": quantization
+    }
+
+
+def build_prefix_cache() -> Optional[PrefixCache]:
+    """
+    Считает KV состояние начала промпта (до первого изображения) и
+    проверяет, что следующий токен с ним тот же, что после обычного prefill
+    
+    Returns:
+        Кэш или None, если постоянного начала нет или проверка не пройдена
+    """
+    logger.info("⏳ Подготовка KV кэша начала промпта...")
+    # Промпт с пустым изображением минимального бюджета
+    image = Image.new("RGB", (448, 448), "white")
+    inputs, _ = prepare_inputs([image], IMAGE_MIN_TOKENS * PIXELS_PER_TOKEN)
+    input_ids = inputs["input_ids"]
+    vision_start = processor.tokenizer.convert_tokens_to_ids("<|vision_start|>")
+    positions = (input_ids[0] == vision_start).nonzero()
+    if len(positions) == 0 or positions[0].item() == 0:
+        logger.warning("⚠️  У промпта нет постоянного начала, KV кэш не используется")
+        return None
+    
+    # LoRA слои подключены к модулям базовой модели и работают и без обертки
+    base_model = model.get_base_model() if isinstance(model, PeftModel) else model
+    try:
+        cache = PrefixCache(base_model, input_ids[:, :positions[0].item()])
+        verified = cache.verify(inputs)
+    except Exception as e:
+        logger.warning(f"⚠️  KV кэш начала промпта не поддерживается моделью: {e}")
+        return None
+    if not verified:
+        logger.warning("⚠️  Ответ с KV кэшем начала промпта расходится с обычным, кэш не используется")
+        return None
+    
+    logger.info(f"✅ KV кэш начала промпта: {cache.length} из {input_ids.shape[1]} токенов")
+    return cache
+
+
+def load_model_and_processor(for_serving: bool = True):
     """
     Загружает базовую модель и LoRA адаптеры при старте сервиса.
     Выполняется один раз при инициализации.
+    
+    Args:
+        for_serving: применить QUANTIZATION, подготовить KV кэш начала
+            промпта и замерить прямой проход (False - для подготовки
+            общих весов диспетчером)
     """
-    global model, processor, model_load_time
+    global model, processor, model_load_time, adapter_version, model_dtype, bundle_manifest
+    global quantization, model_memory, forward_latency, prefix_cache
     
     logger.info("=" * 60)
     logger.info("🚀 Инициализация VLM Inference Service")
@@ -64,10 +454,29 @@ def load_model_and_processor():
     logger.info(f"🔧 Адаптеры: {ADAPTER_PATH}")
     logger.info(f"💻 Устройство: {DEVICE}")
     logger.info(f"🔢 Тип данных: {TORCH_DTYPE}")
+    logger.info(f"🗜️  Квантизация: {QUANTIZATION}")
+    logger.info(f"📝 Порядок промпта: {PROMPT_LAYOUT}")
     logger.info("=" * 60)
     
+    if PROMPT_LAYOUT not in (PROMPT_LAYOUT_IMAGE_FIRST, PROMPT_LAYOUT_TEXT_FIRST):
+        raise ValueError(f"Неизвестный PROMPT_LAYOUT: {PROMPT_LAYOUT}")
+    if SHARED_WEIGHTS_PATH and QUANTIZATION != QUANTIZATION_NONE:
+        # Квантованная копия декодера была бы своей в каждой реплике,
+        # и общие через mmap веса перестали бы экономить память
+        raise ValueError(
+            f"QUANTIZATION={QUANTIZATION} несовместима с общими весами (SHARED_WEIGHTS_PATH): "
+            "используйте QUANTIZATION=none или VLM_APP=main:app"
+        )
+    
     start_time = time.time()
     
+    if CPU_AFFINITY:
+        # Реплика работает только на своих ядрах, не мешая соседним
+        cores = parse_cores(CPU_AFFINITY)
+        os.sched_setaffinity(0, cores)
+        torch.set_num_threads(TORCH_NUM_THREADS or len(cores))
+        logger.info(f"📌 Ядра {format_cores(cores)}, потоков intra-op: {torch.get_num_threads()}")
+    
     try:
         # Определяем устройство
         if DEVICE == "cuda" and torch.cuda.is_available():
@@ -80,44 +489,87 @@ def load_model_and_processor():
             device = torch.device("cpu")
             logger.info("⚠️  Используем CPU (может быть медленно)")
         
-        # Определяем dtype
-        dtype = torch.float16 if TORCH_DTYPE == "float16" else torch.float32
+        # Квантованные ядра есть только для CPU
+        quantization_mode = QUANTIZATION
+        if quantization_mode != QUANTIZATION_NONE and device.type != "cpu":
+            logger.warning(f"⚠️  QUANTIZATION={QUANTIZATION} поддерживается только на CPU, не применяется")
+            quantization_mode = QUANTIZATION_NONE
+        
+        # Бандл задает тип весов сам; для квантизации модель сразу
+        # загружается в типе, в котором будет работать
+        bundle_manifest = load_bundle_manifest()
+        if bundle_manifest:
+            model_dtype = bundle_manifest["torch_dtype"]
+            dtype = getattr(torch, model_dtype)
+        elif quantization_mode != QUANTIZATION_NONE:
+            dtype = compute_dtype(quantization_mode)
+            model_dtype = str(dtype).replace("torch.", "")
+        else:
+            dtype = torch.float16 if TORCH_DTYPE == "float16" else torch.float32
         logger.info(f"🔢 Используем dtype: {dtype}")
         
         # 1. Загрузка базовой модели
-        logger.info("⏳ Загрузка базовой модели...")
-        model = Qwen3VLForConditionalGeneration.from_pretrained(
-            BASE_MODEL_ID,
-            torch_dtype=dtype,
-            device_map="auto" if DEVICE == "cuda" else None
-        )
-        
-        if DEVICE != "cuda":
-            model = model.to(device)
-        
-        logger.info("✅ Базовая модель загружена")
+        if SHARED_WEIGHTS_PATH:
+            # Реплика: веса уже объединены с LoRA, файл отображается в память
+            logger.info(f"⏳ Загрузка общих весов из {SHARED_WEIGHTS_PATH}...")
+            model = load_snapshot(SHARED_WEIGHTS_PATH, Qwen3VLForConditionalGeneration)
+            logger.info("✅ Общие веса загружены (mmap, только чтение)")
+        elif bundle_manifest:
+            # Веса в safetensors уже в нужном типе - загрузка без приведения и PEFT
+            verify_bundle(MODEL_BUNDLE_PATH, bundle_manifest, BUNDLE_VERIFY)
+            logger.info(f"⏳ Загрузка бандла из {MODEL_BUNDLE_PATH}...")
+            model = Qwen3VLForConditionalGeneration.from_pretrained(
+                MODEL_BUNDLE_PATH,
+                torch_dtype=dtype,
+                device_map="auto" if DEVICE == "cuda" else None
+            )
+            
+            if DEVICE != "cuda":
+                model = model.to(device)
+            model.eval()
+            
+            logger.info(f"✅ Бандл загружен (адаптеры {bundle_manifest['adapter_version']})")
+        else:
+            logger.info("⏳ Загрузка базовой модели...")
+            model = Qwen3VLForConditionalGeneration.from_pretrained(
+                BASE_MODEL_ID,
+                torch_dtype=dtype,
+                device_map="auto" if DEVICE == "cuda" else None
+            )
+            
+            if DEVICE != "cuda":
+                model = model.to(device)
+            
+            logger.info("✅ Базовая модель загружена")
         
         # 2. Загрузка процессора
         logger.info("⏳ Загрузка процессора...")
+        # Конфиг процессора лежит в бандле, иначе - в адаптере
+        processor_path = MODEL_BUNDLE_PATH if bundle_manifest else ADAPTER_PATH
         try:
-            # Пытаемся загрузить из адаптера (если там есть конфиг)
+            # Пытаемся загрузить из бандла или адаптера (если там есть конфиг)
             processor = AutoProcessor.from_pretrained(
-                ADAPTER_PATH,
-                min_pixels=256*28*28,
-                max_pixels=512*28*28
+                processor_path,
+                min_pixels=IMAGE_MIN_TOKENS * PIXELS_PER_TOKEN,
+                max_pixels=IMAGE_MAX_TOKENS * PIXELS_PER_TOKEN
             )
-            logger.info("✅ Процессор загружен из адаптера")
+            logger.info(f"✅ Процессор загружен из {processor_path}")
         except Exception as e:
-            logger.warning(f"⚠️  Не удалось загрузить процессор из адаптера: {e}")
+            logger.warning(f"⚠️  Не удалось загрузить процессор из {processor_path}: {e}")
             processor = AutoProcessor.from_pretrained(
                 BASE_MODEL_ID,
-                min_pixels=256*28*28,
-                max_pixels=512*28*28
+                min_pixels=IMAGE_MIN_TOKENS * PIXELS_PER_TOKEN,
+                max_pixels=IMAGE_MAX_TOKENS * PIXELS_PER_TOKEN
             )
             logger.info("✅ Процессор загружен из базовой модели")
         
+        # Паддинг слева: в батче ответ каждой строки начинается сразу после входа
+        processor.tokenizer.padding_side = "left"
+        
         # 3. Подключение LoRA адаптеров
-        if os.path.exists(ADAPTER_PATH):
+        if SHARED_WEIGHTS_PATH or bundle_manifest:
+            logger.info("✅ LoRA адаптеры уже объединены с весами")
+        elif os.path.exists(ADAPTER_PATH):
             logger.info("⏳ Подключение LoRA адаптеров...")
             try:
                 model = PeftModel.from_pretrained(model, ADAPTER_PATH)
@@ -131,12 +583,40 @@ def load_model_and_processor():
             logger.warning(f"⚠️  Адаптеры не найдены в {ADAPTER_PATH}")
             logger.warning("⚠️  Работаем на базовой модели без дообучения")
         
+        # 4. Квантизация декодера: LoRA объединяются с весами до нее,
+        # иначе квантовались бы и матрицы адаптеров
+        if for_serving and quantization_mode != QUANTIZATION_NONE:
+            logger.info(f"⏳ Квантизация декодера ({quantization_mode})...")
+            quantization_start = time.time()
+            if isinstance(model, PeftModel):
+                model = model.merge_and_unload()
+            layers = quantize_model(model, quantization_mode, INT4_GROUP_SIZE)
+            quantization = quantization_mode
+            model_dtype = str(compute_dtype(quantization_mode)).replace("torch.", "")
+            logger.info(f"✅ Квантовано {layers} линейных слоев за {time.time() - quantization_start:.1f} сек")
+        
+        # 5. KV кэш постоянного начала промпта (с image_first начало -
+        # несколько токенов разметки, кэш не стоит проверки при старте)
+        if for_serving and PREFIX_CACHE_ENABLED and PROMPT_LAYOUT == PROMPT_LAYOUT_TEXT_FIRST:
+            prefix_cache = build_prefix_cache()
+        
+        adapter_version = compute_adapter_version()
+        logger.info(f"🏷️  Версия адаптеров: {adapter_version}")
+        
         model_load_time = time.time() - start_time
         
         logger.info("=" * 60)
         logger.info(f"✅ Модель успешно инициализирована за {model_load_time:.2f} сек")
         logger.info("=" * 60)
         
+        model_memory = model_memory_bytes(model)
+        logger.info(f"💾 Веса модели: {model_memory / (1024**3):.2f} GB")
+        if for_serving and LATENCY_PROBE_TOKENS > 0:
+            forward_latency = measure_forward_latency(model, LATENCY_PROBE_TOKENS)
+            logger.info(
+                f"⏱️  Прямой проход по {LATENCY_PROBE_TOKENS} токенам: {forward_latency['forward_ms']} мс"
+            )
+        
         # Логируем использование памяти
         if torch.cuda.is_available():
             memory_allocated = torch.cuda.memory_allocated() / (1024**3)
@@ -155,17 +635,21 @@ async def lifespan(app: FastAPI):
     """Управление жизненным циклом приложения"""
     # Startup
     logger.info("🔄 Запуск сервиса...")
+    configure_tracing("vlm")
     load_model_and_processor()
+    await start_inference()
     logger.info("✅ Сервис готов к работе")
     
     yield
     
     # Shutdown
     logger.info("🛑 Остановка сервиса...")
+    await stop_inference()
     logger.info(f"📊 Всего обработано запросов: {inference_count}")
     if inference_count > 0:
         avg_time = total_inference_time / inference_count
         logger.info(f"⏱️  Среднее время инференса: {avg_time:.2f} сек")
+    shutdown_tracing()
 
 
 # Создание FastAPI приложения
@@ -176,18 +660,49 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# Span на каждый запрос (контекст приходит от Backend в заголовке traceparent)
+app.add_middleware(TraceMiddleware)
+
+
+def process_rss_bytes() -> int:
+    """Резидентная память процесса (веса, активации, KV кэш)"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Вне Linux - пиковое значение (на macOS в байтах, иначе в килобайтах)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
 
 @app.get("/health")
 async def health_check():
     """
     Проверка здоровья сервиса
     """
+    if model is None:
+        status = "initializing"
+    elif draining:
+        status = "draining"
+    else:
+        status = "healthy"
     return {
-        "status": "healthy" if model is not None else "initializing",
+        "status": status,
         "model_loaded": model is not None,
         "processor_loaded": processor is not None,
         "device": DEVICE,
-        "model_load_time": model_load_time
+        "model_load_time": model_load_time,
+        "queue_depth": waiting_requests(),
+        "inference_busy": inference_worker.busy,
+        "quantization": quantization,
+        "torch_dtype": model_dtype,
+        "model_memory_gb": round(model_memory / (1024**3), 2) if model_memory else None,
+        "process_rss_gb": round(process_rss_bytes() / (1024**3), 2),
+        "forward_latency": forward_latency,
+        "avg_inference_time": round(total_inference_time / inference_count, 2) if inference_count else None
     }
 
 
@@ -205,6 +720,12 @@ async def get_metrics():
         "total_inference_time": round(total_inference_time, 2),
         "avg_inference_time": round(avg_inference_time, 2),
         "model_load_time": round(model_load_time, 2) if model_load_time else None,
+        "cancelled_generations": cancelled_generations,
+        "queue_depth": waiting_requests(),
+        "inference_worker": inference_worker.stats(),
+        "quality": quality_policy.stats(),
+        "batching": batch_scheduler.stats() if batch_scheduler else None,
+        "prefix_cache": prefix_cache.stats() if prefix_cache else None,
     }
     
     # Добавляем метрики GPU если доступно
@@ -219,132 +740,565 @@ async def get_metrics():
     return metrics
 
 
-@app.post("/infer")
-async def infer(file: UploadFile = File(...)):
+@app.get("/metrics/prometheus")
+async def get_prometheus_metrics():
     """
-    Выполняет инференс модели на загруженном изображении
-    
-    Args:
-        file: Изображение диаграммы (PNG, JPG, JPEG)
-    
-    Returns:
-        JSON с описанием алгоритма
+    Гистограммы длительности этапов инференса в формате Prometheus
     """
-    global inference_count, total_inference_time
-    
+    QUEUE_DEPTH.set(waiting_requests())
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/model_info")
+async def model_info():
+    """
+    Информация о модели, адаптерах и параметрах генерации
+    """
+    if model is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Модель еще не загружена, попробуйте позже"
+        )
+    return get_model_info()
+
+
+def check_model_ready():
+    """Проверяет, что модель загружена"""
     if model is None or processor is None:
         logger.error("❌ Модель не загружена")
         raise HTTPException(
             status_code=503,
             detail="Модель еще не загружена, попробуйте позже"
         )
-    
-    # Валидация типа файла
+
+
+def check_image_content_type(file: UploadFile):
+    """Проверяет, что загружено изображение"""
     if not file.content_type.startswith("image/"):
         logger.warning(f"⚠️  Неверный тип файла: {file.content_type}")
         raise HTTPException(
             status_code=400,
             detail=f"Ожидается изображение, получено: {file.content_type}"
         )
+
+
+def get_blob_path(blob_hash: str) -> str:
+    """
+    Путь к файлу в общем хранилище
     
-    logger.info("=" * 60)
-    logger.info(f"📥 Получен запрос на инференс")
+    Raises:
+        HTTPException: 404 если хранилище не настроено или файла нет,
+            400 при некорректном хэше
+    """
+    if not BLOB_STORE_PATH:
+        raise HTTPException(status_code=404, detail="Общее хранилище файлов не настроено")
+    if len(blob_hash) != 64 or not set(blob_hash) <= set("0123456789abcdef"):
+        raise HTTPException(status_code=400, detail="Некорректный хэш файла")
+    path = os.path.join(BLOB_STORE_PATH, blob_hash[:2], blob_hash)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Файл не найден в хранилище")
+    return path
+
+
+def resolve_image_source(
+    file: Optional[UploadFile],
+    blob_hash: Optional[str]
+) -> Union[UploadFile, str]:
+    """
+    Проверяет источник изображения запроса: загруженный файл или хэш
+    файла в общем хранилище
+    
+    Returns:
+        Загруженный файл или путь к файлу в хранилище
+    """
+    if blob_hash:
+        path = get_blob_path(blob_hash)
+        logger.info(f"📄 Файл из хранилища: {blob_hash[:16]}...")
+        return path
+    if file is None:
+        raise HTTPException(
+            status_code=400,
+            detail="Нужно передать файл (file) или хэш файла в хранилище (blob_hash)"
+        )
+    check_image_content_type(file)
     logger.info(f"📄 Файл: {file.filename}")
     logger.info(f"📦 Тип: {file.content_type}")
+    return file
+
+
+def read_blob_image(path: str) -> Image.Image:
+    """Читает изображение из хранилища через mmap, без копии файла в памяти процесса"""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with Image.open(mapped) as image:
+            return image.convert("RGB")
+
+
+def decode_image(contents: bytes) -> Image.Image:
+    """Декодирует изображение из содержимого файла"""
+    return Image.open(BytesIO(contents)).convert("RGB")
+
+
+async def load_image(source: Union[UploadFile, str, bytes]) -> Image.Image:
+    """
+    Декодирует изображение из источника, полученного от resolve_image_source,
+    или из содержимого файла (при вызове в том же процессе)
     
-    try:
-        # Чтение и обработка изображения
-        start_time = time.time()
-        
-        contents = await file.read()
-        image = Image.open(BytesIO(contents)).convert("RGB")
-        
-        logger.info(f"🖼️  Размер изображения: {image.size}")
-        
-        # Подготовка сообщений для модели
-        messages = [{
-            "role": "user",
-            "content": [
-                {"type": "image", "image": image},
-                {"type": "text", "text": SYSTEM_PROMPT}
-            ]
-        }]
-        
-        # Применение chat template
-        text_input = processor.apply_chat_template(
+    Декодирование выполняется в пуле потоков, чтобы не блокировать event loop.
+    """
+    if isinstance(source, str):
+        return await asyncio.to_thread(read_blob_image, source)
+    if isinstance(source, bytes):
+        return await asyncio.to_thread(decode_image, source)
+    contents = await source.read()
+    return await asyncio.to_thread(decode_image, contents)
+
+
+def prepare_inputs(images: List[Image.Image], max_pixels: int) -> tuple:
+    """
+    Готовит входные тензоры модели для изображений диаграмм (строка батча
+    на изображение)
+    
+    Args:
+        max_pixels: Бюджет изображения - больше изображение уменьшается
+    
+    Returns:
+        Кортеж (входные данные модели, устройство)
+    """
+    # Подготовка сообщений для модели
+    conversations = []
+    for image in images:
+        content = [
+            {
+                "type": "image",
+                "image": image,
+                "min_pixels": min(IMAGE_MIN_TOKENS * PIXELS_PER_TOKEN, max_pixels),
+                "max_pixels": max_pixels
+            },
+            {"type": "text", "text": SYSTEM_PROMPT}
+        ]
+        if PROMPT_LAYOUT == PROMPT_LAYOUT_TEXT_FIRST:
+            # Постоянный текст перед изображением попадает в KV кэш начала
+            content.reverse()
+        conversations.append([{"role": "user", "content": content}])
+    
+    # Применение chat template
+    text_inputs = [
+        processor.apply_chat_template(
             messages,
             tokenize=False,
             add_generation_prompt=True
         )
-        
-        # Обработка vision inputs
-        image_inputs, video_inputs = process_vision_info(messages)
-        
-        # Подготовка входных данных
-        inputs = processor(
-            text=[text_input],
-            images=image_inputs,
-            videos=video_inputs,
-            padding=True,
-            return_tensors="pt"
+        for messages in conversations
+    ]
+    
+    # Обработка vision inputs
+    image_inputs, video_inputs = process_vision_info(conversations)
+    
+    # Подготовка входных данных (короткие промпты дополняются слева)
+    inputs = processor(
+        text=text_inputs,
+        images=image_inputs,
+        videos=video_inputs,
+        padding=True,
+        return_tensors="pt"
+    )
+    
+    # Перемещаем на нужное устройство
+    device = next(model.parameters()).device
+    inputs = {k: v.to(device) if isinstance(v, torch.Tensor) else v 
+              for k, v in inputs.items()}
+    return inputs, device
+
+
+def build_metadata(
+    total_time: float,
+    generation_time: float,
+    image: Image.Image,
+    device: torch.device,
+    quality: QualitySettings,
+    batch_size: int = 1,
+    cached_tokens: int = 0
+) -> dict:
+    """Метаданные ответа инференса (с бюджетами, выбранными для запроса)"""
+    return {
+        "inference_time": round(total_time, 2),
+        "generation_time": round(generation_time, 2),
+        "image_size": list(image.size),
+        "device": str(device),
+        "batch_size": batch_size,
+        "prefix_cached_tokens": cached_tokens,
+        **get_model_info(),
+        **quality.as_metadata()
+    }
+
+
+def waiting_requests() -> int:
+    """Запросы, ожидающие модель: задачи потока инференса и очередь батчинга"""
+    waiting = inference_worker.pending
+    if batch_scheduler is not None:
+        waiting += batch_scheduler.pending
+    return waiting
+
+
+def check_queue_capacity():
+    """
+    Проверяет, что запрос можно поставить в очередь к модели
+    
+    Raises:
+        HTTPException: 503 с Retry-After, если сервис останавливается или
+            очередь заполнена
+    """
+    if draining:
+        raise HTTPException(
+            status_code=503,
+            detail="Сервис останавливается",
+            headers={"Retry-After": "1"}
         )
+    waiting = waiting_requests()
+    if waiting >= INFERENCE_QUEUE_SIZE:
+        REJECTED_REQUESTS.inc()
+        logger.warning(f"⚠️  Очередь к модели заполнена: {waiting}")
+        raise HTTPException(
+            status_code=503,
+            detail=f"Очередь к модели заполнена ({waiting}), попробуйте позже",
+            headers={"Retry-After": "1"}
+        )
+
+
+def select_quality(waiting: int) -> QualitySettings:
+    """Бюджеты изображения и генерации для запроса с учетом очереди"""
+    quality = quality_policy.select(waiting)
+    if quality.degraded:
+        DEGRADED_REQUESTS.inc()
+        logger.info(
+            f"📉 В очереди {waiting}: max_pixels={quality.max_pixels}, "
+            f"max_new_tokens={quality.max_new_tokens}"
+        )
+    return quality
+
+
+def generate_descriptions(
+    images: List[Image.Image],
+    controls: List[GenerationControl],
+    submitted_at: float,
+    streamer=None
+) -> tuple:
+    """
+    Подготовка входов, генерация и декодирование для изображений
+    (выполняется в потоке инференса)
+    
+    Запросы, прерванные, пока ждали очереди, пропускаются. Бюджеты
+    выбираются по очереди на момент начала генерации. Если задан
+    streamer, токены отдаются в него по мере генерации.
+    
+    Returns:
+        Кортеж (тексты по изображениям - None для прерванных запросов,
+        время генерации, устройство, бюджеты, размер батча, токены
+        промпта строки из KV кэша начала)
+    """
+    observe_stage(STAGE_QUEUE_WAIT, "success", time.perf_counter() - submitted_at)
+    
+    active = []
+    for index, control in enumerate(controls):
+        if control.expired():
+            record_cancellation(control.reason, STAGE_QUEUE_WAIT)
+        else:
+            active.append(index)
+    texts: List[Optional[str]] = [None] * len(images)
+    
+    if not active:
+        if streamer is not None:
+            streamer.end()
+        return texts, 0.0, None, None, 0, 0
+    
+    quality = select_quality(waiting_requests())
+    
+    try:
+        preprocessing_start = time.perf_counter()
+        inputs, device = prepare_inputs([images[i] for i in active], quality.max_pixels)
+        observe_stage(STAGE_PREPROCESSING, "success", time.perf_counter() - preprocessing_start)
         
-        # Перемещаем на нужное устройство
-        device = next(model.parameters()).device
-        inputs = {k: v.to(device) if isinstance(v, torch.Tensor) else v 
-                  for k, v in inputs.items()}
-        
-        logger.info("⏳ Запуск генерации...")
+        logger.info(f"⏳ Запуск генерации для {len(active)} изображений...")
         generation_start = time.time()
+        timer = TokenTimer()
+        active_controls = [controls[i] for i in active]
         
-        # Генерация
-        with torch.inference_mode():
-            generated_ids = model.generate(
-                **inputs,
-                max_new_tokens=MAX_NEW_TOKENS,
-                do_sample=False
-            )
+        try:
+            with torch.inference_mode():
+                # Начало промпта берется из кэша, generate продолжает с
+                # кэша всего промпта (изображение уже обработано)
+                past_key_values = prefix_cache.prefill(inputs) if prefix_cache else None
+                if past_key_values is not None:
+                    cached_tokens = prefix_cache.length
+                    PREFIX_CACHE_TOKENS.inc(cached_tokens * len(active))
+                    generation_inputs = {
+                        "input_ids": inputs["input_ids"],
+                        "attention_mask": inputs["attention_mask"],
+                        "past_key_values": past_key_values
+                    }
+                else:
+                    cached_tokens = 0
+                    generation_inputs = inputs
+                generated_ids = model.generate(
+                    **generation_inputs,
+                    max_new_tokens=quality.max_new_tokens,
+                    do_sample=False,
+                    streamer=streamer,
+                    stopping_criteria=StoppingCriteriaList([timer, BatchControl(active_controls)])
+                )
+        except Exception:
+            timer.observe("error")
+            raise
+    except Exception:
+        if streamer is not None:
+            # Завершаем поток токенов, чтобы читатель не ждал вечно
+            streamer.end()
+        raise
+    
+    timer.observe(
+        "success" if any(control.reason is None for control in active_controls) else "cancelled"
+    )
+    generation_time = time.time() - generation_start
+    logger.info(f"✅ Генерация завершена за {generation_time:.2f} сек")
+    
+    # Входы выровнены паддингом слева: ответы начинаются после общей длины входа
+    input_length = inputs["input_ids"].shape[1]
+    output_texts = processor.batch_decode(
+        generated_ids[:, input_length:],
+        skip_special_tokens=True,
+        clean_up_tokenization_spaces=False
+    )
+    
+    for index, output_text in zip(active, output_texts):
+        control = controls[index]
+        if control.reason is not None:
+            record_cancellation(control.reason, STAGE_GENERATION)
+        else:
+            texts[index] = output_text
+    
+    return texts, generation_time, device, quality, len(active), cached_tokens
+
+
+def submit_generation(
+    images: List[Image.Image],
+    controls: List[GenerationControl],
+    streamer=None
+) -> asyncio.Future:
+    """
+    Ставит генерацию в очередь потока инференса
+    
+    Raises:
+        HTTPException: 503, если очередь заполнена или сервис останавливается
+    """
+    try:
+        return inference_worker.submit(
+            generate_descriptions, images, controls, time.perf_counter(), streamer
+        )
+    except WorkerBusy as e:
+        REJECTED_REQUESTS.inc()
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+
+async def wait_for_generation(future: asyncio.Future, request: Optional[Request], control: GenerationControl):
+    """
+    Ждет результат из потока инференса, пока ждет - проверяет, не закрыл
+    ли клиент соединение (без HTTP запроса - прерывание только по дедлайну)
+    """
+    try:
+        while True:
+            done, _ = await asyncio.wait([future], timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return future.result()
+            if request is not None and control.reason is None and await request.is_disconnected():
+                # Генерация остановится на следующем токене
+                control.cancel(CANCEL_DISCONNECT)
+    except asyncio.CancelledError:
+        control.cancel(CANCEL_DISCONNECT)
+        raise
+
+
+async def generate_single(image: Image.Image, request: Optional[Request], deadline: Optional[float]) -> tuple:
+    """
+    Генерация для одного изображения (без батчинга)
+    
+    Returns:
+        Кортеж (текст, время генерации, устройство, бюджеты, размер батча,
+        токены промпта из KV кэша начала)
+    """
+    control = GenerationControl(deadline)
+    texts, generation_time, device, quality, batch_size, cached_tokens = await wait_for_generation(
+        submit_generation([image], [control]), request, control
+    )
+    if texts[0] is None:
+        raise GenerationCancelled(control.reason)
+    return texts[0], generation_time, device, quality, batch_size, cached_tokens
+
+
+async def generate_batched(image: Image.Image, request: Optional[Request], deadline: Optional[float]) -> tuple:
+    """
+    Ставит изображение в очередь батчинга и ждет свою строку результата,
+    пока ждет - следит за клиентом
+    
+    Returns:
+        Кортеж (текст, время генерации, устройство, бюджеты, размер батча,
+        токены промпта из KV кэша начала)
+    """
+    control = GenerationControl(deadline)
+    return await wait_for_generation(batch_scheduler.submit((image, control)), request, control)
+
+
+async def run_batch(entries: List[BatchEntry]):
+    """
+    Один вызов generate для батча изображений; результат каждой строки
+    передается ее запросу
+    """
+    for entry in entries:
+        BATCH_WAIT_SECONDS.observe(time.perf_counter() - entry.enqueued_at)
+    images = [entry.payload[0] for entry in entries]
+    controls = [entry.payload[1] for entry in entries]
+    
+    texts, generation_time, device, quality, batch_size, cached_tokens = await submit_generation(images, controls)
+    if batch_size:
+        BATCH_SIZE.observe(batch_size)
+    
+    for entry, control, output_text in zip(entries, controls, texts):
+        if output_text is None:
+            entry.set_exception(GenerationCancelled(control.reason))
+        else:
+            entry.set_result((output_text, generation_time, device, quality, batch_size, cached_tokens))
+
+
+async def start_inference():
+    """Запускает поток инференса и сборщик батчей /infer (при BATCH_MAX_SIZE > 1)"""
+    global batch_scheduler, draining
+    
+    draining = False
+    inference_worker.start()
+    logger.info(f"🧵 Поток инференса запущен, очередь до {INFERENCE_QUEUE_SIZE} запросов")
+    
+    if BATCH_MAX_SIZE > 1 and batch_scheduler is None:
+        batch_scheduler = BatchScheduler(run_batch, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS / 1000)
+        await batch_scheduler.start()
+        logger.info(f"📦 Батчинг /infer: до {BATCH_MAX_SIZE} запросов, окно {BATCH_MAX_WAIT_MS:.0f} мс")
+
+
+async def stop_inference():
+    """
+    Перестает принимать запросы и дожидается уже принятых (не дольше
+    INFERENCE_DRAIN_TIMEOUT), затем останавливает поток инференса
+    """
+    global batch_scheduler, draining
+    
+    draining = True
+    deadline = time.monotonic() + INFERENCE_DRAIN_TIMEOUT
+    logger.info(f"⏳ Завершение принятых запросов: ожидают {waiting_requests()}")
+    
+    if batch_scheduler is not None:
+        while not batch_scheduler.idle and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        await batch_scheduler.stop()
+        batch_scheduler = None
+    
+    await inference_worker.drain(max(0.0, deadline - time.monotonic()))
+    logger.info("🧵 Поток инференса остановлен")
+
+
+@app.post("/infer")
+async def infer(
+    request: Request,
+    file: Optional[UploadFile] = File(None),
+    blob_hash: Optional[str] = Form(None)
+):
+    """
+    Выполняет инференс модели на загруженном изображении
+    
+    Генерация прерывается, если истек дедлайн из заголовка
+    X-Request-Timeout-Ms или клиент закрыл соединение.
+    
+    Args:
+        file: Изображение диаграммы (PNG, JPG, JPEG)
+        blob_hash: SHA256 изображения в общем хранилище (вместо file)
+    
+    Returns:
+        JSON с описанием алгоритма
+    """
+    check_model_ready()
+    
+    logger.info("=" * 60)
+    logger.info(f"📥 Получен запрос на инференс")
+    check_queue_capacity()
+    deadline = get_request_deadline(request)
+    source = resolve_image_source(file, blob_hash)
+    
+    return JSONResponse(content=await run_inference(source, request, deadline))
+
+
+async def run_inference(
+    source: Union[UploadFile, str, bytes],
+    request: Optional[Request],
+    deadline: Optional[float]
+) -> dict:
+    """
+    Распознает изображение: очередь к модели, подготовка входов, генерация
+    и декодирование
+    
+    Args:
+        source: Загруженный файл, путь в хранилище или содержимое изображения
+        request: HTTP запрос для проверки отключения клиента (None - вызов
+            в том же процессе, прерывание только по дедлайну)
+        deadline: Момент (time.monotonic()), после которого генерация прерывается
+    
+    Returns:
+        {"description": ..., "metadata": ...}
+    """
+    global inference_count, total_inference_time
+    
+    try:
+        # Чтение и обработка изображения
+        start_time = time.time()
         
-        generation_time = time.time() - generation_start
-        logger.info(f"✅ Генерация завершена за {generation_time:.2f} сек")
+        image = await load_image(source)
         
-        # Декодирование результата
-        generated_ids_trimmed = [
-            out_ids[len(in_ids):] 
-            for in_ids, out_ids in zip(inputs["input_ids"], generated_ids)
-        ]
+        logger.info(f"🖼️  Размер изображения: {image.size}")
         
-        output_text = processor.batch_decode(
-            generated_ids_trimmed,
-            skip_special_tokens=True,
-            clean_up_tokenization_spaces=False
-        )[0]
+        # Одновременные запросы объединяются в батч (если батчинг включен)
+        if batch_scheduler is not None:
+            output_text, generation_time, device, quality, batch_size, cached_tokens = await generate_batched(
+                image, request, deadline
+            )
+        else:
+            output_text, generation_time, device, quality, batch_size, cached_tokens = await generate_single(
+                image, request, deadline
+            )
         
         total_time = time.time() - start_time
         
         # Обновление метрик
         inference_count += 1
         total_inference_time += total_time
+        observe_stage(STAGE_TOTAL, "success", total_time)
         
         logger.info(f"✅ Инференс завершен успешно")
         logger.info(f"⏱️  Общее время: {total_time:.2f} сек")
         logger.info(f"📊 Длина ответа: {len(output_text)} символов")
         logger.info("=" * 60)
         
-        return JSONResponse(
-            content={
-                "description": output_text,
-                "metadata": {
-                    "inference_time": round(total_time, 2),
-                    "generation_time": round(generation_time, 2),
-                    "image_size": list(image.size),
-                    "model": BASE_MODEL_ID,
-                    "device": str(device)
-                }
-            }
-        )
+        return {
+            "description": output_text,
+            "metadata": build_metadata(
+                total_time, generation_time, image, device, quality, batch_size, cached_tokens
+            )
+        }
         
+    except GenerationCancelled as e:
+        observe_stage(STAGE_TOTAL, "cancelled", time.time() - start_time)
+        raise cancelled_error(e)
+    except HTTPException:
+        # Очередь к модели заполнена или сервис останавливается
+        observe_stage(STAGE_TOTAL, "error", time.time() - start_time)
+        raise
     except Exception as e:
+        observe_stage(STAGE_TOTAL, "error", time.time() - start_time)
         logger.error("=" * 60)
         logger.error(f"❌ Ошибка при инференсе: {e}")
         logger.error("=" * 60)
@@ -354,6 +1308,134 @@ async def infer(file: UploadFile = File(...)):
         )
 
 
+@app.post("/infer/stream")
+async def infer_stream(
+    request: Request,
+    file: Optional[UploadFile] = File(None),
+    blob_hash: Optional[str] = Form(None)
+):
+    """
+    Потоковый инференс: текст отдается по мере генерации
+    
+    Генерация прерывается, если истек дедлайн из заголовка
+    X-Request-Timeout-Ms или клиент закрыл поток.
+    
+    Args:
+        file: Изображение диаграммы (PNG, JPG, JPEG)
+        blob_hash: SHA256 изображения в общем хранилище (вместо file)
+    
+    Returns:
+        NDJSON поток: {"type": "token", "text": ...} для каждого фрагмента,
+        затем {"type": "done", "description": ..., "metadata": ...}
+        или {"type": "error", "status_code": ..., "detail": ...}
+    """
+    check_model_ready()
+    
+    logger.info("=" * 60)
+    logger.info(f"📥 Получен запрос на потоковый инференс")
+    check_queue_capacity()
+    deadline = get_request_deadline(request)
+    source = resolve_image_source(file, blob_hash)
+    
+    start_time = time.time()
+    try:
+        image = await load_image(source)
+    except Exception as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Ошибка при обработке изображения: {str(e)}"
+        )
+    
+    logger.info(f"🖼️  Размер изображения: {image.size}")
+    
+    async def token_stream():
+        global inference_count, total_inference_time
+        
+        try:
+            # Отключение клиента от потока видно только при отправке токена
+            control = GenerationControl(deadline)
+            streamer = AsyncTextIteratorStreamer(
+                processor.tokenizer,
+                skip_prompt=True,
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=False
+            )
+            
+            logger.info("⏳ Постановка потоковой генерации в очередь...")
+            future = submit_generation([image], [control], streamer)
+            
+            output_text = ""
+            time_to_first_token = None
+            try:
+                async for text in streamer:
+                    if not text:
+                        continue
+                    if time_to_first_token is None:
+                        time_to_first_token = time.time() - start_time
+                        logger.info(f"⚡ Первый токен через {time_to_first_token:.2f} сек")
+                    output_text += text
+                    yield json.dumps({"type": "token", "text": text}, ensure_ascii=False) + "\n"
+            except (asyncio.CancelledError, GeneratorExit):
+                # Клиент закрыл поток - дальше генерировать незачем
+                control.cancel(CANCEL_DISCONNECT)
+                observe_stage(STAGE_TOTAL, "cancelled", time.time() - start_time)
+                raise
+            
+            # Поток токенов закончился - результат генерации уже готов или вот-вот будет
+            texts, generation_time, device, quality, _, cached_tokens = await future
+            if texts[0] is None:
+                raise GenerationCancelled(control.reason)
+            
+            total_time = time.time() - start_time
+            inference_count += 1
+            total_inference_time += total_time
+            observe_stage(STAGE_TOTAL, "success", total_time)
+            
+            logger.info(f"✅ Потоковый инференс завершен за {total_time:.2f} сек")
+            logger.info("=" * 60)
+            
+            metadata = build_metadata(
+                total_time, generation_time, image, device, quality, cached_tokens=cached_tokens
+            )
+            metadata["time_to_first_token"] = (
+                round(time_to_first_token, 2) if time_to_first_token is not None else None
+            )
+            yield json.dumps({
+                "type": "done",
+                "description": output_text,
+                "metadata": metadata
+            }, ensure_ascii=False) + "\n"
+            
+        except GenerationCancelled as e:
+            observe_stage(STAGE_TOTAL, "cancelled", time.time() - start_time)
+            error = cancelled_error(e)
+            yield json.dumps({
+                "type": "error",
+                "status_code": error.status_code,
+                "detail": error.detail
+            }, ensure_ascii=False) + "\n"
+        except HTTPException as he:
+            # Очередь к модели заполнилась после начала ответа
+            observe_stage(STAGE_TOTAL, "error", time.time() - start_time)
+            yield json.dumps({
+                "type": "error",
+                "status_code": he.status_code,
+                "detail": he.detail
+            }, ensure_ascii=False) + "\n"
+        except Exception as e:
+            observe_stage(STAGE_TOTAL, "error", time.time() - start_time)
+            logger.error("=" * 60)
+            logger.error(f"❌ Ошибка при потоковом инференсе: {e}")
+            logger.error("=" * 60)
+            yield json.dumps({
+                "type": "error",
+                "status_code": 500,
+                "detail": f"Ошибка при обработке изображения: {str(e)}"
+            }, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(token_stream(), media_type="application/x-ndjson")
+
+
 @app.get("/")
 async def root():
     """Корневой эндпоинт с информацией о сервисе"""
@@ -365,7 +1447,10 @@ async def root():
         "endpoints": {
             "health": "/health",
             "metrics": "/metrics",
+            "metrics_prometheus": "/metrics/prometheus",
+            "model_info": "/model_info",
             "infer": "/infer (POST)",
+            "infer_stream": "/infer/stream (POST, NDJSON)",
             "docs": "/docs"
         }
     }
@@ -0,0 +1,153 @@
+"""
+KV кэш постоянного начала промпта
+Начало промпта до первого изображения (разметка chat template, а при
+PROMPT_LAYOUT=text_first и текст SYSTEM_PROMPT) одинаково у всех
+запросов. Его KV состояние считается один раз при старте. Для запроса
+копия кэша дополняется только переменной частью (изображение и остаток
+промпта), и generate продолжает с готового кэша.
+
+Позиции M-RoPE считаются по всему промпту, поэтому ключи и значения
+совпадают с обычным prefill. Последний токен промпта обрабатывает
+generate: его шаги берут позиции из rope_deltas, как при декодировании.
+"""
+
+import copy
+import logging
+from typing import Any, Dict, Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Допустимое расхождение log-вероятностей следующего токена при проверке
+VERIFY_TOLERANCE = 0.05
+
+
+class PrefixCache:
+    """KV состояние начала промпта и статистика его использования"""
+
+    def __init__(self, model: torch.nn.Module, prefix_ids: torch.Tensor):
+        """
+        Args:
+            model: Qwen-VL без PEFT обертки (подключенные LoRA слои
+                работают и при вызове базовой модели)
+            prefix_ids: Токены постоянного начала промпта, форма (1, P)
+        """
+        self.model = model
+        self.prefix_ids = prefix_ids
+        with torch.inference_mode():
+            outputs = model(
+                input_ids=prefix_ids,
+                attention_mask=torch.ones_like(prefix_ids),
+                use_cache=True,
+                logits_to_keep=1
+            )
+        self.cache = outputs.past_key_values
+
+        # Метрики
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+
+    @property
+    def length(self) -> int:
+        return self.prefix_ids.shape[1]
+
+    def matches(self, inputs: Dict[str, Any]) -> bool:
+        """Все строки батча начинаются с постоянной части без паддинга"""
+        input_ids = inputs["input_ids"]
+        if input_ids.shape[1] <= self.length:
+            return False
+        # Паддинг слева сдвигает начало промпта у коротких строк батча
+        if not bool(inputs["attention_mask"].all()):
+            return False
+        return bool((input_ids[:, :self.length] == self.prefix_ids).all())
+
+    def prefill(self, inputs: Dict[str, Any]) -> Optional[Any]:
+        """
+        Prefill переменной части промпта поверх копии кэша начала
+
+        Returns:
+            Кэш всех токенов промпта, кроме последнего (передается в
+            generate как past_key_values), или None, если промпт не
+            начинается с постоянной части
+        """
+        if not self.matches(inputs):
+            self.misses += 1
+            return None
+
+        input_ids = inputs["input_ids"]
+        attention_mask = inputs["attention_mask"]
+        batch_size, length = input_ids.shape
+        start, end = self.length, length - 1
+        language_model = self.model.model
+
+        position_ids, rope_deltas = language_model.get_rope_index(
+            input_ids,
+            image_grid_thw=inputs.get("image_grid_thw"),
+            video_grid_thw=inputs.get("video_grid_thw"),
+            attention_mask=attention_mask
+        )
+
+        cache = copy.deepcopy(self.cache)
+        if batch_size > 1:
+            cache.batch_repeat_interleave(batch_size)
+
+        # Все токены изображения после начала промпта, поэтому пиксели
+        # обрабатываются здесь целиком; логиты переменной части не нужны
+        self.model(
+            input_ids=input_ids[:, start:end],
+            attention_mask=attention_mask[:, :end],
+            position_ids=position_ids[..., start:end],
+            pixel_values=inputs.get("pixel_values"),
+            image_grid_thw=inputs.get("image_grid_thw"),
+            past_key_values=cache,
+            cache_position=torch.arange(start, end, device=input_ids.device),
+            use_cache=True,
+            logits_to_keep=1
+        )
+        # Шаги generate вычисляют позиции от смещения rope_deltas
+        language_model.rope_deltas = rope_deltas
+
+        self.hits += 1
+        self.tokens_saved += self.length * batch_size
+        return cache
+
+    @torch.inference_mode()
+    def verify(self, inputs: Dict[str, Any]) -> bool:
+        """
+        Сравнивает распределение следующего токена после промпта с кэшем
+        начала и после обычного prefill (выполняется один раз при старте)
+        """
+        language_model = self.model.model
+        language_model.rope_deltas = None
+        expected = self.model(**inputs, logits_to_keep=1).logits[:, -1].float()
+
+        hits, tokens_saved = self.hits, self.tokens_saved
+        cache = self.prefill(inputs)
+        self.hits, self.tokens_saved = hits, tokens_saved
+        if cache is None:
+            return False
+
+        length = inputs["input_ids"].shape[1]
+        actual = self.model(
+            input_ids=inputs["input_ids"][:, -1:],
+            attention_mask=inputs["attention_mask"],
+            past_key_values=cache,
+            cache_position=torch.tensor([length - 1], device=inputs["input_ids"].device),
+            use_cache=True
+        ).logits[:, -1].float()
+
+        difference = (expected.log_softmax(-1) - actual.log_softmax(-1)).abs().max().item()
+        same_token = bool((expected.argmax(-1) == actual.argmax(-1)).all())
+        logger.info(f"🔍 Проверка KV кэша начала промпта: расхождение {difference:.4f}")
+        return same_token and difference <= VERIFY_TOLERANCE
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики кэша"""
+        return {
+            "prefix_tokens": self.length,
+            "hits": self.hits,
+            "misses": self.misses,
+            "tokens_saved": self.tokens_saved
+        }
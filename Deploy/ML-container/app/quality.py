@@ -0,0 +1,110 @@
+"""
+Снижение качества инференса под нагрузкой
+Чем больше запросов ждет модель, тем меньше бюджет токенов изображения
+(max_pixels) и лимит генерации (max_new_tokens), но не ниже заданных
+минимумов. Когда очередь уменьшается, значения возвращаются к исходным.
+"""
+
+from typing import Any, Dict
+
+# Один токен изображения Qwen-VL соответствует фрагменту 28x28 пикселей
+PIXELS_PER_TOKEN = 28 * 28
+
+
+class QualitySettings:
+    """Параметры инференса, выбранные для одного запроса"""
+
+    def __init__(self, max_pixels: int, max_new_tokens: int, level: float, queue_depth: int):
+        self.max_pixels = max_pixels
+        self.max_new_tokens = max_new_tokens
+        # 1 - полное качество, 0 - минимумы
+        self.level = level
+        self.queue_depth = queue_depth
+
+    @property
+    def degraded(self) -> bool:
+        return self.level < 1
+
+    def as_metadata(self) -> Dict[str, Any]:
+        """Поля метаданных ответа"""
+        return {
+            "effective_max_tokens": self.max_new_tokens,
+            "effective_max_pixels": self.max_pixels,
+            "quality_level": round(self.level, 2),
+            "degraded": self.degraded,
+            "queue_depth": self.queue_depth
+        }
+
+
+class QualityPolicy:
+    """
+    Выбор бюджета изображения и генерации по глубине очереди к модели
+
+    До queue_low ожидающих запросов используются полные значения, от
+    queue_high - минимумы, между ними значения уменьшаются линейно.
+    """
+
+    def __init__(
+        self,
+        max_image_tokens: int,
+        image_tokens_floor: int,
+        max_new_tokens: int,
+        max_new_tokens_floor: int,
+        queue_low: int,
+        queue_high: int,
+        enabled: bool = True
+    ):
+        self.max_image_tokens = max_image_tokens
+        self.image_tokens_floor = min(image_tokens_floor, max_image_tokens)
+        self.max_new_tokens = max_new_tokens
+        self.max_new_tokens_floor = min(max_new_tokens_floor, max_new_tokens)
+        self.queue_low = queue_low
+        self.queue_high = max(queue_high, queue_low + 1)
+        self.enabled = enabled
+
+        # Метрики
+        self.selected = 0
+        self.degraded = 0
+        self.last_level = 1.0
+
+    def level(self, queue_depth: int) -> float:
+        """Уровень качества для глубины очереди: 1 - полное, 0 - минимумы"""
+        if not self.enabled or queue_depth <= self.queue_low:
+            return 1.0
+        if queue_depth >= self.queue_high:
+            return 0.0
+        return 1 - (queue_depth - self.queue_low) / (self.queue_high - self.queue_low)
+
+    def select(self, queue_depth: int) -> QualitySettings:
+        """
+        Выбирает параметры для запроса, получившего модель
+
+        Args:
+            queue_depth: Сколько запросов еще ждет модель
+        """
+        level = self.level(queue_depth)
+        image_tokens = round(
+            self.image_tokens_floor + (self.max_image_tokens - self.image_tokens_floor) * level
+        )
+        new_tokens = round(
+            self.max_new_tokens_floor + (self.max_new_tokens - self.max_new_tokens_floor) * level
+        )
+
+        self.selected += 1
+        if level < 1:
+            self.degraded += 1
+        self.last_level = level
+        return QualitySettings(image_tokens * PIXELS_PER_TOKEN, new_tokens, level, queue_depth)
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики политики"""
+        return {
+            "enabled": self.enabled,
+            "requests": self.selected,
+            "degraded": self.degraded,
+            "last_level": round(self.last_level, 2),
+            "max_image_tokens": self.max_image_tokens,
+            "image_tokens_floor": self.image_tokens_floor,
+            "max_new_tokens": self.max_new_tokens,
+            "max_new_tokens_floor": self.max_new_tokens_floor
+        }
@@ -0,0 +1,149 @@
+"""
+Квантизация весов языковой модели для инференса на CPU
+Квантуются только линейные слои декодера (language_model), где
+сосредоточена основная часть вычислений генерации. Визуальный энкодер
+работает один раз на запрос и остается в исходном типе. lm_head связан с
+таблицей эмбеддингов, и его квантизация создала бы вторую копию матрицы.
+
+Режимы QUANTIZATION:
+    none - без квантизации
+    int8 - динамическая INT8 (torch.ao): веса int8, активации квантуются
+        на лету; модель работает в float32
+    int4 - 4-битные веса без квантизации активаций (пакет torchao);
+        модель работает в bfloat16
+"""
+
+import time
+from typing import Any, Dict
+
+import torch
+
+QUANTIZATION_NONE = "none"
+QUANTIZATION_INT8 = "int8"
+QUANTIZATION_INT4 = "int4"
+QUANTIZATION_MODES = (QUANTIZATION_NONE, QUANTIZATION_INT8, QUANTIZATION_INT4)
+
+# Тип, в котором работают неквантованные слои и активации
+COMPUTE_DTYPES = {
+    QUANTIZATION_INT8: torch.float32,
+    QUANTIZATION_INT4: torch.bfloat16
+}
+
+
+class QuantizationError(Exception):
+    """Квантизация недоступна или не применима к модели"""
+
+
+def compute_dtype(mode: str) -> torch.dtype:
+    """
+    Тип, в котором нужно загрузить модель для квантизации
+
+    Raises:
+        QuantizationError: неизвестный режим
+    """
+    if mode not in COMPUTE_DTYPES:
+        raise QuantizationError(
+            f"Неизвестный режим квантизации: {mode} (доступны {', '.join(QUANTIZATION_MODES)})"
+        )
+    return COMPUTE_DTYPES[mode]
+
+
+def language_model_of(model: torch.nn.Module) -> torch.nn.Module:
+    """Декодер Qwen-VL без визуального энкодера и lm_head"""
+    language_model = getattr(model, "language_model", None)
+    if language_model is None:
+        language_model = getattr(getattr(model, "model", None), "language_model", None)
+    if language_model is None:
+        raise QuantizationError(f"В модели {type(model).__name__} не найден language_model")
+    return language_model
+
+
+def quantize_model(model: torch.nn.Module, mode: str, int4_group_size: int = 128) -> int:
+    """
+    Квантует линейные слои декодера на месте
+
+    Модель должна быть без PEFT обертки (LoRA уже объединены с весами):
+    иначе квантовались бы и матрицы адаптеров. Перед квантизацией модель
+    приводится к типу compute_dtype(mode).
+
+    Returns:
+        Число квантованных линейных слоев
+
+    Raises:
+        QuantizationError: неизвестный режим или нет torchao для int4
+    """
+    dtype = compute_dtype(mode)
+    if next(model.parameters()).dtype != dtype:
+        model.to(dtype)
+
+    language_model = language_model_of(model)
+    layers = sum(1 for module in language_model.modules() if isinstance(module, torch.nn.Linear))
+
+    if mode == QUANTIZATION_INT8:
+        torch.ao.quantization.quantize_dynamic(
+            language_model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+    else:
+        try:
+            from torchao.dtypes import Int4CPULayout
+            from torchao.quantization import Int4WeightOnlyConfig, quantize_
+        except ImportError as e:
+            raise QuantizationError(f"Для QUANTIZATION=int4 нужен пакет torchao: {e}")
+        quantize_(language_model, Int4WeightOnlyConfig(group_size=int4_group_size, layout=Int4CPULayout()))
+
+    model.eval()
+    return layers
+
+
+def tensor_bytes(value: Any) -> int:
+    """Размер тензора в памяти (для квантованных - размер упакованных данных)"""
+    if isinstance(value, (tuple, list)):
+        return sum(tensor_bytes(item) for item in value)
+    if not isinstance(value, torch.Tensor):
+        return 0
+    if hasattr(value, "__tensor_flatten__"):
+        # Тензоры torchao хранят упакованные веса и масштабы во внутренних тензорах
+        names, _ = value.__tensor_flatten__()
+        return sum(tensor_bytes(getattr(value, name)) for name in names)
+    return value.numel() * value.element_size()
+
+
+def model_memory_bytes(model: torch.nn.Module) -> int:
+    """Память весов и буферов модели (связанные веса считаются один раз)"""
+    total = 0
+    seen = set()
+    for value in model.state_dict().values():
+        plain = (
+            isinstance(value, torch.Tensor)
+            and not value.is_quantized
+            and not hasattr(value, "__tensor_flatten__")
+        )
+        if plain:
+            if value.data_ptr() in seen:
+                continue
+            seen.add(value.data_ptr())
+        total += tensor_bytes(value)
+    return total
+
+
+@torch.no_grad()
+def measure_forward_latency(model: torch.nn.Module, tokens: int, runs: int = 3) -> Dict[str, float]:
+    """
+    Время прямого прохода по tokens текстовым токенам (без изображения)
+
+    Первый проход прогревочный и не учитывается. Сравнимо между режимами
+    квантизации на одном хосте; время prefill запроса с изображением больше.
+    """
+    device = next(model.parameters()).device
+    input_ids = torch.ones((1, tokens), dtype=torch.long, device=device)
+    model(input_ids=input_ids)
+
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        model(input_ids=input_ids)
+        timings.append(time.perf_counter() - start)
+    return {
+        "tokens": tokens,
+        "forward_ms": round(min(timings) * 1000, 1)
+    }
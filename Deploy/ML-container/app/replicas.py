@@ -0,0 +1,251 @@
+"""
+Процессы-реплики VLM сервиса на одном CPU хосте
+Каждая реплика - uvicorn с main:app на своем Unix сокете, привязанный к
+своему набору ядер. Запрос направляется реплике с наименьшим числом
+выполняющихся запросов; упавшая реплика перезапускается.
+"""
+
+import os
+import sys
+import time
+import signal
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+def parse_cores(spec: str) -> List[int]:
+    """Список ядер из строки вида "0-7,16,18-19" """
+    cores = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cores.extend(range(int(first), int(last or first) + 1))
+    return sorted(set(cores))
+
+
+def format_cores(cores: List[int]) -> str:
+    """Обратное к parse_cores: [0, 1, 2, 5] -> "0-2,5" """
+    ranges: List[List[int]] = []
+    for core in sorted(cores):
+        if ranges and core == ranges[-1][1] + 1:
+            ranges[-1][1] = core
+        else:
+            ranges.append([core, core])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+
+def split_cores(cores: List[int], workers: int) -> List[List[int]]:
+    """
+    Делит ядра на workers непересекающихся наборов подряд идущих ядер
+
+    Подряд идущие номера обычно принадлежат одному сокету, поэтому реплика
+    не делит кэш с соседями. Лишние ядра достаются первым репликам.
+    """
+    if workers < 1 or workers > len(cores):
+        raise ValueError(f"Нельзя разделить {len(cores)} ядер на {workers} реплик")
+    size, extra = divmod(len(cores), workers)
+    sets, start = [], 0
+    for index in range(workers):
+        end = start + size + (1 if index < extra else 0)
+        sets.append(cores[start:end])
+        start = end
+    return sets
+
+
+class NoReplicaAvailable(Exception):
+    """Ни одна реплика не готова принимать запросы"""
+
+
+class WorkerReplica:
+    """Процесс реплики, его HTTP клиент (через Unix сокет) и статистика"""
+
+    def __init__(self, index: int, cores: List[int], socket_path: str, app_dir: str, env: Dict[str, str]):
+        self.index = index
+        self.cores = cores
+        self.socket_path = socket_path
+        self.app_dir = app_dir
+        self.env = env
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(uds=socket_path),
+            base_url="http://replica",
+            timeout=None
+        )
+        self.ready = False
+
+        # Метрики
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.restarts = 0
+
+    @property
+    def key(self) -> str:
+        return f"worker-{self.index}"
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        """Запускает процесс реплики на своих ядрах"""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        threads = str(len(self.cores))
+        env = {
+            **os.environ,
+            **self.env,
+            "CPU_AFFINITY": format_cores(self.cores),
+            # OpenMP читает число потоков при импорте torch
+            "OMP_NUM_THREADS": threads,
+            "TORCH_NUM_THREADS": threads
+        }
+        self.ready = False
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "uvicorn", "main:app",
+            "--uds", self.socket_path, "--log-level", "info",
+            cwd=self.app_dir,
+            env=env
+        )
+        logger.info(f"🚀 {self.key}: pid {self.process.pid}, ядра {format_cores(self.cores)}")
+
+    async def wait_ready(self, timeout: float) -> bool:
+        """Ждет, пока реплика загрузит модель (статус healthy в /health)"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and self.alive:
+            try:
+                response = await self.client.get("/health", timeout=5)
+                if response.status_code == 200 and response.json().get("status") == "healthy":
+                    self.ready = True
+                    logger.info(f"✅ {self.key} готова")
+                    return True
+            except (httpx.HTTPError, ValueError):
+                # Сокет появится после загрузки модели
+                pass
+            await asyncio.sleep(1)
+        logger.error(f"❌ {self.key} не запустилась")
+        return False
+
+    async def stop(self, timeout: float):
+        """Останавливает реплику: SIGTERM, реплика дорабатывает принятые запросы"""
+        self.ready = False
+        if self.alive:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"⚠️  {self.key} не остановилась за {timeout:.0f}s, завершаем принудительно")
+                self.process.kill()
+                await self.process.wait()
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики реплики"""
+        return {
+            "pid": self.process.pid if self.process else None,
+            "cores": format_cores(self.cores),
+            "ready": self.ready,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "restarts": self.restarts
+        }
+
+
+class ReplicaPool:
+    """Запуск, балансировка и перезапуск реплик"""
+
+    def __init__(
+        self,
+        replicas: List[WorkerReplica],
+        start_timeout: float,
+        on_exit: Optional[Callable[[int], None]] = None
+    ):
+        self.replicas = replicas
+        self.start_timeout = start_timeout
+        self.on_exit = on_exit
+        self._starting: Dict[int, asyncio.Task] = {}
+        self._stopping = False
+
+    async def start(self):
+        """
+        Запускает все реплики и ждет их готовности
+
+        Raises:
+            RuntimeError: ни одна реплика не запустилась
+        """
+        for replica in self.replicas:
+            await replica.start()
+        ready = await asyncio.gather(*(r.wait_ready(self.start_timeout) for r in self.replicas))
+        if not any(ready):
+            raise RuntimeError("Ни одна реплика не запустилась")
+
+    def select(self) -> WorkerReplica:
+        """
+        Выбирает готовую реплику с наименьшим числом выполняющихся запросов
+
+        Raises:
+            NoReplicaAvailable: нет готовых реплик
+        """
+        ready = [r for r in self.replicas if r.ready]
+        if not ready:
+            raise NoReplicaAvailable("Нет готовых реплик")
+        return min(ready, key=lambda r: (r.in_flight, r.requests))
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[WorkerReplica]:
+        """
+        Занимает реплику, выбранную select(), на время запроса
+
+        Raises:
+            NoReplicaAvailable: нет готовых реплик
+        """
+        replica = self.select()
+        replica.in_flight += 1
+        replica.requests += 1
+        try:
+            yield replica
+        except asyncio.CancelledError:
+            raise
+        except BaseException:
+            replica.errors += 1
+            raise
+        finally:
+            replica.in_flight -= 1
+
+    async def monitor(self, interval: float = 1.0):
+        """Перезапускает реплики, процесс которых завершился"""
+        while not self._stopping:
+            await asyncio.sleep(interval)
+            for replica in self.replicas:
+                if replica.alive or replica.index in self._starting or self._stopping:
+                    continue
+                logger.error(f"❌ {replica.key} завершилась (код {replica.process.returncode}), перезапуск")
+                replica.ready = False
+                replica.restarts += 1
+                if self.on_exit:
+                    self.on_exit(replica.process.pid)
+                await replica.start()
+                task = asyncio.create_task(replica.wait_ready(self.start_timeout))
+                task.add_done_callback(lambda _, index=replica.index: self._starting.pop(index, None))
+                self._starting[replica.index] = task
+
+    async def stop(self, timeout: float):
+        """Останавливает все реплики одновременно"""
+        self._stopping = True
+        for task in self._starting.values():
+            task.cancel()
+        await asyncio.gather(*(r.stop(timeout) for r in self.replicas))
+        for replica in self.replicas:
+            await replica.client.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики реплик"""
+        return {replica.key: replica.stats() for replica in self.replicas}
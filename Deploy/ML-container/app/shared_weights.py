@@ -0,0 +1,80 @@
+"""
+Общие веса для нескольких процессов инференса на CPU
+Модель с подключенными LoRA адаптерами один раз объединяется и
+сохраняется в файл; процессы-реплики отображают его в память (mmap) только
+для чтения. Страницы весов лежат в page cache в одном экземпляре, сколько
+бы реплик их ни использовало.
+
+Подготовка файла (запускается диспетчером перед стартом реплик):
+
+    python shared_weights.py /tmp/vlm-shared/weights.pt
+"""
+
+import os
+import sys
+import logging
+from typing import Dict
+
+import torch
+from transformers import GenerationConfig
+
+logger = logging.getLogger(__name__)
+
+
+def save_snapshot(model: torch.nn.Module, path: str):
+    """
+    Сохраняет модель для загрузки репликами через load_snapshot
+
+    LoRA адаптеры объединяются с весами базовой модели, поэтому реплики
+    работают без PEFT. Файл записывается атомарно.
+    """
+    if hasattr(model, "merge_and_unload"):
+        model = model.merge_and_unload()
+
+    state_dict = model.state_dict()
+    # Непостоянные буферы (например, частоты rotary) не входят в state_dict
+    buffers = {
+        name: buffer for name, buffer in model.named_buffers()
+        if name not in state_dict
+    }
+    snapshot = {
+        "config": model.config.to_dict(),
+        "generation_config": model.generation_config.to_dict(),
+        "state_dict": state_dict,
+        "buffers": buffers
+    }
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    torch.save(snapshot, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path: str, model_class: type) -> torch.nn.Module:
+    """
+    Создает модель поверх весов, отображенных в память из файла
+
+    Модель строится на meta устройстве (без выделения памяти под веса),
+    затем параметры заменяются тензорами из mmap без копирования.
+    """
+    snapshot: Dict = torch.load(path, mmap=True, weights_only=True)
+    config = model_class.config_class.from_dict(snapshot["config"])
+
+    with torch.device("meta"):
+        model = model_class._from_config(config)
+    model.load_state_dict(snapshot["state_dict"], assign=True)
+    for name, buffer in snapshot["buffers"].items():
+        module_name, _, buffer_name = name.rpartition(".")
+        model.get_submodule(module_name).register_buffer(buffer_name, buffer, persistent=False)
+
+    model.generation_config = GenerationConfig.from_dict(snapshot["generation_config"])
+    model.eval()
+    return model
+
+
+if __name__ == "__main__":
+    import main
+
+    main.load_model_and_processor(for_serving=False)
+    save_snapshot(main.model, sys.argv[1])
+    logger.info(f"✅ Общие веса сохранены: {sys.argv[1]}")
@@ -0,0 +1,152 @@
+"""
+Выделенный поток инференса
+Подготовка входов, generate и декодирование выполняются в одном потоке,
+который берет задачи из ограниченной очереди. Event loop только ставит
+задачи и ждет их результата, поэтому /health, /metrics и прием загрузок
+отвечают, пока модель занята.
+"""
+
+import time
+import queue
+import asyncio
+import logging
+import threading
+import contextvars
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerBusy(Exception):
+    """Очередь к модели заполнена или поток инференса останавливается"""
+
+
+class InferenceWorker:
+    """
+    Поток, владеющий моделью: задачи выполняются строго по одной в порядке
+    поступления
+
+    Результат задачи (или ее исключение) передается в asyncio.Future в
+    event loop, из которого она поставлена. Контекст трассировки
+    поставившего задачу запроса сохраняется, поэтому span'ы этапов
+    попадают в его трассу.
+    """
+
+    def __init__(self, max_queue: int):
+        self.max_queue = max(1, max_queue)
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue(maxsize=self.max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._accepting = False
+        self._busy = False
+
+        # Метрики
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+
+    @property
+    def pending(self) -> int:
+        """Задачи, ожидающие поток инференса"""
+        return self._queue.qsize()
+
+    @property
+    def busy(self) -> bool:
+        """Выполняется ли сейчас задача"""
+        return self._busy
+
+    @property
+    def accepting(self) -> bool:
+        return self._accepting
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="inference-worker", daemon=True)
+        self._thread.start()
+        self._accepting = True
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> asyncio.Future:
+        """
+        Ставит fn(*args) в очередь потока инференса
+
+        Raises:
+            WorkerBusy: очередь заполнена или поток останавливается
+        """
+        if not self._accepting:
+            raise WorkerBusy("Сервис останавливается")
+        future = asyncio.get_running_loop().create_future()
+        item = (future, contextvars.copy_context(), fn, args, time.perf_counter())
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.rejected += 1
+            raise WorkerBusy(f"Очередь к модели заполнена ({self.max_queue})")
+        return future
+
+    async def drain(self, timeout: float):
+        """
+        Перестает принимать задачи, дожидается уже принятых (не дольше
+        timeout) и останавливает поток
+        """
+        self._accepting = False
+        deadline = time.monotonic() + timeout
+        while self.pending or self._busy:
+            if time.monotonic() >= deadline:
+                logger.warning(f"⚠️  Не дождались задач инференса: в очереди {self.pending}")
+                break
+            await asyncio.sleep(0.1)
+        if self._thread is not None:
+            self._queue.put(None)
+            await asyncio.to_thread(self._thread.join, max(0.0, deadline - time.monotonic()))
+            self._thread = None
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, context, fn, args, enqueued_at = item
+            loop = future.get_loop()
+            self._busy = True
+            self.total_wait += time.perf_counter() - enqueued_at
+            try:
+                result = context.run(fn, *args)
+            except BaseException as e:
+                self.failed += 1
+                self._deliver(loop, _set_exception, future, e)
+            else:
+                self.completed += 1
+                self._deliver(loop, _set_result, future, result)
+            finally:
+                self._busy = False
+
+    @staticmethod
+    def _deliver(loop: asyncio.AbstractEventLoop, setter: Callable, future: asyncio.Future, value: Any):
+        try:
+            loop.call_soon_threadsafe(setter, future, value)
+        except RuntimeError:
+            # Event loop уже закрыт - результат никто не ждет
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики потока инференса"""
+        processed = self.completed + self.failed
+        return {
+            "queue_depth": self.pending,
+            "max_queue": self.max_queue,
+            "busy": self._busy,
+            "accepting": self._accepting,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait / processed * 1000, 1) if processed else 0
+        }
+
+
+def _set_result(future: asyncio.Future, result: Any):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future, error: BaseException):
+    if not future.done():
+        future.set_exception(error)
@@ -0,0 +1,121 @@
+"""
+Сборка бандла модели для VLM Service
+Базовая модель из локального кэша HuggingFace (см. download_qwen3.py)
+объединяется с LoRA адаптерами, приводится к целевому типу и сохраняется в
+safetensors вместе с процессором и манифестом (контрольные суммы файлов,
+версия адаптеров). Сервис загружает бандл из MODEL_BUNDLE_PATH без PEFT и
+без приведения типа.
+
+    python build_bundle.py --adapter-path ../weights --output ../bundle --dtype float16
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+from pathlib import Path
+
+import torch
+from peft import PeftModel
+from transformers import AutoProcessor, Qwen3VLForConditionalGeneration
+
+from download_qwen3 import MODEL_ID, CACHE_DIR
+
+# Манифест и версия адаптеров считаются тем же кодом, что и в сервисе
+SCRIPT_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(SCRIPT_DIR.parent.parent / "app"))
+from bundle import adapter_files_version, write_manifest
+
+DTYPES = {
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+    "float32": torch.float32
+}
+
+
+def build_bundle(adapter_path: str, output: str, dtype_name: str) -> dict:
+    """
+    Собирает бандл в каталоге output (старый бандл заменяется целиком)
+
+    Returns:
+        Манифест бандла
+    """
+    print("=" * 60)
+    print(f"📦 Сборка бандла: {MODEL_ID}")
+    print(f"🔧 Адаптеры: {adapter_path}")
+    print(f"🔢 Тип весов: {dtype_name}")
+    print(f"📂 Результат: {output}")
+    print("=" * 60)
+
+    start_time = time.time()
+
+    # LoRA объединяются в float32, чтобы не терять точность до приведения типа
+    print("\n⏳ Загрузка базовой модели из локального кэша...")
+    model = Qwen3VLForConditionalGeneration.from_pretrained(
+        MODEL_ID,
+        torch_dtype=torch.float32,
+        cache_dir=CACHE_DIR,
+        local_files_only=True
+    )
+
+    if os.path.isdir(adapter_path):
+        print("⏳ Объединение LoRA адаптеров с весами...")
+        model = PeftModel.from_pretrained(model, adapter_path).merge_and_unload()
+        adapter_version = os.environ.get("ADAPTER_VERSION") or adapter_files_version(adapter_path)
+    else:
+        print(f"⚠️  Адаптеры не найдены в {adapter_path}, бандл без дообучения")
+        adapter_version = "none"
+
+    model = model.to(DTYPES[dtype_name])
+    model.eval()
+
+    # Собираем во временном каталоге: недособранный бандл не должен подхватиться
+    tmp_output = f"{output}.tmp"
+    shutil.rmtree(tmp_output, ignore_errors=True)
+
+    print("⏳ Сохранение весов в safetensors...")
+    model.save_pretrained(tmp_output, safe_serialization=True, max_shard_size="2GB")
+
+    print("⏳ Сохранение процессора...")
+    try:
+        processor = AutoProcessor.from_pretrained(adapter_path)
+    except Exception as e:
+        print(f"⚠️  Процессор адаптера не загружен ({e}), берем процессор базовой модели")
+        processor = AutoProcessor.from_pretrained(MODEL_ID, cache_dir=CACHE_DIR, local_files_only=True)
+    processor.save_pretrained(tmp_output)
+
+    print("⏳ Подсчет контрольных сумм...")
+    manifest = write_manifest(tmp_output, MODEL_ID, adapter_version, dtype_name)
+
+    shutil.rmtree(output, ignore_errors=True)
+    os.replace(tmp_output, output)
+
+    total_size = sum(f["size"] for f in manifest["files"].values())
+    print("\n" + "=" * 60)
+    print(f"✅ Бандл собран за {time.time() - start_time:.1f} сек")
+    print(f"🏷️  Версия адаптеров: {adapter_version}")
+    print(f"💾 Размер: {total_size / (1024**3):.2f} GB, файлов: {len(manifest['files'])}")
+    print("=" * 60)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сборка бандла модели для VLM Service")
+    parser.add_argument("--adapter-path", default=os.environ.get("ADAPTER_PATH", str(SCRIPT_DIR.parent / "weights")),
+                        help="Каталог LoRA адаптеров")
+    parser.add_argument("--output", default=str(SCRIPT_DIR.parent / "bundle"), help="Каталог бандла")
+    parser.add_argument("--dtype", choices=sorted(DTYPES), default=os.environ.get("TORCH_DTYPE", "float16"),
+                        help="Тип весов в бандле")
+    args = parser.parse_args()
+
+    try:
+        build_bundle(args.adapter_path, args.output, args.dtype)
+    except OSError as e:
+        print(f"\n❌ Ошибка при сборке бандла: {e}")
+        print("💡 Базовая модель должна быть в кэше: запустите download_qwen3.py")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Сравнение ответов VLM сервиса с эталоном на изображениях tests/*.png
+Эталон снимается с сервиса без квантизации, затем тот же набор
+прогоняется через сервис с QUANTIZATION=int8/int4, и для каждого
+изображения считается, насколько ответ отличается от эталона:
+совпадение текста, строк таблицы и время инференса.
+
+    # 1. Сервис с QUANTIZATION=none
+    python compare_outputs.py --save reference.json
+    # 2. Тот же сервис с QUANTIZATION=int8
+    python compare_outputs.py --reference reference.json
+"""
+
+import sys
+import json
+import glob
+import argparse
+from difflib import SequenceMatcher
+from pathlib import Path
+from typing import Any, Dict, List
+
+import httpx
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+
+
+def table_rows(text: str) -> List[tuple]:
+    """Строки Markdown-таблицы без заголовка и разделителя, ячейки нормализованы"""
+    rows = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line.startswith("|"):
+            continue
+        cells = tuple(" ".join(cell.split()).lower() for cell in line.strip("|").split("|"))
+        if all(set(cell) <= set("-: ") for cell in cells):
+            continue
+        rows.append(cells)
+    return rows[1:]
+
+
+def rows_f1(reference: List[tuple], candidate: List[tuple]) -> float:
+    """F1 по совпадающим строкам таблицы (порядок не учитывается)"""
+    if not reference and not candidate:
+        return 1.0
+    matched = len(set(reference) & set(candidate))
+    if matched == 0:
+        return 0.0
+    precision = matched / len(set(candidate))
+    recall = matched / len(set(reference))
+    return 2 * precision * recall / (precision + recall)
+
+
+def run_images(url: str, images: List[str], timeout: float) -> Dict[str, Any]:
+    """Прогоняет изображения через /infer и собирает ответы и состояние сервиса"""
+    results = {}
+    with httpx.Client(base_url=url, timeout=timeout) as client:
+        health = client.get("/health").json()
+        print(f"🗜️  Квантизация: {health.get('quantization')}, dtype: {health.get('torch_dtype')}")
+        print(f"💾 Веса: {health.get('model_memory_gb')} GB, процесс: {health.get('process_rss_gb')} GB")
+
+        for path in images:
+            name = Path(path).name
+            with open(path, "rb") as f:
+                response = client.post("/infer", files={"file": (name, f, "image/png")})
+            response.raise_for_status()
+            data = response.json()
+            results[name] = {
+                "description": data["description"],
+                "inference_time": data["metadata"]["inference_time"]
+            }
+            print(f"✅ {name}: {data['metadata']['inference_time']} сек")
+
+        # Замер прямого прохода при старте и память после прогона
+        health = client.get("/health").json()
+    return {"health": health, "results": results}
+
+
+def compare(reference: Dict[str, Any], candidate: Dict[str, Any]) -> bool:
+    """
+    Печатает отличия от эталона по каждому изображению и итог
+
+    Returns:
+        True, если все ответы эталона есть в прогоне
+    """
+    rows = []
+    for name, expected in reference["results"].items():
+        actual = candidate["results"].get(name)
+        if actual is None:
+            print(f"⚠️  {name}: нет ответа в прогоне")
+            continue
+        rows.append({
+            "name": name,
+            "exact": expected["description"] == actual["description"],
+            "similarity": SequenceMatcher(None, expected["description"], actual["description"]).ratio(),
+            "rows_f1": rows_f1(table_rows(expected["description"]), table_rows(actual["description"])),
+            "time_ref": expected["inference_time"],
+            "time": actual["inference_time"]
+        })
+
+    print("\n" + "=" * 72)
+    print(f"{'Изображение':<14}{'Совпадает':>10}{'Текст':>8}{'Строки F1':>11}{'Эталон, с':>12}{'Прогон, с':>11}")
+    print("-" * 72)
+    for row in rows:
+        print(
+            f"{row['name']:<14}{'да' if row['exact'] else 'нет':>10}{row['similarity']:>8.3f}"
+            f"{row['rows_f1']:>11.3f}{row['time_ref']:>12.2f}{row['time']:>11.2f}"
+        )
+    print("=" * 72)
+
+    if rows:
+        count = len(rows)
+        time_ref = sum(row["time_ref"] for row in rows) / count
+        time = sum(row["time"] for row in rows) / count
+        print(f"📊 Полностью совпадают: {sum(row['exact'] for row in rows)} из {count}")
+        print(f"📊 Средняя похожесть текста: {sum(row['similarity'] for row in rows) / count:.3f}")
+        print(f"📊 Средний F1 по строкам таблицы: {sum(row['rows_f1'] for row in rows) / count:.3f}")
+        print(f"⏱️  Среднее время: {time_ref:.2f} -> {time:.2f} сек (x{time_ref / time:.2f})")
+
+    for label, run in (("Эталон", reference), ("Прогон", candidate)):
+        health = run["health"]
+        latency = health.get("forward_latency") or {}
+        print(
+            f"💾 {label}: {health.get('quantization')}, веса {health.get('model_memory_gb')} GB, "
+            f"процесс {health.get('process_rss_gb')} GB, прямой проход {latency.get('forward_ms')} мс"
+        )
+    return len(rows) == len(reference["results"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение ответов VLM сервиса с эталоном")
+    parser.add_argument("--url", default="http://localhost:8002", help="Адрес VLM сервиса")
+    parser.add_argument("--images", default=str(SCRIPT_DIR / "*.png"), help="Шаблон путей к изображениям")
+    parser.add_argument("--timeout", type=float, default=600, help="Таймаут одного запроса, сек")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--save", help="Сохранить ответы как эталон в файл")
+    group.add_argument("--reference", help="Сравнить ответы с эталоном из файла")
+    args = parser.parse_args()
+
+    images = sorted(glob.glob(args.images))
+    if not images:
+        print(f"❌ Нет изображений: {args.images}")
+        sys.exit(1)
+
+    run = run_images(args.url, images, args.timeout)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(run, f, ensure_ascii=False, indent=2)
+        print(f"💾 Эталон сохранен: {args.save}")
+        return
+
+    with open(args.reference, encoding="utf-8") as f:
+        reference = json.load(f)
+    if not compare(reference, run):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,18 +5,25 @@ Adapter Service - сервис конвертации диаграмм в PNG
 """
 
 import os
+import time
 import logging
 from datetime import datetime
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.responses import Response
+from pydantic import BaseModel
+from prometheus_client import Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+from tracing import TraceMiddleware, TraceIdLogFilter, configure_tracing, shutdown_tracing
 
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s'
 )
+for handler in logging.getLogger().handlers:
+    handler.addFilter(TraceIdLogFilter())
 logger = logging.getLogger(__name__)
 
 # Поддерживаемые форматы
@@ -24,17 +31,51 @@ SUPPORTED_IMAGE_FORMATS = {'.png', '.jpg', '.jpeg', '.gif', '.bmp'}
 SUPPORTED_DIAGRAM_FORMATS = {'.bpmn', '.puml', '.mmd', '.drawio'}
 ALL_SUPPORTED_FORMATS = SUPPORTED_IMAGE_FORMATS | SUPPORTED_DIAGRAM_FORMATS
 
+# Общий с Backend том с файлами, адресуемыми по SHA256 (пусто - не используется)
+BLOB_STORE_PATH = os.getenv("BLOB_STORE_PATH", "")
+
 # Метрики
 total_conversions = 0
 successful_conversions = 0
 failed_conversions = 0
 
+# Prometheus гистограмма длительности конвертации
+CONVERSION_SECONDS = Histogram(
+    "adapter_conversion_duration_seconds",
+    "Длительность конвертации файла",
+    ["file_type", "status"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+
+
+class BlobConvertRequest(BaseModel):
+    blob_hash: str
+    file_name: str
+
 
 def get_file_extension(filename: str) -> str:
     """Получает расширение файла в нижнем регистре"""
     return os.path.splitext(filename)[1].lower() if filename else ''
 
 
+def get_blob_path(blob_hash: str) -> str:
+    """
+    Путь к файлу в общем хранилище
+    
+    Raises:
+        HTTPException: 404 если хранилище не настроено или файла нет,
+            400 при некорректном хэше
+    """
+    if not BLOB_STORE_PATH:
+        raise HTTPException(status_code=404, detail="Общее хранилище файлов не настроено")
+    if len(blob_hash) != 64 or not set(blob_hash) <= set("0123456789abcdef"):
+        raise HTTPException(status_code=400, detail="Некорректный хэш файла")
+    path = os.path.join(BLOB_STORE_PATH, blob_hash[:2], blob_hash)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Файл не найден в хранилище")
+    return path
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Управление жизненным циклом приложения"""
@@ -42,6 +83,7 @@ async def lifespan(app: FastAPI):
     logger.info("=" * 60)
     logger.info("🚀 Запуск Adapter Service")
     logger.info("=" * 60)
+    configure_tracing("adapter")
     logger.info(f"📁 Поддерживаемые изображения: {', '.join(SUPPORTED_IMAGE_FORMATS)}")
     logger.info(f"📊 Форматы диаграмм (TODO): {', '.join(SUPPORTED_DIAGRAM_FORMATS)}")
     logger.info("=" * 60)
@@ -54,6 +96,7 @@ async def lifespan(app: FastAPI):
     logger.info(f"📊 Всего конвертаций: {total_conversions}")
     logger.info(f"✅ Успешных: {successful_conversions}")
     logger.info(f"❌ Ошибок: {failed_conversions}")
+    shutdown_tracing()
 
 
 # Создание FastAPI приложения
@@ -64,6 +107,9 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# Span на каждый запрос (контекст приходит от Backend в заголовке traceparent)
+app.add_middleware(TraceMiddleware)
+
 
 @app.get("/")
 async def root():
@@ -78,8 +124,10 @@ async def root():
         },
         "endpoints": {
             "convert": "/convert (POST)",
+            "convert_blob": "/convert/blob (POST)",
             "health": "/health (GET)",
             "metrics": "/metrics (GET)",
+            "metrics_prometheus": "/metrics/prometheus (GET)",
             "docs": "/docs"
         }
     }
@@ -116,6 +164,49 @@ async def get_metrics():
     }
 
 
+@app.get("/metrics/prometheus")
+async def get_prometheus_metrics():
+    """Гистограммы длительности конвертации в формате Prometheus"""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+def convert_content(file_ext: str, content: bytes) -> bytes:
+    """
+    Конвертирует содержимое файла в PNG
+    
+    Изображения возвращаются как есть, конвертация диаграмм пока не
+    реализована.
+    
+    Args:
+        file_ext: Расширение файла в нижнем регистре
+        content: Содержимое файла
+    
+    Returns:
+        PNG изображение
+    
+    Raises:
+        HTTPException: 400 для неподдерживаемого формата, 501 для диаграмм
+    """
+    if file_ext in SUPPORTED_IMAGE_FORMATS:
+        logger.info("✅ Изображение - pass-through (без конвертации)")
+        return content
+    
+    if file_ext in SUPPORTED_DIAGRAM_FORMATS:
+        logger.warning(f"⚠️  Конвертация {file_ext} еще не реализована")
+        raise HTTPException(
+            status_code=501,
+            detail=f"Конвертация {file_ext} в PNG пока не реализована. "
+                   f"Используйте изображения: {', '.join(SUPPORTED_IMAGE_FORMATS)}"
+        )
+    
+    logger.warning(f"⚠️  Неподдерживаемый формат: {file_ext}")
+    raise HTTPException(
+        status_code=400,
+        detail=f"Неподдерживаемый формат: {file_ext or 'без расширения'}. "
+               f"Поддерживаются: {', '.join(ALL_SUPPORTED_FORMATS)}"
+    )
+
+
 @app.post("/convert")
 async def convert_diagram(file: UploadFile = File(...)):
     """
@@ -134,6 +225,8 @@ async def convert_diagram(file: UploadFile = File(...)):
     global total_conversions, successful_conversions, failed_conversions
     
     total_conversions += 1
+    start_time = time.perf_counter()
+    conversion_status = "error"
     
     logger.info("=" * 60)
     logger.info(f"📥 Получен запрос на конвертацию")
@@ -146,7 +239,6 @@ async def convert_diagram(file: UploadFile = File(...)):
         
         if not file_ext:
             logger.warning("⚠️  Файл без расширения")
-            failed_conversions += 1
             raise HTTPException(
                 status_code=400,
                 detail="Файл должен иметь расширение"
@@ -157,7 +249,6 @@ async def convert_diagram(file: UploadFile = File(...)):
         # Проверяем поддерживаемые форматы
         if file_ext not in ALL_SUPPORTED_FORMATS:
             logger.warning(f"⚠️  Неподдерживаемый формат: {file_ext}")
-            failed_conversions += 1
             raise HTTPException(
                 status_code=400,
                 detail=f"Неподдерживаемый формат: {file_ext}. "
@@ -170,56 +261,103 @@ async def convert_diagram(file: UploadFile = File(...)):
         
         logger.info(f"📊 Размер файла: {file_size / 1024:.2f} KB")
         
-        # Обработка изображений (pass-through)
+        # Изображения возвращаются как есть, для диаграмм - 501
+        png_content = convert_content(file_ext, content)
+        successful_conversions += 1
+        conversion_status = "success"
+        logger.info("=" * 60)
+        
+        return Response(
+            content=png_content,
+            media_type="image/png",
+            headers={
+                "X-Conversion-Type": "pass-through",
+                "X-Original-Format": file_ext,
+                "X-File-Size": str(file_size)
+            }
+        )
+            
+    except HTTPException:
+        failed_conversions += 1
+        logger.info("=" * 60)
+        raise
+    except Exception as e:
+        failed_conversions += 1
+        logger.error("=" * 60)
+        logger.error(f"❌ Неожиданная ошибка: {e}")
+        logger.error("=" * 60)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Ошибка при конвертации: {str(e)}"
+        )
+    finally:
+        # Неизвестные расширения сводим в одно значение метки
+        file_type = get_file_extension(file.filename)
+        if file_type not in ALL_SUPPORTED_FORMATS:
+            file_type = "other"
+        CONVERSION_SECONDS.labels(file_type, conversion_status).observe(
+            time.perf_counter() - start_time
+        )
+
+
+@app.post("/convert/blob")
+async def convert_blob(data: BlobConvertRequest):
+    """
+    Конвертирует файл из общего хранилища без передачи содержимого по HTTP
+    
+    Результат конвертации кладется в то же хранилище под своим SHA256.
+    Изображения не конвертируются, поэтому для них возвращается исходный
+    хэш, а файл даже не читается.
+    
+    Args:
+        data: Хэш файла в хранилище и исходное имя файла (для типа)
+    
+    Returns:
+        {"blob_hash": хэш PNG, "conversion_type": ...}
+    """
+    global total_conversions, successful_conversions, failed_conversions
+    
+    total_conversions += 1
+    start_time = time.perf_counter()
+    conversion_status = "error"
+    file_ext = get_file_extension(data.file_name)
+    
+    logger.info(f"📥 Конвертация из хранилища: {data.file_name} ({data.blob_hash[:16]}...)")
+    
+    try:
+        path = get_blob_path(data.blob_hash)
+        
         if file_ext in SUPPORTED_IMAGE_FORMATS:
             logger.info("✅ Изображение - pass-through (без конвертации)")
             successful_conversions += 1
-            logger.info("=" * 60)
-            
-            # Возвращаем изображение как есть
-            return Response(
-                content=content,
-                media_type="image/png",
-                headers={
-                    "X-Conversion-Type": "pass-through",
-                    "X-Original-Format": file_ext,
-                    "X-File-Size": str(file_size)
-                }
-            )
+            conversion_status = "success"
+            return {
+                "blob_hash": data.blob_hash,
+                "conversion_type": "pass-through",
+                "original_format": file_ext,
+                "file_size": os.path.getsize(path)
+            }
         
-        # Обработка диаграмм (заглушка)
-        elif file_ext in SUPPORTED_DIAGRAM_FORMATS:
+        if file_ext in SUPPORTED_DIAGRAM_FORMATS:
             logger.warning(f"⚠️  Конвертация {file_ext} еще не реализована")
-            failed_conversions += 1
-            logger.info("=" * 60)
-            
             raise HTTPException(
                 status_code=501,
                 detail=f"Конвертация {file_ext} в PNG пока не реализована. "
                        f"Используйте изображения: {', '.join(SUPPORTED_IMAGE_FORMATS)}"
             )
         
-        else:
-            # Не должно сюда попасть, но на всякий случай
-            logger.error(f"❌ Неожиданный формат: {file_ext}")
-            failed_conversions += 1
-            logger.info("=" * 60)
-            
-            raise HTTPException(
-                status_code=500,
-                detail=f"Внутренняя ошибка при обработке {file_ext}"
-            )
-            
+        raise HTTPException(
+            status_code=400,
+            detail=f"Неподдерживаемый формат: {file_ext or 'без расширения'}. "
+                   f"Поддерживаются: {', '.join(ALL_SUPPORTED_FORMATS)}"
+        )
     except HTTPException:
-        raise
-    except Exception as e:
         failed_conversions += 1
-        logger.error("=" * 60)
-        logger.error(f"❌ Неожиданная ошибка: {e}")
-        logger.error("=" * 60)
-        raise HTTPException(
-            status_code=500,
-            detail=f"Ошибка при конвертации: {str(e)}"
+        raise
+    finally:
+        file_type = file_ext if file_ext in ALL_SUPPORTED_FORMATS else "other"
+        CONVERSION_SECONDS.labels(file_type, conversion_status).observe(
+            time.perf_counter() - start_time
         )
 
 
@@ -0,0 +1,255 @@
+"""
+Admission control перед вызовом VLM сервиса
+Ограничение параллелизма, приоритеты, token bucket на клиента и
+ранний отказ запросам, которые заведомо не успеют выполниться
+"""
+
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+# Классы приоритета: меньше - важнее
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+
+PRIORITY_ORDER = {PRIORITY_INTERACTIVE: 0, PRIORITY_BATCH: 1}
+
+
+class AdmissionRejected(Exception):
+    """Запрос не допущен к VLM сервису"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: int, reason: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class TokenBucket:
+    """Token bucket: rate запросов в секунду с допустимым всплеском burst"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> bool:
+        """Забирает токен, если он есть"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def refund(self):
+        """Возвращает токен запроса, который так и не был выполнен"""
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def wait_time(self) -> float:
+        """Время до появления следующего токена (сек)"""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate) if self.rate > 0 else float("inf")
+
+
+class AdmissionController:
+    """
+    Планировщик доступа к VLM сервису
+
+    Одновременно выполняется не более max_concurrency запросов, остальные
+    ждут в ограниченной очереди с приоритетами. Запрос отклоняется сразу,
+    если клиент превысил свою квоту, очередь заполнена или по оценке
+    ожидания запрос не успеет завершиться до своего дедлайна.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        max_queue: int,
+        client_rate: float,
+        client_burst: float,
+        initial_service_time: float,
+        max_clients: int = 10000
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.max_clients = max_clients
+
+        self._in_flight = 0
+        self._waiters: List[tuple] = []
+        self._seq = itertools.count()
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._avg_service_time = initial_service_time
+
+        # Метрики
+        self.admitted = 0
+        self.shed: Dict[str, int] = {"rate_limited": 0, "queue_full": 0, "deadline": 0}
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _bucket(self, client_id: str) -> TokenBucket:
+        bucket = self._buckets.get(client_id)
+        if bucket is None:
+            if len(self._buckets) >= self.max_clients:
+                # Забываем самых давних клиентов - их квоты уже восстановились
+                oldest = sorted(self._buckets, key=lambda c: self._buckets[c].updated)
+                for stale in oldest[:len(oldest) // 10 + 1]:
+                    del self._buckets[stale]
+            bucket = TokenBucket(self.client_rate, self.client_burst)
+            self._buckets[client_id] = bucket
+        return bucket
+
+    def _pending_waiters(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    def _estimated_wait(self, queued_ahead: int) -> float:
+        """Оценка ожидания в очереди по средней длительности обслуживания"""
+        if self._in_flight < self.max_concurrency and queued_ahead == 0:
+            return 0.0
+        rounds = queued_ahead // self.max_concurrency + 1
+        return rounds * self._avg_service_time
+
+    def _reject(self, reason: str, status_code: int, detail: str, retry_after: float):
+        self.shed[reason] += 1
+        raise AdmissionRejected(status_code, detail, max(1, int(retry_after)), reason)
+
+    def charge(self, client_id: str) -> TokenBucket:
+        """
+        Списывает токен клиента без ожидания слота
+
+        Используется для пакетных запросов и задач: квота расходуется один
+        раз на весь HTTP запрос, а не на каждый файл внутри него.
+
+        Raises:
+            AdmissionRejected: клиент превысил свою квоту
+        """
+        bucket = self._bucket(client_id)
+        if not bucket.take():
+            self._reject(
+                "rate_limited", 429,
+                "Превышен лимит запросов клиента", bucket.wait_time()
+            )
+        return bucket
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        client_id: Optional[str],
+        priority: str,
+        deadline: float
+    ) -> AsyncIterator[None]:
+        """
+        Ожидает свободный слот для вызова VLM
+
+        Args:
+            client_id: Идентификатор клиента для квоты; None - квота уже
+                списана через charge()
+            priority: PRIORITY_INTERACTIVE или PRIORITY_BATCH
+            deadline: Момент (time.monotonic()), к которому запрос должен завершиться
+
+        Raises:
+            AdmissionRejected: запрос отклонен
+        """
+        bucket = self.charge(client_id) if client_id is not None else None
+
+        rank = PRIORITY_ORDER.get(priority, PRIORITY_ORDER[PRIORITY_BATCH])
+        # Впереди окажутся ожидающие с тем же или более высоким приоритетом
+        queued_ahead = sum(
+            1 for waiter_rank, _, future in self._waiters
+            if waiter_rank <= rank and not future.done()
+        )
+        expected_wait = self._estimated_wait(queued_ahead)
+        now = time.monotonic()
+
+        if now + expected_wait + self._avg_service_time > deadline:
+            if bucket:
+                bucket.refund()
+            self._reject(
+                "deadline", 503,
+                "Сервис перегружен: запрос не успеет выполниться вовремя", expected_wait
+            )
+
+        wait_start = now
+        if self._in_flight < self.max_concurrency and not self._pending_waiters():
+            self._in_flight += 1
+        else:
+            if self._pending_waiters() >= self.max_queue:
+                if bucket:
+                    bucket.refund()
+                self._reject(
+                    "queue_full", 503,
+                    "Сервис перегружен: очередь заполнена", expected_wait
+                )
+
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (rank, next(self._seq), future))
+            try:
+                # Ждем не дольше, чем позволяет дедлайн с учетом самой обработки
+                await asyncio.wait_for(
+                    asyncio.shield(future),
+                    max(0.0, deadline - self._avg_service_time - time.monotonic())
+                )
+            except asyncio.TimeoutError:
+                if not future.done():
+                    future.cancel()
+                    if bucket:
+                        bucket.refund()
+                    self._reject(
+                        "deadline", 503,
+                        "Сервис перегружен: превышено время ожидания в очереди",
+                        self._avg_service_time
+                    )
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # Слот уже передан нам - возвращаем его следующему
+                    self._release()
+                else:
+                    future.cancel()
+                raise
+
+        waited = time.monotonic() - wait_start
+        self.admitted += 1
+        self.total_wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+
+        service_start = time.monotonic()
+        try:
+            yield
+        finally:
+            service_time = time.monotonic() - service_start
+            self._avg_service_time = 0.8 * self._avg_service_time + 0.2 * service_time
+            self._release()
+
+    def _release(self):
+        """Передает слот следующему ожидающему или освобождает его"""
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                # Слот переходит ожидающему, число выполняющихся не меняется
+                future.set_result(None)
+                return
+        self._in_flight -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики планировщика"""
+        return {
+            "in_flight": self._in_flight,
+            "queue_length": self._pending_waiters(),
+            "max_concurrency": self.max_concurrency,
+            "admitted": self.admitted,
+            "shed": dict(self.shed),
+            "avg_wait_time": round(self.total_wait_time / self.admitted, 3) if self.admitted else 0,
+            "max_wait_time": round(self.max_wait_time, 3),
+            "avg_service_time": round(self._avg_service_time, 3)
+        }
@@ -0,0 +1,119 @@
+"""
+Content-addressed хранилище файлов на общем томе
+Backend кладет загрузку в хранилище один раз, а Adapter и VLM сервисы
+получают только SHA256 и читают файл с общего тома сами, без повторной
+передачи содержимого по HTTP
+"""
+
+import os
+import time
+import shutil
+import logging
+import tempfile
+from typing import BinaryIO, Optional
+
+logger = logging.getLogger(__name__)
+
+HEX_DIGITS = set("0123456789abcdef")
+
+
+def is_valid_blob_hash(blob_hash: str) -> bool:
+    """SHA256 в hex: только такие имена допустимы (защита от выхода из каталога)"""
+    return len(blob_hash) == 64 and set(blob_hash) <= HEX_DIGITS
+
+
+class BlobRef:
+    """Ссылка на файл в хранилище, передаваемая вместо содержимого"""
+
+    def __init__(self, blob_hash: str, path: str):
+        self.blob_hash = blob_hash
+        self.path = path
+
+
+class BlobStore:
+    """
+    Файлы хранятся в root/<первые 2 символа хэша>/<хэш>
+
+    Запись атомарна (временный файл + rename), поэтому читатель никогда не
+    видит недописанный файл. Одинаковое содержимое хранится один раз.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+        # Метрики
+        self.stored = 0
+        self.reused = 0
+        self.removed = 0
+
+    def path(self, blob_hash: str) -> str:
+        if not is_valid_blob_hash(blob_hash):
+            raise ValueError(f"Некорректный хэш: {blob_hash!r}")
+        return os.path.join(self.root, blob_hash[:2], blob_hash)
+
+    def put_file(self, file: BinaryIO, blob_hash: str) -> BlobRef:
+        """
+        Сохраняет файл с уже посчитанным SHA256
+
+        Если такой файл уже есть, обновляется только время изменения,
+        чтобы очистка не удалила его во время обработки запроса.
+        """
+        path = self.path(blob_hash)
+        if os.path.exists(path):
+            os.utime(path)
+            self.reused += 1
+            return BlobRef(blob_hash, path)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as target:
+                file.seek(0)
+                shutil.copyfileobj(file, target)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        finally:
+            file.seek(0)
+
+        self.stored += 1
+        return BlobRef(blob_hash, path)
+
+    def ref(self, blob_hash: str) -> Optional[BlobRef]:
+        """Ссылка на существующий файл или None"""
+        path = self.path(blob_hash)
+        return BlobRef(blob_hash, path) if os.path.exists(path) else None
+
+    def cleanup(self, max_age: float) -> int:
+        """
+        Удаляет файлы, которые не использовались дольше max_age секунд
+
+        Returns:
+            Количество удаленных файлов
+        """
+        cutoff = time.time() - max_age
+        removed = 0
+        for entry in os.scandir(self.root):
+            if not entry.is_dir():
+                continue
+            for blob in os.scandir(entry.path):
+                try:
+                    if blob.stat().st_mtime < cutoff:
+                        os.unlink(blob.path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        self.removed += removed
+        return removed
+
+    def stats(self) -> dict:
+        """Метрики хранилища"""
+        return {
+            "root": self.root,
+            "stored": self.stored,
+            "reused": self.reused,
+            "removed": self.removed
+        }
@@ -0,0 +1,72 @@
+"""
+In-process кэш результатов распознавания
+LRU с ограничением по количеству записей и временем жизни (TTL)
+"""
+
+import time
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Hashable
+
+
+def build_model_key(model_info: Dict[str, Any]) -> str:
+    """
+    Строит ключ версии модели из параметров, влияющих на результат
+
+    Смена модели, адаптеров, промпта, лимита токенов или квантизации дает
+    новый ключ, поэтому старые записи кэша перестают находиться.
+    """
+    key_fields = {
+        "model": model_info.get("model"),
+        "adapter_version": model_info.get("adapter_version"),
+        "prompt_hash": model_info.get("prompt_hash"),
+        "max_tokens": model_info.get("max_tokens"),
+    }
+    # Без квантизации ключ прежний, чтобы не сбрасывать накопленный кэш
+    quantization = model_info.get("quantization") or "none"
+    if quantization != "none":
+        key_fields["quantization"] = quantization
+    payload = json.dumps(key_fields, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+class ResultCache:
+    """LRU кэш с TTL для результатов VLM"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Dict[str, Any]]:
+        """Возвращает значение или None, если записи нет или она устарела"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Dict[str, Any]):
+        """Сохраняет значение, вытесняя самые старые записи при переполнении"""
+        if self.max_size <= 0:
+            return
+
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Очищает кэш"""
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
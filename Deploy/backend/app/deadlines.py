@@ -0,0 +1,98 @@
+"""
+Дедлайн запроса для зависимых сервисов
+Оставшееся до дедлайна время передается в заголовке X-Request-Timeout-Ms,
+чтобы VLM сервис прекращал генерацию, результат которой уже никто не ждет.
+Отключение клиента отменяет обработку так же, как истекший дедлайн.
+"""
+
+import time
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Iterator, Optional, Union
+
+DEADLINE_HEADER = "X-Request-Timeout-Ms"
+
+
+class SharedDeadline:
+    """
+    Дедлайн вызова, результат которого ждут несколько запросов: самый
+    поздний из их дедлайнов (запрос, присоединившийся позже, продлевает его)
+    """
+
+    def __init__(self, deadline: float):
+        self.value = deadline
+
+    def extend(self, deadline: float):
+        self.value = max(self.value, deadline)
+
+
+# Момент (time.monotonic()), к которому должен завершиться текущий запрос
+_deadline: ContextVar[Optional[Union[float, SharedDeadline]]] = ContextVar("request_deadline", default=None)
+
+
+class ClientDisconnected(Exception):
+    """Клиент закрыл соединение, не дождавшись ответа"""
+
+
+def deadline_at(deadline: Union[float, SharedDeadline]) -> float:
+    """Момент дедлайна (для общего дедлайна - текущее значение)"""
+    return deadline.value if isinstance(deadline, SharedDeadline) else deadline
+
+
+@contextmanager
+def deadline_scope(deadline: Union[float, SharedDeadline]) -> Iterator[None]:
+    """Делает deadline дедлайном вызовов зависимых сервисов внутри блока"""
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        try:
+            _deadline.reset(token)
+        except ValueError:
+            # Генератор закрыт из другого контекста (например, при отключении клиента)
+            pass
+
+
+def remaining_time() -> Optional[float]:
+    """Секунд до дедлайна текущего запроса или None вне запроса"""
+    deadline = _deadline.get()
+    return deadline_at(deadline) - time.monotonic() if deadline is not None else None
+
+
+def deadline_expired() -> bool:
+    remaining = remaining_time()
+    return remaining is not None and remaining <= 0
+
+
+def is_expired(deadline: Union[float, SharedDeadline]) -> bool:
+    """
+    Наступил ли дедлайн: 504 от зависимого сервиса до него - таймаут
+    сервиса, а не отмена запроса по дедлайну
+    """
+    return deadline_at(deadline) <= time.monotonic()
+
+
+async def run_until_disconnect(
+    is_disconnected: Callable[[], Awaitable[bool]],
+    awaitable: Awaitable[Any],
+    poll_interval: float
+) -> Any:
+    """
+    Выполняет awaitable, каждые poll_interval секунд проверяя соединение
+    с клиентом; при отключении клиента выполнение отменяется
+
+    Raises:
+        ClientDisconnected: клиент отключился до завершения
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait([task], timeout=poll_interval)
+            if done:
+                return task.result()
+            if await is_disconnected():
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
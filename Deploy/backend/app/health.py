@@ -0,0 +1,247 @@
+"""
+Состояние зависимых сервисов
+Фоновая периодическая проверка /health с кэшированием результата и
+circuit breaker на каждый сервис: пока сервис недоступен, запросы к нему
+сразу отклоняются, не дожидаясь таймаута
+"""
+
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Состояния circuit breaker
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Сервис считается недоступным, запрос не отправляется"""
+
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f"{name} недоступен")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker одного сервиса
+
+    После failure_threshold ошибок подряд размыкается: запросы отклоняются
+    без обращения к сервису. Через reset_timeout переходит в half-open и
+    пропускает один пробный запрос - его успех замыкает цепь, ошибка снова
+    размыкает.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = CIRCUIT_CLOSED
+        self.consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_started: Optional[float] = None
+
+        # Метрики
+        self.rejected = 0
+        self.opened = 0
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос; в half-open пропускает один пробный"""
+        now = time.monotonic()
+
+        if self.state == CIRCUIT_OPEN and now - self._opened_at >= self.reset_timeout:
+            self.state = CIRCUIT_HALF_OPEN
+            self._trial_started = None
+            logger.info(f"🟡 {self.name}: circuit half-open, пробный запрос")
+
+        if self.state == CIRCUIT_CLOSED:
+            return True
+
+        if self.state == CIRCUIT_HALF_OPEN:
+            # Пробный запрос, результат которого так и не пришел, не держит цепь вечно
+            if self._trial_started is None or now - self._trial_started >= self.reset_timeout:
+                self._trial_started = now
+                return True
+
+        self.rejected += 1
+        return False
+
+    def check(self):
+        """
+        Raises:
+            CircuitOpenError: цепь разомкнута
+        """
+        if not self.allow():
+            raise CircuitOpenError(self.name, self.retry_after())
+
+    def retry_after(self) -> int:
+        """Время (сек) до следующей попытки"""
+        if self.state == CIRCUIT_CLOSED:
+            return 1
+        remaining = self.reset_timeout - (time.monotonic() - self._opened_at)
+        return max(1, int(remaining))
+
+    def record_success(self):
+        if self.state != CIRCUIT_CLOSED:
+            logger.info(f"🟢 {self.name}: circuit closed, сервис восстановился")
+        self.state = CIRCUIT_CLOSED
+        self.consecutive_failures = 0
+        self._trial_started = None
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == CIRCUIT_HALF_OPEN or (
+            self.state == CIRCUIT_CLOSED and self.consecutive_failures >= self.failure_threshold
+        ):
+            self.state = CIRCUIT_OPEN
+            self._opened_at = time.monotonic()
+            self._trial_started = None
+            self.opened += 1
+            logger.warning(f"🔴 {self.name}: circuit open после {self.consecutive_failures} ошибок")
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики circuit breaker"""
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "opened": self.opened,
+            "rejected": self.rejected
+        }
+
+
+class _Target:
+    """Проверяемый сервис и результат последней проверки"""
+
+    def __init__(
+        self,
+        name: str,
+        client: httpx.AsyncClient,
+        breaker: CircuitBreaker,
+        on_healthy: Optional[Callable[[], Awaitable[None]]]
+    ):
+        self.name = name
+        self.client = client
+        self.breaker = breaker
+        self.on_healthy = on_healthy
+
+        self.status = "unknown"
+        self.healthy = False
+        self.latency: Optional[float] = None
+        self.error: Optional[str] = None
+        self.checked_at: Optional[float] = None
+
+
+class HealthProber:
+    """Периодически проверяет зависимые сервисы и хранит их состояние в памяти"""
+
+    def __init__(self, interval: float, timeout: float):
+        self.interval = interval
+        self.timeout = timeout
+        self._targets: Dict[str, _Target] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def add(
+        self,
+        key: str,
+        name: str,
+        client: httpx.AsyncClient,
+        breaker: CircuitBreaker,
+        on_healthy: Optional[Callable[[], Awaitable[None]]] = None
+    ):
+        """
+        Регистрирует сервис
+
+        Args:
+            key: Ключ сервиса в ответе /health
+            name: Имя сервиса для логов
+            on_healthy: Вызывается после каждой успешной проверки
+        """
+        self._targets[key] = _Target(name, client, breaker, on_healthy)
+
+    async def start(self):
+        """Выполняет первую проверку и запускает фоновые"""
+        await self.probe_all()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def is_healthy(self, key: str) -> bool:
+        return self._targets[key].healthy
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Состояние сервисов по результатам последних проверок"""
+        now = time.time()
+        return {
+            key: {
+                "status": target.status,
+                "latency_ms": round(target.latency * 1000, 1) if target.latency is not None else None,
+                "checked_seconds_ago": round(now - target.checked_at, 1) if target.checked_at else None,
+                "error": target.error,
+                "circuit": target.breaker.state
+            }
+            for key, target in self._targets.items()
+        }
+
+    async def probe_all(self):
+        await asyncio.gather(*(self._probe(target) for target in self._targets.values()))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.probe_all()
+
+    async def _probe(self, target: _Target):
+        # В лог пишем только смену состояния, а не каждую проверку
+        state_known = target.checked_at is not None
+        was_healthy = target.healthy
+        start = time.monotonic()
+        try:
+            response = await target.client.get("/health", timeout=self.timeout)
+            target.latency = time.monotonic() - start
+            if response.status_code == 200:
+                # VLM сервис отвечает 200 и во время загрузки модели
+                target.status = response.json().get("status", "healthy")
+                target.error = None
+            else:
+                target.status = "unhealthy"
+                target.error = f"HTTP {response.status_code}"
+        except httpx.TimeoutException:
+            # Сервис жив, но не ответил вовремя (например, VLM занят генерацией)
+            target.latency = None
+            target.status = "timeout"
+            target.error = f"Нет ответа за {self.timeout}s"
+        except Exception as e:
+            target.latency = None
+            target.status = "unhealthy"
+            target.error = str(e) or type(e).__name__
+
+        target.healthy = target.status == "healthy"
+        target.checked_at = time.time()
+
+        if target.healthy:
+            target.breaker.record_success()
+            if not was_healthy or not state_known:
+                logger.info(f"✅ {target.name} доступен")
+            if target.on_healthy:
+                try:
+                    await target.on_healthy()
+                except Exception as e:
+                    logger.warning(f"⚠️  {target.name}: ошибка обработчика проверки: {e}")
+        else:
+            # Медленный ответ не размыкает цепь: запросы к занятому сервису
+            # ограничивает admission control, а не circuit breaker
+            if target.status != "timeout":
+                target.breaker.record_failure()
+            if was_healthy or not state_known:
+                logger.warning(f"⚠️  {target.name}: {target.status} ({target.error})")
@@ -0,0 +1,236 @@
+"""
+Асинхронные задачи обработки диаграмм
+Задача ставится в ограниченную очередь, клиент сразу получает ее id и
+следит за состоянием через polling или поток событий (SSE)
+"""
+
+import time
+import uuid
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, BinaryIO, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Состояния задачи
+JOB_QUEUED = "queued"
+JOB_CONVERTING = "converting"
+JOB_INFERRING = "inferring"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+FINAL_STATES = {JOB_DONE, JOB_FAILED}
+
+
+class QueueFullError(Exception):
+    """Очередь задач заполнена"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Очередь задач заполнена")
+        self.retry_after = retry_after
+
+
+class Job:
+    """Задача обработки одного файла"""
+
+    def __init__(
+        self,
+        file_name: str,
+        content_type: str,
+        file: BinaryIO,
+        file_hash: str,
+        file_size: int
+    ):
+        self.id = uuid.uuid4().hex
+        self.file_name = file_name
+        self.content_type = content_type
+        self.file: Optional[BinaryIO] = file
+        self.file_hash = file_hash
+        self.file_size = file_size
+        self.state = JOB_QUEUED
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[Dict[str, Any]] = None
+        self.events: List[Dict[str, Any]] = []
+        # Контекст трассировки запроса, поставившего задачу
+        self.trace_context: Optional[Tuple[str, str]] = None
+        self._subscribers: List[asyncio.Queue] = []
+        self._record_event()
+
+    def set_state(self, state: str):
+        """Переводит задачу в новое состояние и оповещает подписчиков"""
+        if state == self.state or self.state in FINAL_STATES:
+            return
+        self.state = state
+        if state in FINAL_STATES:
+            self.finished_at = time.time()
+            # Временный файл с содержимым больше не нужен
+            self.file.close()
+            self.file = None
+        self._record_event()
+
+    def _record_event(self):
+        event = {"state": self.state, "timestamp": time.time()}
+        self.events.append(event)
+        for queue in self._subscribers:
+            queue.put_nowait(event)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Состояние задачи для API"""
+        return {
+            "job_id": self.id,
+            "file_name": self.file_name,
+            "status": self.state,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "events": self.events,
+            "error": self.error
+        }
+
+    async def subscribe(self) -> AsyncIterator[Dict[str, Any]]:
+        """Отдает уже произошедшие события, затем новые до финального состояния"""
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers.append(queue)
+        try:
+            for event in list(self.events):
+                yield event
+            while not (queue.empty() and self.state in FINAL_STATES):
+                event = await queue.get()
+                yield event
+                if event["state"] in FINAL_STATES:
+                    break
+        finally:
+            self._subscribers.remove(queue)
+
+
+class JobManager:
+    """Очередь задач с фиксированным числом обработчиков и ограниченным хранением"""
+
+    def __init__(
+        self,
+        handler: Callable[[Job], Awaitable[Dict[str, Any]]],
+        queue_size: int,
+        workers: int,
+        retention: float,
+        max_jobs: int
+    ):
+        self.handler = handler
+        self.workers = workers
+        self.retention = retention
+        self.max_jobs = max_jobs
+
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._tasks: List[asyncio.Task] = []
+
+        # Метрики
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self._avg_duration = 0.0
+
+    async def start(self):
+        """Запускает обработчики и очистку устаревших задач"""
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._cleanup_loop()))
+
+    async def stop(self):
+        """Останавливает обработчики"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def submit(
+        self,
+        file_name: str,
+        content_type: str,
+        file: BinaryIO,
+        file_hash: str,
+        file_size: int
+    ) -> Job:
+        """
+        Ставит задачу в очередь
+
+        Args:
+            file: Временный файл с содержимым; закрывается по завершении задачи
+
+        Raises:
+            QueueFullError: очередь заполнена
+        """
+        if self._queue.full():
+            self.rejected += 1
+            raise QueueFullError(self.retry_after())
+
+        job = Job(file_name, content_type, file, file_hash, file_size)
+        self._queue.put_nowait(job)
+
+        self._jobs[job.id] = job
+        self.submitted += 1
+        self._evict()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Возвращает задачу по id"""
+        return self._jobs.get(job_id)
+
+    def retry_after(self) -> int:
+        """Оценка времени (сек), через которое в очереди освободится место"""
+        if not self._avg_duration:
+            return 1
+        return max(1, int(self._avg_duration * self._queue.qsize() / self.workers))
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики очереди задач"""
+        return {
+            "queue_depth": self._queue.qsize(),
+            "stored_jobs": len(self._jobs),
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_job_duration": round(self._avg_duration, 2)
+        }
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            started = time.monotonic()
+            try:
+                job.result = await self.handler(job)
+                job.set_state(JOB_DONE)
+                self.completed += 1
+            except asyncio.CancelledError:
+                job.error = {"status_code": 503, "detail": "Сервис остановлен"}
+                job.set_state(JOB_FAILED)
+                raise
+            except Exception as e:
+                job.error = {
+                    "status_code": getattr(e, "status_code", 500),
+                    "detail": getattr(e, "detail", str(e))
+                }
+                job.set_state(JOB_FAILED)
+                self.failed += 1
+
+            # Скользящее среднее длительности для оценки Retry-After
+            duration = time.monotonic() - started
+            self._avg_duration = (
+                duration if not self._avg_duration
+                else 0.8 * self._avg_duration + 0.2 * duration
+            )
+
+    def _evict(self):
+        """Удаляет завершенные задачи старше retention или сверх max_jobs"""
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.state not in FINAL_STATES:
+                continue
+            if len(self._jobs) > self.max_jobs or now - job.finished_at > self.retention:
+                del self._jobs[job_id]
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(min(self.retention, 60))
+            self._evict()
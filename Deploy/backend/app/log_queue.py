@@ -0,0 +1,285 @@
+"""
+Фоновая очередь логирования запросов в DB сервис
+Записи отправляются пачками; при недоступности БД сохраняются в локальный
+spool-файл (JSONL, только дозапись) и переотправляются позже. Пачку,
+отклоненную DB сервисом (4xx), повтор не исправит - она отбрасывается.
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from health import CircuitBreaker
+from metrics import DB_LOGGING_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Маркер остановки фоновой задачи
+_STOP = object()
+
+
+class InferenceLogQueue:
+    """Неблокирующая очередь записей inference_logs с пакетной отправкой"""
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        max_size: int,
+        batch_size: int,
+        flush_interval: float,
+        spool_path: str,
+        replay_interval: float,
+        stop_timeout: float = 10,
+        breaker: Optional[CircuitBreaker] = None
+    ):
+        self.client = client
+        self.breaker = breaker
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_path = spool_path
+        self.replay_interval = replay_interval
+        self.stop_timeout = stop_timeout
+
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self._task: Optional[asyncio.Task] = None
+        self._last_replay = 0.0
+
+        # Метрики
+        self.sent = 0
+        self.spooled = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.failed_flushes = 0
+
+    def enqueue(self, record: Dict[str, Any]):
+        """Добавляет запись в очередь, не дожидаясь записи в БД"""
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            # Очередь переполнена - сразу сохраняем на диск
+            self._spool([record])
+
+    async def start(self):
+        """Запускает фоновую отправку"""
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Останавливает отправку и сбрасывает оставшиеся записи
+
+        Фоновая задача получает до stop_timeout секунд на текущую пачку
+        (при переполненной очереди - и на то, чтобы освободить место для
+        маркера остановки). Отмененная задача сохраняет пачку в spool.
+        """
+        if self._task:
+            deadline = time.monotonic() + self.stop_timeout
+            try:
+                await asyncio.wait_for(self._queue.put(_STOP), self.stop_timeout)
+                await asyncio.wait_for(self._task, max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                logger.warning("⚠️  Отправка логов не завершилась вовремя, остаток сохраняется в spool")
+            if not self._task.done():
+                self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+        batch = self._drain()
+        while batch:
+            await self._flush(batch)
+            batch = self._drain()
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики очереди"""
+        return {
+            "queue_depth": self._queue.qsize(),
+            "sent": self.sent,
+            "spooled": self.spooled,
+            "replayed": self.replayed,
+            "dropped": self.dropped,
+            "failed_flushes": self.failed_flushes,
+            "spool_size_bytes": self._spool_size()
+        }
+
+    def _drain(self) -> List[Dict[str, Any]]:
+        batch = []
+        while len(batch) < self.batch_size and not self._queue.empty():
+            record = self._queue.get_nowait()
+            if record is not _STOP:
+                batch.append(record)
+        return batch
+
+    async def _run(self):
+        while True:
+            # Ждем первую запись, затем добираем пачку до размера или таймаута.
+            # Без новых записей периодически пробуем переотправить spool
+            try:
+                first = await asyncio.wait_for(self._queue.get(), self.replay_interval)
+            except asyncio.TimeoutError:
+                await self._maybe_replay()
+                continue
+
+            if first is _STOP:
+                return
+
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            stopping = False
+
+            try:
+                while len(batch) < self.batch_size:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        record = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    if record is _STOP:
+                        stopping = True
+                        break
+                    batch.append(record)
+            except asyncio.CancelledError:
+                # Остановка сервиса: набранная пачка не должна потеряться
+                self._spool(batch)
+                raise
+
+            if await self._flush(batch) and not stopping:
+                await self._maybe_replay()
+            if stopping:
+                return
+
+    async def _send(self, batch: List[Dict[str, Any]]) -> Optional[int]:
+        """
+        Отправляет пачку в DB сервис
+
+        Returns:
+            Число сохраненных записей или None, если пачку нужно отправить
+            позже (DB сервис недоступен или вернул 5xx). Записи, отклоненные
+            DB сервисом, учитываются в dropped.
+        """
+        # Пока DB сервис недоступен, сразу пишем в spool, не дожидаясь таймаута
+        if self.breaker and not self.breaker.allow():
+            return None
+        start = time.perf_counter()
+        try:
+            response = await self.client.post("/log/batch", json={"records": batch})
+            available = response.status_code < 500
+            ok = response.status_code == 200
+        except httpx.HTTPError as e:
+            logger.warning(f"⚠️  DB Service недоступен для логирования: {e}")
+            response = None
+            available = ok = False
+        DB_LOGGING_SECONDS.labels("success" if ok else "error").observe(time.perf_counter() - start)
+        if self.breaker:
+            if available:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+        if not available:
+            return None
+        if not ok:
+            # Повтор даст тот же ответ и заблокирует переотправку spool
+            self.dropped += len(batch)
+            logger.error(
+                f"❌ DB Service отклонил пачку логов ({response.status_code}), "
+                f"потеряно {len(batch)}: {response.text[:500]}"
+            )
+            return 0
+
+        try:
+            failed = response.json().get("failed") or []
+        except (ValueError, AttributeError):
+            failed = []
+        if failed:
+            self.dropped += len(failed)
+            logger.error(f"❌ DB Service не сохранил {len(failed)} записей пачки: {failed}")
+        return len(batch) - len(failed)
+
+    async def _flush(self, batch: List[Dict[str, Any]]) -> bool:
+        try:
+            saved = await self._send(batch)
+        except asyncio.CancelledError:
+            # Остановка во время отправки: DB сервис мог уже сохранить пачку,
+            # но повтор из spool по record_id дублей не создаст
+            self._spool(batch)
+            raise
+        if saved is not None:
+            self.sent += saved
+            return True
+
+        self.failed_flushes += 1
+        self._spool(batch)
+        return False
+
+    def _spool(self, records: List[Dict[str, Any]]):
+        """Дописывает записи в spool-файл"""
+        try:
+            os.makedirs(os.path.dirname(self.spool_path) or ".", exist_ok=True)
+            with open(self.spool_path, "a", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.spooled += len(records)
+            logger.warning(f"💾 {len(records)} записей сохранено в spool: {self.spool_path}")
+        except OSError as e:
+            self.dropped += len(records)
+            logger.error(f"❌ Не удалось сохранить записи в spool, потеряно {len(records)}: {e}")
+
+    def _spool_size(self) -> int:
+        try:
+            return os.path.getsize(self.spool_path)
+        except OSError:
+            return 0
+
+    async def _maybe_replay(self):
+        """Переотправляет записи из spool-файла после восстановления БД"""
+        if time.monotonic() - self._last_replay < self.replay_interval:
+            return
+        self._last_replay = time.monotonic()
+
+        # Забираем файл целиком: новые записи пойдут уже в свежий spool.
+        # Файл, оставшийся от прерванной переотправки, обрабатываем первым
+        replay_path = f"{self.spool_path}.replay"
+        try:
+            if not os.path.exists(replay_path):
+                if not self._spool_size():
+                    return
+                os.replace(self.spool_path, replay_path)
+            with open(replay_path, encoding="utf-8") as f:
+                lines = [line for line in f if line.strip()]
+        except OSError as e:
+            logger.error(f"❌ Не удалось прочитать spool: {e}")
+            return
+
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Оборванная строка после аварийной остановки
+                self.dropped += 1
+
+        logger.info(f"🔁 Переотправка {len(records)} записей из spool")
+        for start in range(0, len(records), self.batch_size):
+            batch = records[start:start + self.batch_size]
+            saved = await self._send(batch)
+            if saved is None:
+                # БД снова недоступна - возвращаем остаток в spool
+                remaining = records[start:]
+                self.spooled -= len(remaining)
+                self._spool(remaining)
+                break
+            self.replayed += saved
+
+        try:
+            os.remove(replay_path)
+        except OSError as e:
+            # Оставшийся файл будет переотправлен еще раз при следующей попытке
+            logger.warning(f"⚠️  Не удалось удалить переотправленный spool {replay_path}: {e}")
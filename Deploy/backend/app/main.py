@@ -4,16 +4,53 @@ Backend API Service - координирует работу микросерви
 """
 
 import os
-import hashlib
+import json
+import time
+import uuid
+import asyncio
 import logging
+import mimetypes
+import zipfile
+import zlib
 from datetime import datetime
-from typing import Optional
+from typing import Optional, Dict, Any, List, Callable, BinaryIO, Union
 from contextlib import asynccontextmanager
 
 import httpx
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel
+from starlette.formparsers import MultiPartParser
+
+from cache import ResultCache, build_model_key
+from singleflight import SingleFlight
+from uploads import BodySizeLimitMiddleware, hash_file, read_limited, spool_copy
+from blob_store import BlobRef, BlobStore, is_valid_blob_hash
+from tracing import (
+    TraceMiddleware, TraceIdLogFilter, configure_tracing, shutdown_tracing, tracing_stats,
+    current_context, current_trace_id, record_span, span, trace_headers, REQUEST_ID_HEADER
+)
+from deadlines import (
+    ClientDisconnected, SharedDeadline, deadline_at, deadline_expired, deadline_scope, is_expired,
+    remaining_time, run_until_disconnect, DEADLINE_HEADER
+)
+from perceptual import PerceptualIndex, compute_dhash, MAX_SEARCH_DISTANCE
+from metrics import (
+    UploadTimingMiddleware, observe_request, observe_stage, render_metrics, stage_timer,
+    CANCELLED_REQUESTS, NEAR_DUPLICATE_HITS, STAGE_HASHING, STAGE_CACHE_LOOKUP, STAGE_PERCEPTUAL_HASH,
+    STAGE_NEAR_DUPLICATE_LOOKUP, STAGE_CONVERSION, STAGE_VLM_QUEUE_WAIT, STAGE_VLM_INFERENCE
+)
+from health import CircuitBreaker, CircuitOpenError, HealthProber
+from vlm_pool import VLMPool, VLMReplica
+from log_queue import InferenceLogQueue
+from admission import (
+    AdmissionController, AdmissionRejected, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+)
+from jobs import (
+    Job, JobManager, QueueFullError,
+    JOB_CONVERTING, JOB_INFERRING, JOB_DONE, JOB_FAILED
+)
 
 # Импорт модуля базы данных будет через HTTP запросы к DB сервису
 DB_SERVICE_URL = os.getenv("DB_SERVICE_URL", "http://database:8003")
@@ -21,14 +58,100 @@ DB_SERVICE_URL = os.getenv("DB_SERVICE_URL", "http://database:8003")
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s'
 )
+for handler in logging.getLogger().handlers:
+    handler.addFilter(TraceIdLogFilter())
 logger = logging.getLogger(__name__)
 
 # Конфигурация из переменных окружения
 VLM_SERVICE_URL = os.getenv("VLM_SERVICE_URL", "http://localhost:8002")
+# Несколько реплик VLM сервиса через запятую (по умолчанию - одна VLM_SERVICE_URL)
+VLM_SERVICE_URLS = [
+    url.strip() for url in os.getenv("VLM_SERVICE_URLS", VLM_SERVICE_URL).split(",")
+    if url.strip()
+]
 ADAPTER_SERVICE_URL = os.getenv("ADAPTER_SERVICE_URL", "http://localhost:8001")
 REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "120"))
+# Период проверки, не закрыл ли клиент соединение во время обработки
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.5"))
+
+# Пул HTTP соединений к зависимым сервисам
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+ADAPTER_TIMEOUT = float(os.getenv("ADAPTER_TIMEOUT", str(REQUEST_TIMEOUT)))
+VLM_TIMEOUT = float(os.getenv("VLM_TIMEOUT", str(REQUEST_TIMEOUT)))
+DB_TIMEOUT = float(os.getenv("DB_TIMEOUT", "5"))
+HEALTH_CHECK_TIMEOUT = float(os.getenv("HEALTH_CHECK_TIMEOUT", "5"))
+
+# Балансировка между репликами VLM и дублирование медленных запросов
+VLM_HEDGE_PERCENTILE = float(os.getenv("VLM_HEDGE_PERCENTILE", "0"))
+VLM_HEDGE_MIN_SAMPLES = int(os.getenv("VLM_HEDGE_MIN_SAMPLES", "20"))
+VLM_HEDGE_MAX_BYTES = int(os.getenv("VLM_HEDGE_MAX_BYTES", str(20 * 1024 * 1024)))
+VLM_LATENCY_WINDOW = int(os.getenv("VLM_LATENCY_WINDOW", "200"))
+
+# Фоновая проверка зависимостей и circuit breaker
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "10"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "3"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+
+# Кэш результатов распознавания
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1024"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "3600"))
+RESULT_CACHE_DB_LOOKUP = os.getenv("RESULT_CACHE_DB_LOOKUP", "true").lower() == "true"
+MODEL_INFO_TTL = float(os.getenv("MODEL_INFO_TTL", "60"))
+
+# Поиск почти одинаковых изображений по перцептивному хэшу (dHash)
+PHASH_CACHE_ENABLED = os.getenv("PHASH_CACHE_ENABLED", "true").lower() == "true"
+PHASH_MAX_DISTANCE = min(int(os.getenv("PHASH_MAX_DISTANCE", "4")), MAX_SEARCH_DISTANCE)
+PHASH_MAX_AGE_HOURS = float(os.getenv("PHASH_MAX_AGE_HOURS", "168"))
+
+# Фоновое логирование в DB сервис
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "50"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1"))
+LOG_SPOOL_PATH = os.getenv("LOG_SPOOL_PATH", "/spool/inference-logs.jsonl")
+LOG_REPLAY_INTERVAL = float(os.getenv("LOG_REPLAY_INTERVAL", "30"))
+LOG_STOP_TIMEOUT = float(os.getenv("LOG_STOP_TIMEOUT", "10"))
+
+# Пакетная обработка
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "500"))
+BATCH_MAX_TOTAL_SIZE = int(os.getenv("BATCH_MAX_TOTAL_SIZE", str(500 * 1024 * 1024)))
+
+# Асинхронные задачи
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", "3600"))
+JOB_MAX_STORED = int(os.getenv("JOB_MAX_STORED", "1000"))
+
+# Admission control перед VLM сервисом; реплика объединяет до VLM_BATCH_SIZE
+# одновременных запросов в батч (BATCH_MAX_SIZE VLM сервиса), а за одним
+# адресом диспетчера VLM работают VLM_WORKERS процессов
+VLM_BATCH_SIZE = int(os.getenv("VLM_BATCH_SIZE", "4"))
+VLM_WORKERS = int(os.getenv("VLM_WORKERS", "1"))
+ADMISSION_MAX_CONCURRENCY = int(os.getenv(
+    "ADMISSION_MAX_CONCURRENCY", str(len(VLM_SERVICE_URLS) * VLM_WORKERS * VLM_BATCH_SIZE)
+))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "50"))
+ADMISSION_CLIENT_RATE = float(os.getenv("ADMISSION_CLIENT_RATE", "2"))
+ADMISSION_CLIENT_BURST = float(os.getenv("ADMISSION_CLIENT_BURST", "10"))
+ADMISSION_INITIAL_SERVICE_TIME = float(os.getenv("ADMISSION_INITIAL_SERVICE_TIME", "10"))
+
+# Загрузка файлов
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(50 * 1024 * 1024)))
+UPLOAD_SPOOL_THRESHOLD = int(os.getenv("UPLOAD_SPOOL_THRESHOLD", str(1024 * 1024)))
+
+# Загрузки крупнее порога парсер multipart сразу пишет на диск
+MultiPartParser.spool_max_size = UPLOAD_SPOOL_THRESHOLD
+
+# Общий том для передачи файлов Adapter и VLM сервисам по хэшу
+# (пусто - содержимое передается по HTTP)
+BLOB_STORE_PATH = os.getenv("BLOB_STORE_PATH", "")
+BLOB_STORE_TTL = float(os.getenv("BLOB_STORE_TTL", "3600"))
+BLOB_CLEANUP_INTERVAL = float(os.getenv("BLOB_CLEANUP_INTERVAL", "600"))
 
 # Поддерживаемые форматы файлов
 SUPPORTED_IMAGE_FORMATS = {'.png', '.jpg', '.jpeg', '.gif', '.bmp'}
@@ -39,6 +162,64 @@ ALL_SUPPORTED_FORMATS = SUPPORTED_IMAGE_FORMATS | SUPPORTED_DIAGRAM_FORMATS
 total_requests = 0
 successful_requests = 0
 failed_requests = 0
+# Запросы, прерванные по дедлайну или из-за отключения клиента
+cancelled_requests = {"deadline": 0, "client_disconnect": 0}
+
+# Метрики кэша
+cache_memory_hits = 0
+cache_db_hits = 0
+cache_misses = 0
+near_duplicate_memory_hits = 0
+near_duplicate_db_hits = 0
+
+# Кэш результатов и информация о текущей модели VLM
+result_cache = ResultCache(max_size=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
+model_info: Optional[Dict[str, Any]] = None
+model_info_updated_at = 0.0
+
+# Перцептивные хэши изображений, результаты которых есть в кэше
+phash_index = PerceptualIndex(max_size=RESULT_CACHE_SIZE)
+
+# Выполняющиеся инференсы по хэшу файла (объединение одинаковых загрузок)
+inflight_inferences = SingleFlight()
+# Дедлайны выполняющихся инференсов: самый поздний из ожидающих запросов
+flight_deadlines: Dict[str, SharedDeadline] = {}
+
+# Доступ к VLM сервису: лимит параллелизма, приоритеты и квоты клиентов
+admission = AdmissionController(
+    max_concurrency=ADMISSION_MAX_CONCURRENCY,
+    max_queue=ADMISSION_MAX_QUEUE,
+    client_rate=ADMISSION_CLIENT_RATE,
+    client_burst=ADMISSION_CLIENT_BURST,
+    initial_service_time=ADMISSION_INITIAL_SERVICE_TIME
+)
+
+# Circuit breaker на каждый зависимый сервис (у реплик VLM - свои, в пуле)
+adapter_breaker = CircuitBreaker("Adapter Service", CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+db_breaker = CircuitBreaker("DB Service", CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+
+# Коды ответа, означающие недоступность сервиса (а не ошибку во входных данных)
+UPSTREAM_FAILURE_STATUSES = {502, 503, 504}
+
+# Реплики VLM сервиса (создаются в lifespan)
+vlm_pool: Optional[VLMPool] = None
+
+# Фоновая проверка зависимостей (создается в lifespan)
+health_prober: Optional[HealthProber] = None
+
+# Долгоживущие HTTP клиенты (создаются в lifespan)
+adapter_client: Optional[httpx.AsyncClient] = None
+db_client: Optional[httpx.AsyncClient] = None
+
+# Очередь записей для DB сервиса (создается в lifespan)
+log_queue: Optional[InferenceLogQueue] = None
+
+# Очередь асинхронных задач (создается в lifespan)
+job_manager: Optional[JobManager] = None
+
+# Хранилище файлов на общем томе (создается в lifespan, если настроено)
+blob_store: Optional[BlobStore] = None
+blob_cleanup_task: Optional[asyncio.Task] = None
 
 
 def get_file_extension(filename: str) -> str:
@@ -46,46 +227,259 @@ def get_file_extension(filename: str) -> str:
     return os.path.splitext(filename)[1].lower() if filename else ''
 
 
-def calculate_file_hash(content: bytes) -> str:
-    """Вычисляет SHA256 хэш содержимого файла"""
-    return hashlib.sha256(content).hexdigest()
+def get_client_id(request: Request) -> str:
+    """Идентификатор клиента для квот: заголовок X-Client-ID или IP адрес"""
+    client_id = request.headers.get("X-Client-ID")
+    if client_id:
+        return client_id
+    return request.client.host if request.client else "unknown"
 
 
-async def check_service_health(service_url: str, service_name: str) -> bool:
-    """Проверяет доступность сервиса"""
+def admission_error(e: AdmissionRejected) -> HTTPException:
+    """Преобразует отказ admission control в HTTP ответ с Retry-After"""
+    logger.warning(f"🚦 Запрос отклонен ({e.reason}), повтор через {e.retry_after}s")
+    return HTTPException(
+        status_code=e.status_code,
+        detail=e.detail,
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+
+@asynccontextmanager
+async def vlm_slot(
+    client_id: Optional[str],
+    priority: str,
+    deadline: float,
+    file_type: Optional[str] = None
+):
+    """
+    Слот для вызова VLM сервиса
+    
+    Args:
+        client_id: Клиент, с квоты которого списывается вызов (None - уже списано)
+        priority: PRIORITY_INTERACTIVE или PRIORITY_BATCH
+        deadline: Момент (time.monotonic()), к которому запрос должен завершиться
+        file_type: Тип файла для метрик
+    
+    Raises:
+        HTTPException: 429 при превышении квоты, 503 при перегрузке
+    """
+    wait_start = time.perf_counter()
+    wait_started_at = time.time()
     try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.get(f"{service_url}/health")
-            if response.status_code == 200:
-                logger.info(f"✅ {service_name} доступен")
-                return True
-            else:
-                logger.warning(f"⚠️  {service_name} вернул статус {response.status_code}")
-                return False
-    except Exception as e:
-        logger.error(f"❌ {service_name} недоступен: {e}")
-        return False
+        async with admission.slot(client_id, priority, deadline):
+            observe_stage(
+                STAGE_VLM_QUEUE_WAIT, file_type, current_model_name(), "success",
+                time.perf_counter() - wait_start
+            )
+            record_span(STAGE_VLM_QUEUE_WAIT, wait_started_at, time.time(), priority=priority)
+            yield
+    except AdmissionRejected as e:
+        observe_stage(
+            STAGE_VLM_QUEUE_WAIT, file_type, current_model_name(), "rejected",
+            time.perf_counter() - wait_start
+        )
+        record_span(
+            STAGE_VLM_QUEUE_WAIT, wait_started_at, time.time(), "error",
+            priority=priority, reason=e.reason
+        )
+        raise admission_error(e)
+
+
+async def inject_trace_headers(request: httpx.Request):
+    """Передает контекст трассировки текущего запроса в зависимый сервис"""
+    request.headers.update(trace_headers())
+
+
+async def apply_deadline(request: httpx.Request):
+    """
+    Передает зависимому сервису оставшееся до дедлайна время и не ждет
+    ответ дольше него
+    """
+    remaining = remaining_time()
+    if remaining is None:
+        return
+    remaining = max(0.0, remaining)
+    request.headers[DEADLINE_HEADER] = str(int(remaining * 1000))
+    timeout = dict(request.extensions.get("timeout", {}))
+    read_timeout = timeout.get("read")
+    timeout["read"] = remaining if read_timeout is None else min(read_timeout, remaining)
+    request.extensions["timeout"] = timeout
+
+
+def record_cancellation(reason: str):
+    """Учитывает запрос, прерванный по дедлайну или из-за отключения клиента"""
+    cancelled_requests[reason] += 1
+    CANCELLED_REQUESTS.labels(reason).inc()
+
+
+def create_http_client(base_url: str, timeout: float) -> httpx.AsyncClient:
+    """Создает HTTP клиент с пулом keep-alive соединений к одному сервису"""
+    return httpx.AsyncClient(
+        base_url=base_url,
+        event_hooks={"request": [inject_trace_headers, apply_deadline]},
+        timeout=httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        )
+    )
+
+
+def record_upstream_status(breaker: CircuitBreaker, status_code: int):
+    """Учитывает ответ сервиса в его circuit breaker"""
+    if status_code in UPSTREAM_FAILURE_STATUSES:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+
+def circuit_error(e: CircuitOpenError) -> HTTPException:
+    """Преобразует отказ circuit breaker в HTTP ответ 503 с Retry-After"""
+    logger.warning(f"🔴 {e.name} недоступен, запрос отклонен без обращения к сервису")
+    return HTTPException(
+        status_code=503,
+        detail=f"{e.name} недоступен",
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+
+def check_circuit(breaker: CircuitBreaker):
+    """
+    Пропускает запрос к сервису, только если его цепь не разомкнута
+    
+    Raises:
+        HTTPException: 503 с Retry-After, пока сервис считается недоступным
+    """
+    try:
+        breaker.check()
+    except CircuitOpenError as e:
+        raise circuit_error(e)
+
+
+def create_vlm_pool() -> VLMPool:
+    """Создает пул реплик VLM сервиса с отдельным клиентом и breaker у каждой"""
+    replicas = []
+    for index, url in enumerate(VLM_SERVICE_URLS, start=1):
+        key = "vlm" if len(VLM_SERVICE_URLS) == 1 else f"vlm_{index}"
+        replicas.append(VLMReplica(
+            key=key,
+            url=url,
+            client=create_http_client(url, VLM_TIMEOUT),
+            breaker=CircuitBreaker(
+                f"VLM Service ({url})", CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT
+            ),
+            latency_window=VLM_LATENCY_WINDOW
+        ))
+    return VLMPool(
+        replicas,
+        hedge_percentile=VLM_HEDGE_PERCENTILE,
+        hedge_min_samples=VLM_HEDGE_MIN_SAMPLES,
+        latency_window=VLM_LATENCY_WINDOW
+    )
+
+
+def vlm_healthy() -> bool:
+    """Доступна ли хотя бы одна реплика VLM сервиса"""
+    return any(health_prober.is_healthy(replica.key) for replica in vlm_pool.replicas)
+
+
+async def run_blob_cleanup():
+    """Периодически удаляет из хранилища давно не использованные файлы"""
+    while True:
+        await asyncio.sleep(BLOB_CLEANUP_INTERVAL)
+        try:
+            removed = await asyncio.to_thread(blob_store.cleanup, BLOB_STORE_TTL)
+            if removed:
+                logger.info(f"🗑️  Удалено файлов из хранилища: {removed}")
+        except Exception as e:
+            logger.warning(f"⚠️  Ошибка очистки хранилища файлов: {e}")
+
+
+async def store_blob(file: BinaryIO, file_hash: str) -> Union[BinaryIO, BlobRef]:
+    """
+    Кладет файл в общее хранилище, чтобы передавать сервисам только хэш
+    
+    Returns:
+        Ссылка на файл в хранилище или сам файл, если хранилище не настроено
+        или недоступно
+    """
+    if blob_store is None:
+        return file
+    try:
+        return await asyncio.to_thread(blob_store.put_file, file, file_hash)
+    except OSError as e:
+        logger.warning(f"⚠️  Не удалось сохранить файл в хранилище, передаем по HTTP: {e}")
+        return file
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Управление жизненным циклом приложения"""
+    global adapter_client, db_client, vlm_pool, log_queue, job_manager, health_prober
+    global blob_store, blob_cleanup_task
+    
     # Startup
     logger.info("=" * 60)
     logger.info("🚀 Запуск Backend API Service")
     logger.info("=" * 60)
-    logger.info(f"🔗 VLM Service: {VLM_SERVICE_URL}")
+    logger.info(f"🔗 VLM Service: {', '.join(VLM_SERVICE_URLS)}")
     logger.info(f"🔗 Adapter Service: {ADAPTER_SERVICE_URL}")
     logger.info(f"⏱️  Request Timeout: {REQUEST_TIMEOUT}s")
+    logger.info(f"🔌 HTTP пул: {HTTP_MAX_CONNECTIONS} соединений, "
+                f"{HTTP_MAX_KEEPALIVE_CONNECTIONS} keep-alive ({HTTP_KEEPALIVE_EXPIRY}s)")
+    logger.info(f"🚦 Admission: {ADMISSION_MAX_CONCURRENCY} одновременно, "
+                f"очередь {ADMISSION_MAX_QUEUE}, {ADMISSION_CLIENT_RATE} req/s на клиента")
     logger.info("=" * 60)
     
-    # Проверяем доступность сервисов
-    vlm_available = await check_service_health(VLM_SERVICE_URL, "VLM Service")
-    adapter_available = await check_service_health(ADAPTER_SERVICE_URL, "Adapter Service")
+    configure_tracing("backend")
+    
+    # Создаем HTTP клиенты, переиспользуемые всеми запросами
+    adapter_client = create_http_client(ADAPTER_SERVICE_URL, ADAPTER_TIMEOUT)
+    vlm_pool = create_vlm_pool()
+    db_client = create_http_client(DB_SERVICE_URL, DB_TIMEOUT)
     
-    if not vlm_available:
+    log_queue = InferenceLogQueue(
+        client=db_client,
+        max_size=LOG_QUEUE_SIZE,
+        batch_size=LOG_BATCH_SIZE,
+        flush_interval=LOG_FLUSH_INTERVAL,
+        spool_path=LOG_SPOOL_PATH,
+        replay_interval=LOG_REPLAY_INTERVAL,
+        stop_timeout=LOG_STOP_TIMEOUT,
+        breaker=db_breaker
+    )
+    await log_queue.start()
+    
+    job_manager = JobManager(
+        handler=run_job,
+        queue_size=JOB_QUEUE_SIZE,
+        workers=JOB_WORKERS,
+        retention=JOB_RETENTION,
+        max_jobs=JOB_MAX_STORED
+    )
+    await job_manager.start()
+    
+    if BLOB_STORE_PATH:
+        blob_store = BlobStore(BLOB_STORE_PATH)
+        blob_cleanup_task = asyncio.create_task(run_blob_cleanup())
+        logger.info(f"📦 Файлы передаются сервисам через общий том: {BLOB_STORE_PATH}")
+    
+    # Проверяем доступность сервисов и запускаем фоновые проверки
+    health_prober = HealthProber(interval=HEALTH_CHECK_INTERVAL, timeout=HEALTH_CHECK_TIMEOUT)
+    for replica in vlm_pool.replicas:
+        health_prober.add(
+            replica.key, f"VLM Service ({replica.url})", replica.client, replica.breaker,
+            on_healthy=refresh_model_info
+        )
+    health_prober.add("adapter", "Adapter Service", adapter_client, adapter_breaker)
+    health_prober.add("database", "DB Service", db_client, db_breaker)
+    await health_prober.start()
+    
+    if not vlm_healthy():
         logger.warning("⚠️  VLM Service недоступен при старте")
-    if not adapter_available:
+    if not health_prober.is_healthy("adapter"):
         logger.warning("⚠️  Adapter Service недоступен при старте")
     
     logger.info("✅ Backend API готов к работе")
@@ -94,9 +488,18 @@ async def lifespan(app: FastAPI):
     
     # Shutdown
     logger.info("🛑 Остановка Backend API Service")
+    await health_prober.stop()
+    if blob_cleanup_task:
+        blob_cleanup_task.cancel()
+        await asyncio.gather(blob_cleanup_task, return_exceptions=True)
+    await job_manager.stop()
+    await log_queue.stop()
+    for client in (adapter_client, db_client, *(r.client for r in vlm_pool.replicas)):
+        await client.aclose()
     logger.info(f"📊 Всего запросов: {total_requests}")
     logger.info(f"✅ Успешных: {successful_requests}")
     logger.info(f"❌ Ошибок: {failed_requests}")
+    shutdown_tracing()
 
 
 # Создание FastAPI приложения
@@ -107,6 +510,20 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# Ограничение размера тела запроса (до чтения загрузки целиком)
+app.add_middleware(
+    BodySizeLimitMiddleware,
+    max_body_size=MAX_UPLOAD_SIZE,
+    path_limits={"/api/v1/process/batch": BATCH_MAX_TOTAL_SIZE}
+)
+
+# Время получения загрузок от клиента
+app.add_middleware(
+    UploadTimingMiddleware,
+    paths={"/api/v1/process", "/api/v1/process/stream", "/api/v1/process/batch", "/api/v1/jobs"},
+    model_name=lambda: current_model_name()
+)
+
 # Настройка CORS для фронтенда
 app.add_middleware(
     CORSMiddleware,
@@ -114,8 +531,12 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[REQUEST_ID_HEADER],
 )
 
+# Span на каждый запрос, id запроса возвращается в X-Request-ID
+app.add_middleware(TraceMiddleware)
+
 
 @app.get("/")
 async def root():
@@ -126,8 +547,17 @@ async def root():
         "status": "running",
         "endpoints": {
             "process": "/api/v1/process (POST)",
+            "process_stream": "/api/v1/process/stream (POST, SSE)",
+            "process_batch": "/api/v1/process/batch (POST)",
+            "result_by_hash": "/api/v1/results/{file_hash} (GET)",
+            "results_lookup": "/api/v1/results/lookup (POST)",
+            "jobs": "/api/v1/jobs (POST)",
+            "job_status": "/api/v1/jobs/{job_id} (GET)",
+            "job_result": "/api/v1/jobs/{job_id}/result (GET)",
+            "job_events": "/api/v1/jobs/{job_id}/events (GET, SSE)",
             "health": "/health (GET)",
             "metrics": "/metrics (GET)",
+            "metrics_prometheus": "/metrics/prometheus (GET)",
             "docs": "/docs"
         }
     }
@@ -135,18 +565,26 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    """Проверка здоровья сервиса и зависимостей"""
-    vlm_healthy = await check_service_health(VLM_SERVICE_URL, "VLM Service")
-    adapter_healthy = await check_service_health(ADAPTER_SERVICE_URL, "Adapter Service")
+    """
+    Проверка здоровья сервиса и зависимостей
+    
+    Отвечает из памяти по результатам фоновых проверок, не обращаясь
+    к зависимым сервисам.
+    """
+    details = health_prober.snapshot()
+    overall_status = "healthy" if vlm_healthy() else "degraded"
     
-    overall_status = "healthy" if vlm_healthy else "degraded"
+    services = {
+        key: "healthy" if info["status"] == "healthy" else "unhealthy"
+        for key, info in details.items()
+    }
+    # Сводный статус VLM: достаточно одной доступной реплики
+    services["vlm"] = "healthy" if vlm_healthy() else "unhealthy"
     
     return {
         "status": overall_status,
-        "services": {
-            "vlm": "healthy" if vlm_healthy else "unhealthy",
-            "adapter": "healthy" if adapter_healthy else "unhealthy"
-        },
+        "services": services,
+        "details": details,
         "timestamp": datetime.utcnow().isoformat()
     }
 
@@ -159,291 +597,1718 @@ async def get_metrics():
         if total_requests > 0 else 0
     )
     
+    cache_lookups = cache_memory_hits + cache_db_hits + cache_misses
+    cache_hit_ratio = (
+        ((cache_memory_hits + cache_db_hits) / cache_lookups * 100)
+        if cache_lookups > 0 else 0
+    )
+    
     return {
         "total_requests": total_requests,
         "successful_requests": successful_requests,
         "failed_requests": failed_requests,
-        "success_rate": round(success_rate, 2)
+        "success_rate": round(success_rate, 2),
+        "cache": {
+            "memory_hits": cache_memory_hits,
+            "db_hits": cache_db_hits,
+            "misses": cache_misses,
+            "hit_ratio": round(cache_hit_ratio, 2),
+            "memory_hit_ratio": round(
+                cache_memory_hits / cache_lookups * 100 if cache_lookups > 0 else 0, 2
+            ),
+            "size": len(result_cache),
+            "near_duplicate_hits": {
+                "memory": near_duplicate_memory_hits,
+                "db": near_duplicate_db_hits
+            },
+            "phash_index_size": len(phash_index)
+        },
+        "cancelled_requests": cancelled_requests,
+        "coalesced_requests": inflight_inferences.coalesced,
+        "inflight_inferences": len(inflight_inferences),
+        "admission": admission.stats(),
+        "circuits": {
+            **{replica.key: replica.breaker.stats() for replica in vlm_pool.replicas},
+            "adapter": adapter_breaker.stats(),
+            "database": db_breaker.stats()
+        },
+        "vlm_pool": vlm_pool.stats(),
+        "db_logging": log_queue.stats(),
+        "jobs": job_manager.stats(),
+        "blob_store": blob_store.stats() if blob_store else None,
+        "tracing": tracing_stats()
     }
 
 
-@app.post("/api/v1/process")
-async def process_diagram(file: UploadFile = File(...)):
+@app.get("/metrics/prometheus")
+async def get_prometheus_metrics():
+    """Гистограммы длительности этапов в формате Prometheus"""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
+async def refresh_model_info():
     """
-    Основной эндпоинт для обработки диаграмм
+    Обновляет информацию о модели VLM сервиса, если она устарела
     
-    Принимает файл диаграммы, определяет тип, конвертирует если нужно,
-    отправляет на распознавание в VLM сервис и возвращает результат.
+    Вызывается фоновой проверкой здоровья, поэтому запросам обычно не
+    приходится ждать ответа /model_info.
+    """
+    global model_info, model_info_updated_at
     
-    Args:
-        file: Файл диаграммы (PNG, JPG, BPMN, PlantUML, Mermaid, Draw.io)
+    if model_info is not None and time.monotonic() - model_info_updated_at <= MODEL_INFO_TTL:
+        return
+    replica = vlm_pool.peek()
+    if replica is None:
+        # Все реплики недоступны - не ждем таймаута, работаем с тем, что есть
+        return
+    try:
+        response = await replica.client.get("/model_info", timeout=HEALTH_CHECK_TIMEOUT)
+        if response.status_code == 200:
+            model_info = response.json()
+            model_info_updated_at = time.monotonic()
+    except httpx.HTTPError as e:
+        logger.warning(f"⚠️  Не удалось получить информацию о модели: {e}")
+
+
+async def get_model_key() -> Optional[str]:
+    """
+    Возвращает ключ текущей версии модели VLM сервиса
+    
+    Информация о модели периодически обновляется, чтобы после смены
+    модели старые результаты не отдавались.
+    """
+    await refresh_model_info()
+    return build_model_key(model_info) if model_info else None
+
+
+def current_model_name() -> Optional[str]:
+    """Имя модели VLM сервиса для меток метрик (по последней полученной информации)"""
+    return model_info.get("model") if model_info else None
+
+
+def result_from_db_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Восстанавливает ответ VLM сервиса из записи inference_logs"""
+    image_size = None
+    if row.get("image_width") is not None and row.get("image_height") is not None:
+        image_size = [row["image_width"], row["image_height"]]
+    
+    return {
+        "description": row.get("description_text", ""),
+        "metadata": {
+            "inference_time": row.get("inference_time_sec", 0),
+            "generation_time": row.get("generation_time_sec", 0),
+            "image_size": image_size,
+            "model": row.get("model_name"),
+            "device": row.get("device_type"),
+            "max_tokens": row.get("max_tokens"),
+            "torch_dtype": row.get("torch_dtype")
+        }
+    }
+
+
+async def lookup_cached_result(file_hash: str, model_key: str) -> Optional[tuple]:
+    """
+    Ищет готовый результат: сначала в памяти, затем в БД
     
     Returns:
-        JSON с описанием алгоритма и метаданными
+        Кортеж (результат VLM, источник) или None при промахе
     """
-    global total_requests, successful_requests, failed_requests
+    global cache_memory_hits, cache_db_hits, cache_misses
     
-    total_requests += 1
-    request_start = datetime.utcnow()
+    cache_key = (file_hash, model_key)
     
-    logger.info("=" * 60)
-    logger.info(f"📥 Получен запрос на обработку")
-    logger.info(f"📄 Файл: {file.filename}")
-    logger.info(f"📦 Тип: {file.content_type}")
+    result = result_cache.get(cache_key)
+    if result is not None:
+        cache_memory_hits += 1
+        return result, "memory"
     
-    try:
-        # 1. Валидация файла
-        file_ext = get_file_extension(file.filename)
-        
-        if not file_ext:
-            logger.warning("⚠️  Файл без расширения")
-            raise HTTPException(
-                status_code=400,
-                detail="Файл должен иметь расширение"
-            )
-        
-        if file_ext not in ALL_SUPPORTED_FORMATS:
-            logger.warning(f"⚠️  Неподдерживаемый формат: {file_ext}")
-            raise HTTPException(
-                status_code=400,
-                detail=f"Неподдерживаемый формат файла: {file_ext}. "
-                       f"Поддерживаются: {', '.join(ALL_SUPPORTED_FORMATS)}"
-            )
-        
-        logger.info(f"✅ Формат файла: {file_ext}")
-        
-        # 2. Чтение содержимого файла
-        file_content = await file.read()
-        file_size = len(file_content)
-        file_hash = calculate_file_hash(file_content)
-        
-        logger.info(f"📊 Размер файла: {file_size / 1024:.2f} KB")
-        logger.info(f"🔑 Хэш файла: {file_hash[:16]}...")
-        
-        # 3. Определение необходимости конвертации
-        needs_conversion = file_ext in SUPPORTED_DIAGRAM_FORMATS
-        
-        if needs_conversion:
-            logger.info(f"🔄 Требуется конвертация из {file_ext} в PNG")
-            
-            # Вызов Adapter Service для конвертации
-            try:
-                async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT) as client:
-                    files = {"file": (file.filename, file_content, file.content_type)}
-                    
-                    logger.info(f"📤 Отправка в Adapter Service...")
-                    response = await client.post(
-                        f"{ADAPTER_SERVICE_URL}/convert",
-                        files=files
-                    )
-                    
-                    if response.status_code != 200:
-                        logger.error(f"❌ Adapter Service вернул ошибку: {response.status_code}")
-                        raise HTTPException(
-                            status_code=502,
-                            detail=f"Ошибка конвертации: {response.text}"
-                        )
-                    
-                    # Получаем PNG из ответа
-                    png_content = response.content
-                    logger.info(f"✅ Конвертация завершена, размер PNG: {len(png_content) / 1024:.2f} KB")
-                    
-            except httpx.TimeoutException:
-                logger.error("❌ Timeout при конвертации")
-                raise HTTPException(
-                    status_code=504,
-                    detail="Превышено время ожидания конвертации"
-                )
-            except httpx.RequestError as e:
-                logger.error(f"❌ Ошибка соединения с Adapter Service: {e}")
-                raise HTTPException(
-                    status_code=503,
-                    detail="Adapter Service недоступен"
-                )
-        else:
-            logger.info("✅ Файл уже в формате изображения, конвертация не требуется")
-            png_content = file_content
-        
-        # 4. Отправка в VLM Service для распознавания
-        logger.info("📤 Отправка в VLM Service для распознавания...")
-        
+    # Пока DB сервис недоступен, считаем промахом без обращения к нему
+    if RESULT_CACHE_DB_LOOKUP and db_breaker.allow():
         try:
-            async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT) as client:
-                files = {"file": ("diagram.png", png_content, "image/png")}
-                
-                response = await client.post(
-                    f"{VLM_SERVICE_URL}/infer",
-                    files=files
-                )
-                
-                if response.status_code != 200:
-                    logger.error(f"❌ VLM Service вернул ошибку: {response.status_code}")
-                    raise HTTPException(
-                        status_code=502,
-                        detail=f"Ошибка распознавания: {response.text}"
-                    )
-                
-                result = response.json()
-                logger.info("✅ Распознавание завершено успешно")
-                
-        except httpx.TimeoutException:
-            logger.error("❌ Timeout при распознавании")
-            raise HTTPException(
-                status_code=504,
-                detail="Превышено время ожидания распознавания"
-            )
-        except httpx.RequestError as e:
-            logger.error(f"❌ Ошибка соединения с VLM Service: {e}")
-            raise HTTPException(
-                status_code=503,
-                detail="VLM Service недоступен"
+            response = await db_client.get(
+                f"/by_hash/{file_hash}",
+                params={"model_key": model_key}
             )
-        
-        # 5. Формирование ответа
-        request_end = datetime.utcnow()
-        processing_time = (request_end - request_start).total_seconds()
-        
-        successful_requests += 1
-        
-        # Извлекаем метаданные из результата VLM
-        vlm_metadata = result.get("metadata", {})
-        
-        response_data = {
-            "description": result.get("description", ""),
-            "metadata": {
-                "file_name": file.filename,
-                "file_type": file_ext,
-                "file_size_kb": round(file_size / 1024, 2),
-                "file_hash": file_hash,
-                "converted": needs_conversion,
-                "processing_time": round(processing_time, 2),
-                "timestamp": request_end.isoformat(),
-                **vlm_metadata
-            }
-        }
-        
-        # 6. Логирование в базу данных через DB сервис
-        try:
-            log_data = {
-                "file_name": file.filename,
-                "file_type": file_ext,
-                "file_size": file_size,
-                "file_hash": file_hash,
-                "was_converted": needs_conversion,
-                "conversion_time": vlm_metadata.get("conversion_time") if needs_conversion else None,
-                "model_name": vlm_metadata.get("model", "unknown"),
-                "device_type": vlm_metadata.get("device", "unknown"),
-                "description": result.get("description", ""),
-                "inference_time": vlm_metadata.get("inference_time", 0),
-                "generation_time": vlm_metadata.get("generation_time", 0),
-                "total_time": processing_time,
-                "image_size": vlm_metadata.get("image_size"),
-                "max_tokens": vlm_metadata.get("max_tokens"),
-                "torch_dtype": vlm_metadata.get("torch_dtype"),
-                "status": "success"
-            }
-            
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                await client.post(f"{DB_SERVICE_URL}/log", json=log_data)
+            if response.status_code >= 500:
+                db_breaker.record_failure()
+            else:
+                db_breaker.record_success()
+            if response.status_code == 200:
+                row = response.json()
+                if "description_text" in row:
+                    result = result_from_db_row(row)
+                    result_cache.set(cache_key, result)
+                    cache_db_hits += 1
+                    return result, "db"
+        except httpx.HTTPError as e:
+            db_breaker.record_failure()
+            logger.warning(f"⚠️  Не удалось проверить кэш в БД: {e}")
         except Exception as e:
-            logger.warning(f"⚠️  Не удалось залогировать в БД: {e}")
-        
-        logger.info(f"✅ Запрос обработан успешно за {processing_time:.2f} сек")
-        logger.info("=" * 60)
-        
-        return JSONResponse(content=response_data)
-        
-    except HTTPException as he:
-        failed_requests += 1
-        
-        # Логируем ошибку в БД через DB сервис
-        try:
-            log_data = {
-                "file_name": file.filename if file else "unknown",
-                "file_type": file_ext if 'file_ext' in locals() else "unknown",
-                "file_size": file_size if 'file_size' in locals() else 0,
-                "file_hash": file_hash if 'file_hash' in locals() else "unknown",
-                "was_converted": False,
-                "model_name": "unknown",
-                "device_type": "unknown",
-                "description": "",
-                "inference_time": 0,
-                "generation_time": 0,
-                "total_time": (datetime.utcnow() - request_start).total_seconds(),
-                "status": "error",
-                "error_message": str(he.detail)
-            }
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                await client.post(f"{DB_SERVICE_URL}/log", json=log_data)
-        except:
-            pass
-        
-        raise
-    except Exception as e:
-        failed_requests += 1
-        logger.error("=" * 60)
-        logger.error(f"❌ Неожиданная ошибка: {e}")
-        logger.error("=" * 60)
-        
-        # Логируем ошибку в БД через DB сервис
-        try:
-            log_data = {
-                "file_name": file.filename if file else "unknown",
-                "file_type": file_ext if 'file_ext' in locals() else "unknown",
-                "file_size": file_size if 'file_size' in locals() else 0,
-                "file_hash": file_hash if 'file_hash' in locals() else "unknown",
-                "was_converted": False,
-                "model_name": "unknown",
-                "device_type": "unknown",
-                "description": "",
-                "inference_time": 0,
-                "generation_time": 0,
-                "total_time": (datetime.utcnow() - request_start).total_seconds(),
-                "status": "error",
-                "error_message": str(e)
-            }
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                await client.post(f"{DB_SERVICE_URL}/log", json=log_data)
-        except:
-            pass
-        
-        raise HTTPException(
-            status_code=500,
-            detail=f"Внутренняя ошибка сервера: {str(e)}"
-        )
+            logger.warning(f"⚠️  Не удалось проверить кэш в БД: {e}")
+    
+    cache_misses += 1
+    return None
 
 
-@app.get("/api/v1/statistics")
-async def get_db_statistics():
+async def lookup_cached_results(file_hashes: List[str], model_key: str) -> Dict[str, tuple]:
     """
-    Получение статистики из базы данных через DB сервис
+    Ищет готовые результаты для нескольких хэшей: сначала в памяти,
+    промахи - одним запросом к БД
     
     Returns:
-        Статистика по всем запросам
+        Словарь хэш -> (результат VLM, источник) для найденных хэшей
     """
-    try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.get(f"{DB_SERVICE_URL}/statistics")
+    global cache_memory_hits, cache_db_hits, cache_misses
+    
+    found: Dict[str, tuple] = {}
+    missing: List[str] = []
+    for file_hash in dict.fromkeys(file_hashes):
+        result = result_cache.get((file_hash, model_key))
+        if result is not None:
+            found[file_hash] = (result, "memory")
+        else:
+            missing.append(file_hash)
+    cache_memory_hits += len(found)
+    
+    if missing and RESULT_CACHE_DB_LOOKUP and db_breaker.allow():
+        try:
+            response = await db_client.post(
+                "/by_hash/bulk",
+                json={"file_hashes": missing, "model_key": model_key}
+            )
+            if response.status_code >= 500:
+                db_breaker.record_failure()
+            else:
+                db_breaker.record_success()
             if response.status_code == 200:
-                return response.json()
-    except:
-        pass
-    return JSONResponse(content={})
+                for file_hash, row in response.json().get("results", {}).items():
+                    result = result_from_db_row(row)
+                    result_cache.set((file_hash, model_key), result)
+                    found[file_hash] = (result, "db")
+                    cache_db_hits += 1
+        except httpx.HTTPError as e:
+            db_breaker.record_failure()
+            logger.warning(f"⚠️  Не удалось проверить кэш в БД: {e}")
+        except Exception as e:
+            logger.warning(f"⚠️  Не удалось проверить кэш в БД: {e}")
+    
+    cache_misses += len(file_hashes) - len(found)
+    return found
 
 
-@app.get("/api/v1/recent")
-async def get_recent():
+def mark_near_duplicate(result: Dict[str, Any], file_hash: str, distance: int) -> Dict[str, Any]:
+    """Добавляет в метаданные результата, с каким изображением он совпал"""
+    return {
+        **result,
+        "metadata": {
+            **result.get("metadata", {}),
+            "near_duplicate_of": file_hash,
+            "phash_distance": distance
+        }
+    }
+
+
+async def lookup_similar_result(phash: str, model_key: str) -> Optional[tuple]:
     """
-    Получение последних запросов из базы данных через DB сервис
+    Ищет результат для почти такого же изображения: сначала в памяти,
+    затем в БД (только записи не старше PHASH_MAX_AGE_HOURS)
     
     Returns:
-        Список последних 20 запросов
+        Кортеж (результат VLM, источник) или None при промахе
     """
-    try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.get(f"{DB_SERVICE_URL}/recent?limit=20")
+    global near_duplicate_memory_hits, near_duplicate_db_hits
+    
+    for distance, similar_hash in phash_index.find(phash, model_key, PHASH_MAX_DISTANCE):
+        result = result_cache.get((similar_hash, model_key))
+        if result is not None:
+            near_duplicate_memory_hits += 1
+            NEAR_DUPLICATE_HITS.labels("memory").inc()
+            return mark_near_duplicate(result, similar_hash, distance), "phash_memory"
+    
+    if RESULT_CACHE_DB_LOOKUP and db_breaker.allow():
+        try:
+            response = await db_client.get(
+                f"/by_phash/{phash}",
+                params={
+                    "model_key": model_key,
+                    "max_distance": PHASH_MAX_DISTANCE,
+                    "max_age_hours": PHASH_MAX_AGE_HOURS
+                }
+            )
+            if response.status_code >= 500:
+                db_breaker.record_failure()
+            else:
+                db_breaker.record_success()
             if response.status_code == 200:
-                return response.json()
+                row = response.json()
+                if "description_text" in row:
+                    result = result_from_db_row(row)
+                    result_cache.set((row["file_hash"], model_key), result)
+                    phash_index.add(row["phash"], model_key, row["file_hash"])
+                    near_duplicate_db_hits += 1
+                    NEAR_DUPLICATE_HITS.labels("db").inc()
+                    return mark_near_duplicate(result, row["file_hash"], row["phash_distance"]), "phash_db"
+        except httpx.HTTPError as e:
+            db_breaker.record_failure()
+            logger.warning(f"⚠️  Не удалось найти похожее изображение в БД: {e}")
+        except Exception as e:
+            logger.warning(f"⚠️  Не удалось найти похожее изображение в БД: {e}")
+    
+    return None
+
+
+async def lookup_near_duplicate(
+    file_ext: str,
+    file: BinaryIO,
+    model_key: Optional[str]
+) -> tuple:
+    """
+    Считает перцептивный хэш изображения и ищет результат для похожего
+    
+    Вызывается после промаха по SHA256: пересохраненный или
+    масштабированный скриншот той же диаграммы дает другой SHA256, но
+    близкий перцептивный хэш.
+    
+    Returns:
+        Кортеж (перцептивный хэш или None, найденный результат или None)
+    """
+    if not PHASH_CACHE_ENABLED or file_ext not in SUPPORTED_IMAGE_FORMATS:
+        return None, None
+    
+    with stage_timer(STAGE_PERCEPTUAL_HASH, file_ext, current_model_name()):
+        phash = await asyncio.to_thread(compute_dhash, file)
+    if phash is None or not model_key:
+        return phash, None
+    
+    with stage_timer(STAGE_NEAR_DUPLICATE_LOOKUP, file_ext, current_model_name()):
+        cached = await lookup_similar_result(phash, model_key)
+    if cached:
+        logger.info(
+            f"🖼️  Найдено похожее изображение (расстояние "
+            f"{cached[0]['metadata']['phash_distance']})"
+        )
+    return phash, cached
+
+
+async def convert_to_png(
+    file_name: str,
+    content_type: str,
+    file: Union[BinaryIO, BlobRef]
+) -> Union[bytes, BlobRef]:
+    """Конвертирует диаграмму в PNG через Adapter Service"""
+    with stage_timer(STAGE_CONVERSION, get_file_extension(file_name), current_model_name()):
+        if isinstance(file, BlobRef):
+            converted = await send_blob_to_adapter(file_name, file)
+            if converted is not None:
+                return converted
+            # Adapter Service без доступа к общему тому - отправляем содержимое
+            with open(file.path, "rb") as content:
+                return await send_to_adapter(file_name, content_type, content)
+        return await send_to_adapter(file_name, content_type, file)
+
+
+async def send_blob_to_adapter(file_name: str, blob: BlobRef) -> Optional[BlobRef]:
+    """
+    Конвертирует файл из общего хранилища: передается только хэш,
+    результат Adapter Service тоже кладет в хранилище
+    
+    Returns:
+        Ссылка на PNG или None, если у Adapter Service нет доступа к хранилищу
+    """
+    check_circuit(adapter_breaker)
+    try:
+        logger.info(f"📤 Отправка в Adapter Service по хэшу {blob.blob_hash[:16]}...")
+        response = await adapter_client.post(
+            "/convert/blob",
+            json={"blob_hash": blob.blob_hash, "file_name": file_name}
+        )
+    except httpx.TimeoutException:
+        # Истекший дедлайн запроса - не признак недоступности сервиса
+        if not deadline_expired():
+            adapter_breaker.record_failure()
+        logger.error("❌ Timeout при конвертации")
+        raise HTTPException(
+            status_code=504,
+            detail="Превышено время ожидания конвертации"
+        )
+    except httpx.RequestError as e:
+        adapter_breaker.record_failure()
+        logger.error(f"❌ Ошибка соединения с Adapter Service: {e}")
+        raise HTTPException(
+            status_code=503,
+            detail="Adapter Service недоступен"
+        )
+    
+    record_upstream_status(adapter_breaker, response.status_code)
+    if response.status_code == 404:
+        logger.warning("⚠️  Adapter Service не видит общее хранилище, передаем файл по HTTP")
+        return None
+    if response.status_code != 200:
+        logger.error(f"❌ Adapter Service вернул ошибку: {response.status_code}")
+        raise HTTPException(
+            status_code=502,
+            detail=f"Ошибка конвертации: {response.text}"
+        )
+    
+    try:
+        blob_hash = response.json().get("blob_hash")
+    except (ValueError, AttributeError):
+        blob_hash = None
+    if not isinstance(blob_hash, str) or not is_valid_blob_hash(blob_hash):
+        logger.error(f"❌ Adapter Service вернул некорректный хэш результата: {blob_hash!r}")
+        raise HTTPException(
+            status_code=502,
+            detail="Ошибка конвертации: некорректный ответ Adapter Service"
+        )
+    
+    png = blob_store.ref(blob_hash)
+    if png is None:
+        raise HTTPException(
+            status_code=502,
+            detail="Ошибка конвертации: результат не найден в хранилище"
+        )
+    logger.info(f"✅ Конвертация завершена, PNG: {png.blob_hash[:16]}...")
+    return png
+
+
+async def send_to_adapter(file_name: str, content_type: str, file: BinaryIO) -> bytes:
+    """Отправляет файл на конвертацию в Adapter Service"""
+    check_circuit(adapter_breaker)
+    try:
+        # httpx читает файл блоками при отправке, без копии в памяти
+        files = {"file": (file_name, file, content_type)}
+        
+        logger.info(f"📤 Отправка в Adapter Service...")
+        response = await adapter_client.post("/convert", files=files)
+        record_upstream_status(adapter_breaker, response.status_code)
+        
+        if response.status_code != 200:
+            logger.error(f"❌ Adapter Service вернул ошибку: {response.status_code}")
+            raise HTTPException(
+                status_code=502,
+                detail=f"Ошибка конвертации: {response.text}"
+            )
+        
+        # Получаем PNG из ответа
+        png_content = response.content
+        logger.info(f"✅ Конвертация завершена, размер PNG: {len(png_content) / 1024:.2f} KB")
+        return png_content
+        
+    except httpx.TimeoutException:
+        # Истекший дедлайн запроса - не признак недоступности сервиса
+        if not deadline_expired():
+            adapter_breaker.record_failure()
+        logger.error("❌ Timeout при конвертации")
+        raise HTTPException(
+            status_code=504,
+            detail="Превышено время ожидания конвертации"
+        )
+    except httpx.RequestError as e:
+        adapter_breaker.record_failure()
+        logger.error(f"❌ Ошибка соединения с Adapter Service: {e}")
+        raise HTTPException(
+            status_code=503,
+            detail="Adapter Service недоступен"
+        )
+
+
+async def run_vlm_inference(png_content: Union[bytes, BinaryIO, BlobRef]) -> Dict[str, Any]:
+    """
+    Отправляет изображение (байты, файл или ссылку на хранилище) в VLM
+    Service и возвращает его ответ
+    
+    Запрос уходит на наименее загруженную реплику; при включенном hedging
+    медленный запрос дублируется на свободную реплику. Ссылку на хранилище и
+    байты каждая попытка отправляет независимо, а один открытый файл две
+    попытки читать одновременно не могут: для дубля файл не больше
+    VLM_HEDGE_MAX_BYTES читается в память, больший не дублируется.
+    """
+    hedge = True
+    if not isinstance(png_content, (bytes, BlobRef)) and vlm_pool.hedge_delay() is not None:
+        content = await asyncio.to_thread(read_limited, png_content, VLM_HEDGE_MAX_BYTES)
+        if content is None:
+            hedge = False
+        else:
+            png_content = content
+    try:
+        return await vlm_pool.call(lambda replica: send_vlm_request(replica, png_content), hedge=hedge)
+    except CircuitOpenError as e:
+        raise circuit_error(e)
+
+
+async def post_vlm_image(
+    replica: VLMReplica,
+    png_content: Union[bytes, BinaryIO, BlobRef]
+) -> httpx.Response:
+    """
+    Отправляет изображение в /infer реплики: ссылку на хранилище - по хэшу
+    (с откатом на передачу содержимого, если реплика не видит общий том)
+    """
+    if isinstance(png_content, BlobRef):
+        response = await replica.client.post("/infer", data={"blob_hash": png_content.blob_hash})
+        if response.status_code != 404:
+            return response
+        logger.warning(f"⚠️  {replica.url} не видит общее хранилище, передаем файл по HTTP")
+        with open(png_content.path, "rb") as content:
+            return await replica.client.post(
+                "/infer", files={"file": ("diagram.png", content, "image/png")}
+            )
+    return await replica.client.post(
+        "/infer", files={"file": ("diagram.png", png_content, "image/png")}
+    )
+
+
+@asynccontextmanager
+async def stream_vlm_image(replica: VLMReplica, png_content: Union[bytes, BinaryIO, BlobRef]):
+    """Потоковый аналог post_vlm_image для /infer/stream"""
+    if isinstance(png_content, BlobRef):
+        async with replica.client.stream(
+            "POST", "/infer/stream", data={"blob_hash": png_content.blob_hash}
+        ) as response:
+            if response.status_code != 404:
+                yield response
+                return
+        logger.warning(f"⚠️  {replica.url} не видит общее хранилище, передаем файл по HTTP")
+        with open(png_content.path, "rb") as content:
+            async with replica.client.stream(
+                "POST", "/infer/stream", files={"file": ("diagram.png", content, "image/png")}
+            ) as response:
+                yield response
+        return
+    
+    async with replica.client.stream(
+        "POST", "/infer/stream", files={"file": ("diagram.png", png_content, "image/png")}
+    ) as response:
+        yield response
+
+
+async def send_vlm_request(
+    replica: VLMReplica,
+    png_content: Union[bytes, BinaryIO, BlobRef]
+) -> Dict[str, Any]:
+    """Отправляет изображение в одну реплику VLM Service"""
+    logger.info(f"📤 Отправка в VLM Service ({replica.url}) для распознавания...")
+    
+    try:
+        response = await post_vlm_image(replica, png_content)
+        if response.status_code == 504:
+            # VLM Service прервал генерацию по дедлайну - реплика исправна
+            replica.breaker.record_success()
+            logger.error("❌ Генерация прервана VLM Service по дедлайну запроса")
+            raise HTTPException(
+                status_code=504,
+                detail="Превышено время ожидания распознавания"
+            )
+        record_upstream_status(replica.breaker, response.status_code)
+        
+        if response.status_code != 200:
+            logger.error(f"❌ VLM Service вернул ошибку: {response.status_code}")
+            raise HTTPException(
+                status_code=502,
+                detail=f"Ошибка распознавания: {response.text}"
+            )
+        
+        result = response.json()
+        logger.info("✅ Распознавание завершено успешно")
+        return result
+        
+    except httpx.TimeoutException:
+        if not deadline_expired():
+            replica.breaker.record_failure()
+        logger.error("❌ Timeout при распознавании")
+        raise HTTPException(
+            status_code=504,
+            detail="Превышено время ожидания распознавания"
+        )
+    except httpx.RequestError as e:
+        replica.breaker.record_failure()
+        logger.error(f"❌ Ошибка соединения с VLM Service ({replica.url}): {e}")
+        raise HTTPException(
+            status_code=503,
+            detail="VLM Service недоступен"
+        )
+
+
+def is_degraded(result: Dict[str, Any]) -> bool:
+    """
+    Получен ли результат с уменьшенными под нагрузкой бюджетами VLM
+    
+    Такие результаты отдаются клиенту, но не кэшируются, чтобы повторный
+    запрос получил ответ полного качества.
+    """
+    return bool(result.get("metadata", {}).get("degraded"))
+
+
+def build_log_data(
+    file_name: str,
+    file_ext: str,
+    file_size: int,
+    file_hash: str,
+    total_time: float,
+    result: Optional[Dict[str, Any]] = None,
+    converted: bool = False,
+    cache_source: Optional[str] = None,
+    model_key: Optional[str] = None,
+    error_message: Optional[str] = None,
+    phash: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Формирует запись inference_logs для DB сервиса
+    
+    Без result запись описывает запрос, завершившийся ошибкой.
+    """
+    result = result or {}
+    vlm_metadata = result.get("metadata", {})
+    
+    if error_message is not None:
+        status = "error"
+    else:
+        status = "cached" if cache_source else "success"
+    
+    return {
+        "file_name": file_name,
+        "file_type": file_ext,
+        "file_size": file_size,
+        "file_hash": file_hash,
+        "was_converted": converted,
+        "conversion_time": vlm_metadata.get("conversion_time") if converted else None,
+        "model_name": vlm_metadata.get("model", "unknown"),
+        "device_type": vlm_metadata.get("device", "unknown"),
+        "description": result.get("description", ""),
+        # Для ответа из кэша модель не запускалась
+        "inference_time": 0 if cache_source else vlm_metadata.get("inference_time", 0),
+        "generation_time": 0 if cache_source else vlm_metadata.get("generation_time", 0),
+        "total_time": total_time,
+        "image_size": vlm_metadata.get("image_size"),
+        "max_tokens": vlm_metadata.get("max_tokens"),
+        "torch_dtype": vlm_metadata.get("torch_dtype"),
+        # Бюджеты, фактически использованные VLM сервисом для запроса
+        "effective_max_tokens": vlm_metadata.get("effective_max_tokens"),
+        "effective_max_pixels": vlm_metadata.get("effective_max_pixels"),
+        "degraded": vlm_metadata.get("degraded"),
+        "status": status,
+        "error_message": error_message,
+        "model_key": model_key,
+        "phash": phash,
+        "trace_id": current_trace_id(),
+        # Ключ идемпотентности: переотправка из spool не создает дублей
+        "record_id": uuid.uuid4().hex
+    }
+
+
+async def infer_file(
+    file_name: str,
+    content_type: str,
+    file_ext: str,
+    file: Union[BinaryIO, BlobRef],
+    file_hash: str,
+    on_stage: Optional[Callable[[str], None]] = None,
+    client_id: Optional[str] = None,
+    priority: str = PRIORITY_BATCH,
+    deadline: Optional[Union[float, SharedDeadline]] = None
+) -> tuple:
+    """
+    Конвертирует файл (если нужно) и распознает его в VLM сервисе
+    
+    Args:
+        file: Файл или ссылка на него в общем хранилище
+        on_stage: Вызывается при переходе к очередному этапу обработки
+        client_id: Клиент для квоты admission control
+        priority: Класс приоритета запроса к VLM
+        deadline: Момент (time.monotonic()), к которому запрос должен
+            завершиться, или общий дедлайн объединенных запросов
+    
+    Returns:
+        Кортеж (ответ VLM, ключ версии модели)
+    """
+    if deadline is None:
+        deadline = time.monotonic() + REQUEST_TIMEOUT
+    
+    # С общим томом сервисам передается только хэш файла
+    if not isinstance(file, BlobRef):
+        file = await store_blob(file, file_hash)
+    
+    # Зависимые сервисы получают оставшееся до дедлайна время
+    with deadline_scope(deadline):
+        if file_ext in SUPPORTED_DIAGRAM_FORMATS:
+            logger.info(f"🔄 Требуется конвертация из {file_ext} в PNG")
+            png_content = await convert_to_png(file_name, content_type, file)
+        else:
+            logger.info("✅ Файл уже в формате изображения, конвертация не требуется")
+            png_content = file
+        
+        if on_stage:
+            on_stage(JOB_INFERRING)
+        
+        async with vlm_slot(client_id, priority, deadline_at(deadline), file_ext):
+            with stage_timer(STAGE_VLM_INFERENCE, file_ext, current_model_name()):
+                result = await run_vlm_inference(png_content)
+    
+    # Ключ берем из ответа - модель могла смениться с момента проверки кэша
+    model_key = build_model_key(result.get("metadata", {}))
+    if not is_degraded(result):
+        result_cache.set((file_hash, model_key), result)
+    return result, model_key
+
+
+async def own_upload(file: BinaryIO, file_hash: str) -> Union[BinaryIO, BlobRef]:
+    """
+    Копия загрузки для общего инференса: файл запроса закрывается, когда
+    запрос завершается, а другие запросы могут еще ждать результат
+    
+    Returns:
+        Ссылка на файл в общем хранилище или временный файл
+    """
+    if blob_store is not None:
+        stored = await store_blob(file, file_hash)
+        if isinstance(stored, BlobRef):
+            return stored
+    file.seek(0)
+    copy, _, _ = await asyncio.to_thread(spool_copy, file, UPLOAD_SPOOL_THRESHOLD)
+    file.seek(0)
+    return copy
+
+
+def release_upload(file: Union[BinaryIO, BlobRef, None]):
+    """Закрывает временную копию загрузки (файл в хранилище удаляет очистка)"""
+    if file is not None and not isinstance(file, BlobRef):
+        file.close()
+
+
+async def infer_shared(
+    file_name: str,
+    content_type: str,
+    file_ext: str,
+    file: BinaryIO,
+    file_hash: str,
+    on_stage: Optional[Callable[[str], None]],
+    client_id: Optional[str],
+    priority: str,
+    deadline: float
+) -> tuple:
+    """
+    infer_file, общий для одновременных загрузок того же файла
+    
+    Инференс работает со своей копией файла и с самым поздним дедлайном из
+    ожидающих запросов, поэтому отключение или завершение запроса, который
+    его начал, не мешает остальным.
+    
+    Returns:
+        Кортеж ((ответ VLM, ключ версии модели), получен ли результат от
+        чужого вызова)
+    """
+    if file_hash not in inflight_inferences:
+        owned = await own_upload(file, file_hash)
+        # Пока файл копировался, такой же инференс мог начать другой запрос
+        if file_hash not in inflight_inferences:
+            flight_deadline = SharedDeadline(deadline)
+            flight_deadlines[file_hash] = flight_deadline
+            started = False
+            
+            async def run_flight():
+                nonlocal started
+                started = True
+                try:
+                    return await infer_file(
+                        file_name, content_type, file_ext, owned, file_hash, on_stage,
+                        client_id, priority, flight_deadline
+                    )
+                finally:
+                    release_upload(owned)
+                    if flight_deadlines.get(file_hash) is flight_deadline:
+                        del flight_deadlines[file_hash]
+            
+            try:
+                return await inflight_inferences.do(file_hash, run_flight)
+            finally:
+                if not started:
+                    # Вызов отменен до начала работы
+                    release_upload(owned)
+                    if flight_deadlines.get(file_hash) is flight_deadline:
+                        del flight_deadlines[file_hash]
+        release_upload(owned)
+    
+    # Присоединяемся к выполняющемуся вызову (функция не будет вызвана)
+    if file_hash in flight_deadlines:
+        flight_deadlines[file_hash].extend(deadline)
+    return await inflight_inferences.do(file_hash, None)
+
+
+def complete_request(
+    file_name: str,
+    file_ext: str,
+    file_size: int,
+    file_hash: str,
+    request_start: datetime,
+    result: Dict[str, Any],
+    converted: bool,
+    cache_source: Optional[str],
+    model_key: Optional[str],
+    extra_metadata: Optional[Dict[str, Any]] = None,
+    phash: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Формирует ответ клиенту по результату VLM и ставит запись в очередь логов
+    
+    Returns:
+        Ответ с описанием алгоритма и метаданными
+    """
+    global successful_requests
+    
+    request_end = datetime.utcnow()
+    processing_time = (request_end - request_start).total_seconds()
+    
+    successful_requests += 1
+    
+    # Извлекаем метаданные из результата VLM
+    vlm_metadata = result.get("metadata", {})
+    
+    response_data = {
+        "description": result.get("description", ""),
+        "metadata": {
+            "file_name": file_name,
+            "file_type": file_ext,
+            "file_size_kb": round(file_size / 1024, 2),
+            "file_hash": file_hash,
+            "converted": converted,
+            "processing_time": round(processing_time, 2),
+            "timestamp": request_end.isoformat(),
+            **vlm_metadata,
+            "cached": cache_source is not None,
+            "cache_source": cache_source,
+            **(extra_metadata or {})
+        }
+    }
+    
+    observe_request(
+        file_ext, vlm_metadata.get("model"),
+        "cached" if cache_source else "success", processing_time
+    )
+    
+    # Логирование в базу данных (в фоне, ответ не ждет записи)
+    log_queue.enqueue(build_log_data(
+        file_name=file_name,
+        file_ext=file_ext,
+        file_size=file_size,
+        file_hash=file_hash,
+        total_time=processing_time,
+        result=result,
+        converted=converted,
+        cache_source=cache_source,
+        model_key=model_key,
+        phash=phash
+    ))
+    
+    logger.info(f"✅ Запрос обработан успешно за {processing_time:.2f} сек")
+    logger.info("=" * 60)
+    
+    return response_data
+
+
+def validate_file_extension(file_name: str) -> str:
+    """
+    Проверяет расширение файла
+    
+    Returns:
+        Расширение файла в нижнем регистре
+    """
+    file_ext = get_file_extension(file_name)
+    
+    if not file_ext:
+        logger.warning("⚠️  Файл без расширения")
+        raise HTTPException(
+            status_code=400,
+            detail="Файл должен иметь расширение"
+        )
+    
+    if file_ext not in ALL_SUPPORTED_FORMATS:
+        logger.warning(f"⚠️  Неподдерживаемый формат: {file_ext}")
+        raise HTTPException(
+            status_code=400,
+            detail=f"Неподдерживаемый формат файла: {file_ext}. "
+                   f"Поддерживаются: {', '.join(ALL_SUPPORTED_FORMATS)}"
+        )
+    
+    logger.info(f"✅ Формат файла: {file_ext}")
+    return file_ext
+
+
+async def process_file(
+    file_name: str,
+    content_type: str,
+    file: BinaryIO,
+    file_hash: str,
+    file_size: int,
+    on_stage: Optional[Callable[[str], None]] = None,
+    client_id: Optional[str] = None,
+    priority: str = PRIORITY_BATCH
+) -> Dict[str, Any]:
+    """
+    Полный цикл обработки одного файла: валидация, кэш, конвертация,
+    распознавание и логирование
+    
+    Args:
+        file_name: Имя файла
+        content_type: MIME тип файла
+        file: Файл с содержимым (загрузка или временный файл)
+        file_hash: SHA256 содержимого
+        file_size: Размер содержимого в байтах
+        on_stage: Вызывается при переходе к этапам конвертации и распознавания
+        client_id: Клиент для квоты admission control (None - квота уже списана)
+        priority: Класс приоритета запроса к VLM
+    
+    Returns:
+        Ответ с описанием алгоритма и метаданными
+    """
+    global total_requests, failed_requests
+    
+    total_requests += 1
+    request_start = datetime.utcnow()
+    deadline = time.monotonic() + REQUEST_TIMEOUT
+    
+    # Значение для записи об ошибке, если запрос упадет до валидации
+    file_ext = "unknown"
+    
+    try:
+        # 1. Валидация файла
+        file_ext = validate_file_extension(file_name)
+        
+        # 2. Размер и хэш содержимого (посчитаны при приеме загрузки)
+        logger.info(f"📊 Размер файла: {file_size / 1024:.2f} KB")
+        logger.info(f"🔑 Хэш файла: {file_hash[:16]}...")
+        
+        # 3. Поиск готового результата в кэше
+        needs_conversion = file_ext in SUPPORTED_DIAGRAM_FORMATS
+        with stage_timer(STAGE_CACHE_LOOKUP, file_ext, current_model_name()):
+            model_key = await get_model_key()
+            cached = await lookup_cached_result(file_hash, model_key) if model_key else None
+        phash = None
+        if not cached:
+            phash, cached = await lookup_near_duplicate(file_ext, file, model_key)
+        
+        if cached:
+            result, cache_source = cached
+            logger.info(f"⚡ Результат найден в кэше ({cache_source})")
+        else:
+            cache_source = None
+            if on_stage:
+                on_stage(JOB_CONVERTING if needs_conversion else JOB_INFERRING)
+            
+            # 4-5. Конвертация и распознавание; одновременные загрузки
+            # того же файла ждут результат одного вызова VLM
+            (result, model_key), shared = await infer_shared(
+                file_name, content_type, file_ext, file, file_hash, on_stage,
+                client_id, priority, deadline
+            )
+            if shared:
+                logger.info("🔗 Результат получен от одновременного запроса с тем же файлом")
+            if phash and not is_degraded(result):
+                phash_index.add(phash, model_key, file_hash)
+        
+        # 6-7. Формирование ответа и логирование
+        return complete_request(
+            file_name, file_ext, file_size, file_hash, request_start,
+            result, needs_conversion, cache_source, model_key, phash=phash
+        )
+        
+    except HTTPException as he:
+        failed_requests += 1
+        observe_request(file_ext, None, "error", (datetime.utcnow() - request_start).total_seconds())
+        if he.status_code == 504 and is_expired(deadline):
+            record_cancellation("deadline")
+        
+        # Логируем ошибку в БД через DB сервис
+        log_queue.enqueue(build_log_data(
+            file_name=file_name or "unknown",
+            file_ext=file_ext,
+            file_size=file_size,
+            file_hash=file_hash,
+            total_time=(datetime.utcnow() - request_start).total_seconds(),
+            error_message=str(he.detail)
+        ))
+        
+        raise
+    except asyncio.CancelledError:
+        # Клиент отключился: вызовы зависимых сервисов отменены вместе с запросом
+        observe_request(file_ext, None, "cancelled", (datetime.utcnow() - request_start).total_seconds())
+        raise
+    except Exception as e:
+        failed_requests += 1
+        observe_request(file_ext, None, "error", (datetime.utcnow() - request_start).total_seconds())
+        logger.error("=" * 60)
+        logger.error(f"❌ Неожиданная ошибка: {e}")
+        logger.error("=" * 60)
+        
+        # Логируем ошибку в БД через DB сервис
+        log_queue.enqueue(build_log_data(
+            file_name=file_name or "unknown",
+            file_ext=file_ext,
+            file_size=file_size,
+            file_hash=file_hash,
+            total_time=(datetime.utcnow() - request_start).total_seconds(),
+            error_message=str(e)
+        ))
+        
+        raise HTTPException(
+            status_code=500,
+            detail=f"Внутренняя ошибка сервера: {str(e)}"
+        )
+
+
+@app.post("/api/v1/process")
+async def process_diagram(request: Request, file: UploadFile = File(...)):
+    """
+    Основной эндпоинт для обработки диаграмм
+    
+    Принимает файл диаграммы, определяет тип, конвертирует если нужно,
+    отправляет на распознавание в VLM сервис и возвращает результат.
+    Повторные файлы обслуживаются из кэша результатов.
+    
+    Args:
+        file: Файл диаграммы (PNG, JPG, BPMN, PlantUML, Mermaid, Draw.io)
+    
+    Returns:
+        JSON с описанием алгоритма и метаданными
+    """
+    logger.info("=" * 60)
+    logger.info(f"📥 Получен запрос на обработку")
+    logger.info(f"📄 Файл: {file.filename}")
+    logger.info(f"📦 Тип: {file.content_type}")
+    
+    # Загрузка уже лежит во временном файле: хэш считаем блоками, не читая
+    # файл в память целиком, и передаем дальше сам файл
+    with stage_timer(STAGE_HASHING, get_file_extension(file.filename), current_model_name()):
+        file_hash, file_size = await asyncio.to_thread(hash_file, file.file)
+    
+    # Если клиент ушел, не дождавшись ответа, обработка отменяется, и VLM
+    # Service прекращает генерацию по закрытому соединению
+    try:
+        response_data = await run_until_disconnect(
+            request.is_disconnected,
+            process_file(
+                file.filename, file.content_type, file.file, file_hash, file_size,
+                client_id=get_client_id(request), priority=PRIORITY_INTERACTIVE
+            ),
+            DISCONNECT_POLL_INTERVAL
+        )
+    except ClientDisconnected:
+        record_cancellation("client_disconnect")
+        logger.warning("🛑 Клиент закрыл соединение, обработка отменена")
+        raise HTTPException(status_code=499, detail="Клиент закрыл соединение")
+    
+    return JSONResponse(content=response_data)
+
+
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    """Форматирует событие Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class TableRowDetector:
+    """Выделяет завершенные строки данных Markdown-таблицы из потока текста"""
+    
+    def __init__(self):
+        self._buffer = ""
+        self._header_seen = False
+    
+    def feed(self, text: str) -> List[str]:
+        """Добавляет фрагмент текста и возвращает строки таблицы, завершенные в нем"""
+        self._buffer += text
+        rows = []
+        while "\n" in self._buffer:
+            line, self._buffer = self._buffer.split("\n", 1)
+            line = line.strip()
+            if not line.startswith("|"):
+                continue
+            if not self._header_seen:
+                # Первая строка таблицы - заголовок
+                self._header_seen = True
+                continue
+            if set(line) <= set("|-: "):
+                # Разделитель заголовка |---|---|
+                continue
+            rows.append(line)
+        return rows
+
+
+async def stream_vlm_inference(png_content: Union[bytes, BinaryIO, BlobRef]):
+    """
+    Потоковое распознавание в VLM Service
+    
+    Yields:
+        События VLM сервиса: {"type": "token", ...}, затем {"type": "done", ...}
+    """
+    try:
+        replica = vlm_pool.select()
+    except CircuitOpenError as e:
+        raise circuit_error(e)
+    
+    logger.info(f"📤 Отправка в VLM Service ({replica.url}) для потокового распознавания...")
+    
+    try:
+        async with vlm_pool.acquire(replica), stream_vlm_image(replica, png_content) as response:
+            record_upstream_status(replica.breaker, response.status_code)
+            if response.status_code != 200:
+                detail = (await response.aread()).decode("utf-8", errors="replace")
+                logger.error(f"❌ VLM Service вернул ошибку: {response.status_code}")
+                raise HTTPException(
+                    status_code=502,
+                    detail=f"Ошибка распознавания: {detail}"
+                )
+            
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                if event.get("type") == "error":
+                    if event.get("status_code") == 504:
+                        raise HTTPException(
+                            status_code=504,
+                            detail="Превышено время ожидания распознавания"
+                        )
+                    raise HTTPException(
+                        status_code=502,
+                        detail=f"Ошибка распознавания: {event.get('detail')}"
+                    )
+                yield event
+                
+    except httpx.TimeoutException:
+        if not deadline_expired():
+            replica.breaker.record_failure()
+        logger.error("❌ Timeout при распознавании")
+        raise HTTPException(
+            status_code=504,
+            detail="Превышено время ожидания распознавания"
+        )
+    except httpx.RequestError as e:
+        replica.breaker.record_failure()
+        logger.error(f"❌ Ошибка соединения с VLM Service ({replica.url}): {e}")
+        raise HTTPException(
+            status_code=503,
+            detail="VLM Service недоступен"
+        )
+
+
+@app.post("/api/v1/process/stream")
+async def process_diagram_stream(request: Request, file: UploadFile = File(...)):
+    """
+    Потоковая обработка диаграммы
+    
+    Текст описания передается по мере генерации моделью, что позволяет
+    показывать таблицу построчно, не дожидаясь конца инференса.
+    
+    Args:
+        file: Файл диаграммы
+    
+    Returns:
+        Поток Server-Sent Events:
+        - stage: переход к этапу converting / inferring
+        - token: очередной фрагмент текста
+        - row: завершенная строка таблицы
+        - done: итоговый ответ (как у /api/v1/process) с time_to_first_token
+          и time_to_first_row в метаданных
+        - error: ошибка обработки
+    """
+    logger.info("=" * 60)
+    logger.info(f"📥 Получен запрос на потоковую обработку")
+    logger.info(f"📄 Файл: {file.filename}")
+    
+    # Ошибки валидации возвращаем обычным HTTP ответом до начала потока
+    file_ext = validate_file_extension(file.filename)
+    # Поток отдается после возврата из эндпоинта, когда загрузка уже может
+    # быть закрыта, поэтому копируем ее во временный файл (с подсчетом хэша)
+    with stage_timer(STAGE_HASHING, get_file_extension(file.filename), current_model_name()):
+        spooled, file_hash, file_size = await asyncio.to_thread(
+            spool_copy, file.file, UPLOAD_SPOOL_THRESHOLD
+        )
+    content_type = file.content_type
+    file_name = file.filename
+    client_id = get_client_id(request)
+    
+    async def event_stream():
+        global total_requests, failed_requests
+        
+        total_requests += 1
+        request_start = datetime.utcnow()
+        start = time.monotonic()
+        deadline = start + REQUEST_TIMEOUT
+        needs_conversion = file_ext in SUPPORTED_DIAGRAM_FORMATS
+        
+        try:
+            with stage_timer(STAGE_CACHE_LOOKUP, file_ext, current_model_name()):
+                model_key = await get_model_key()
+                cached = await lookup_cached_result(file_hash, model_key) if model_key else None
+            phash = None
+            if not cached:
+                phash, cached = await lookup_near_duplicate(file_ext, spooled, model_key)
+            time_to_first_token = None
+            time_to_first_row = None
+            
+            if cached:
+                result, cache_source = cached
+                logger.info(f"⚡ Результат найден в кэше ({cache_source})")
+            else:
+                cache_source = None
+                
+                source = await store_blob(spooled, file_hash)
+                # Зависимые сервисы получают оставшееся до дедлайна время
+                with deadline_scope(deadline):
+                    if needs_conversion:
+                        yield format_sse("stage", {"stage": JOB_CONVERTING})
+                        png_content = await convert_to_png(file_name, content_type, source)
+                    else:
+                        png_content = source
+                    
+                    yield format_sse("stage", {"stage": JOB_INFERRING})
+                    
+                    result = None
+                    rows = TableRowDetector()
+                    row_count = 0
+                    async with vlm_slot(client_id, PRIORITY_INTERACTIVE, deadline, file_ext):
+                        with stage_timer(STAGE_VLM_INFERENCE, file_ext, current_model_name()):
+                            async for event in stream_vlm_inference(png_content):
+                                if event.get("type") == "token":
+                                    if time_to_first_token is None:
+                                        time_to_first_token = time.monotonic() - start
+                                    yield format_sse("token", {"text": event["text"]})
+                                
+                                    for row in rows.feed(event["text"]):
+                                        if time_to_first_row is None:
+                                            time_to_first_row = time.monotonic() - start
+                                            logger.info(f"⚡ Первая строка таблицы через {time_to_first_row:.2f} сек")
+                                        row_count += 1
+                                        yield format_sse("row", {"index": row_count, "row": row})
+                                elif event.get("type") == "done":
+                                    result = {
+                                        "description": event.get("description", ""),
+                                        "metadata": event.get("metadata", {})
+                                    }
+                
+                if result is None:
+                    raise HTTPException(
+                        status_code=502,
+                        detail="VLM Service оборвал поток до завершения генерации"
+                    )
+                
+                model_key = build_model_key(result["metadata"])
+                if not is_degraded(result):
+                    result_cache.set((file_hash, model_key), result)
+                    if phash:
+                        phash_index.add(phash, model_key, file_hash)
+            
+            response_data = complete_request(
+                file_name, file_ext, file_size, file_hash, request_start,
+                result, needs_conversion, cache_source, model_key,
+                extra_metadata={
+                    "time_to_first_token": (
+                        round(time_to_first_token, 2) if time_to_first_token is not None else None
+                    ),
+                    "time_to_first_row": (
+                        round(time_to_first_row, 2) if time_to_first_row is not None else None
+                    )
+                },
+                phash=phash
+            )
+            yield format_sse("done", response_data)
+            
+        except (asyncio.CancelledError, GeneratorExit):
+            # Клиент закрыл поток: поток VLM Service закрывается вместе с ним,
+            # и генерация прекращается
+            record_cancellation("client_disconnect")
+            observe_request(file_ext, None, "cancelled", (datetime.utcnow() - request_start).total_seconds())
+            logger.warning("🛑 Клиент закрыл соединение, обработка отменена")
+            raise
+        except HTTPException as he:
+            failed_requests += 1
+            observe_request(file_ext, None, "error", (datetime.utcnow() - request_start).total_seconds())
+            if he.status_code == 504 and is_expired(deadline):
+                record_cancellation("deadline")
+            log_queue.enqueue(build_log_data(
+                file_name=file_name,
+                file_ext=file_ext,
+                file_size=file_size,
+                file_hash=file_hash,
+                total_time=(datetime.utcnow() - request_start).total_seconds(),
+                error_message=str(he.detail)
+            ))
+            error = {"status_code": he.status_code, "detail": he.detail}
+            if he.headers and "Retry-After" in he.headers:
+                error["retry_after"] = int(he.headers["Retry-After"])
+            yield format_sse("error", error)
+        except Exception as e:
+            failed_requests += 1
+            observe_request(file_ext, None, "error", (datetime.utcnow() - request_start).total_seconds())
+            logger.error(f"❌ Неожиданная ошибка: {e}")
+            log_queue.enqueue(build_log_data(
+                file_name=file_name,
+                file_ext=file_ext,
+                file_size=file_size,
+                file_hash=file_hash,
+                total_time=(datetime.utcnow() - request_start).total_seconds(),
+                error_message=str(e)
+            ))
+            yield format_sse("error", {
+                "status_code": 500,
+                "detail": f"Внутренняя ошибка сервера: {str(e)}"
+            })
+        finally:
+            spooled.close()
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def close_batch_items(items: List[tuple]):
+    """Закрывает временные файлы элементов пакета"""
+    for item in items:
+        item[2].close()
+
+
+def spool_batch_item(file_name: str, content_type: str, source: BinaryIO, items: List[tuple]):
+    """
+    Копирует файл пакета во временный файл и добавляет его в items
+    
+    Элемент пакета - кортеж (имя файла, MIME тип, временный файл, хэш, размер)
+    """
+    with stage_timer(STAGE_HASHING, get_file_extension(file_name), current_model_name()):
+        spooled, file_hash, file_size = spool_copy(source, UPLOAD_SPOOL_THRESHOLD)
+    items.append((file_name, content_type, spooled, file_hash, file_size))
+
+
+def spool_uploads(files: List[UploadFile]) -> List[tuple]:
+    """
+    Копирует загрузки пакета во временные файлы, считая хэши
+    
+    Returns:
+        Список элементов пакета (см. spool_batch_item)
+    """
+    items: List[tuple] = []
+    try:
+        for f in files:
+            spool_batch_item(f.filename, f.content_type, f.file, items)
+    except BaseException:
+        close_batch_items(items)
+        raise
+    return items
+
+
+def extract_zip_archive(archive: BinaryIO) -> List[tuple]:
+    """
+    Распаковывает zip архив с диаграммами во временные файлы
+    
+    Returns:
+        Список элементов пакета (см. spool_batch_item)
+    """
+    try:
+        zf = zipfile.ZipFile(archive)
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=400, detail="Некорректный zip архив")
+    
+    entries = [
+        info for info in zf.infolist()
+        if not info.is_dir() and not info.filename.startswith("__MACOSX/")
+    ]
+    
+    if len(entries) > BATCH_MAX_FILES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Слишком много файлов в архиве: {len(entries)} (максимум {BATCH_MAX_FILES})"
+        )
+    
+    # Защита от zip-бомб: проверяем заявленный размер до распаковки
+    total_size = sum(info.file_size for info in entries)
+    if total_size > BATCH_MAX_TOTAL_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Распакованный архив слишком большой: {total_size / 1024 / 1024:.1f} MB"
+        )
+    
+    items: List[tuple] = []
+    try:
+        for info in entries:
+            file_name = os.path.basename(info.filename)
+            content_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+            # Распаковываем потоком, не читая файл архива в память целиком
+            with zf.open(info) as source:
+                spool_batch_item(file_name, content_type, source, items)
+    except (zipfile.BadZipFile, zlib.error, EOFError):
+        # Поврежденные данные обнаруживаются только при распаковке файла
+        close_batch_items(items)
+        raise HTTPException(status_code=400, detail="Некорректный zip архив")
+    except BaseException:
+        close_batch_items(items)
+        raise
+    return items
+
+
+@app.post("/api/v1/process/batch")
+async def process_batch(request: Request, files: List[UploadFile] = File(...)):
+    """
+    Пакетная обработка диаграмм
+    
+    Принимает несколько файлов или один zip архив. Файлы обрабатываются
+    параллельно (не более BATCH_CONCURRENCY одновременно), одинаковые файлы
+    внутри пакета распознаются один раз.
+    
+    Returns:
+        NDJSON поток: строка с результатом по каждому файлу по мере готовности
+        и итоговая строка со сводкой
+    """
+    # Квота клиента списывается один раз на весь пакет
+    try:
+        admission.charge(get_client_id(request))
+    except AdmissionRejected as e:
+        raise admission_error(e)
+    
+    # Копируем файлы во временные заранее (с подсчетом хэшей):
+    # после возврата ответа загрузки будут закрыты
+    if len(files) == 1 and get_file_extension(files[0].filename) == ".zip":
+        items = await asyncio.to_thread(extract_zip_archive, files[0].file)
+    else:
+        if len(files) > BATCH_MAX_FILES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Слишком много файлов: {len(files)} (максимум {BATCH_MAX_FILES})"
+            )
+        items = await asyncio.to_thread(spool_uploads, files)
+    
+    logger.info("=" * 60)
+    logger.info(f"📦 Получен пакет из {len(items)} файлов")
+    
+    # Дедупликация внутри пакета: индексы файлов по хэшу содержимого
+    groups: Dict[str, List[int]] = {}
+    for index, item in enumerate(items):
+        groups.setdefault(item[3], []).append(index)
+    
+    logger.info(f"🔑 Уникальных файлов: {len(groups)}")
+    
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    
+    async def process_group(file_hash: str, indexes: List[int]) -> tuple:
+        file_name, content_type, spooled, _, file_size = items[indexes[0]]
+        async with semaphore:
+            try:
+                response_data = await process_file(
+                    file_name, content_type, spooled, file_hash, file_size,
+                    priority=PRIORITY_BATCH
+                )
+                return indexes, response_data, None
+            except HTTPException as he:
+                return indexes, None, {"status_code": he.status_code, "detail": he.detail}
+    
+    async def stream_results():
+        tasks = [
+            asyncio.create_task(process_group(file_hash, indexes))
+            for file_hash, indexes in groups.items()
+        ]
+        succeeded = failed = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                indexes, response_data, error = await next_done
+                for index in indexes:
+                    line = {
+                        "type": "result",
+                        "index": index,
+                        "file_name": items[index][0],
+                        "status": "success" if error is None else "error",
+                        # Повторы внутри пакета ссылаются на первый такой файл
+                        "duplicate_of": indexes[0] if index != indexes[0] else None
+                    }
+                    if error is None:
+                        line["result"] = response_data
+                        succeeded += 1
+                    else:
+                        line["error"] = error
+                        failed += 1
+                    yield json.dumps(line, ensure_ascii=False) + "\n"
+            
+            logger.info(f"✅ Пакет обработан: {succeeded} успешно, {failed} с ошибкой")
+            yield json.dumps({
+                "type": "summary",
+                "total": len(items),
+                "unique": len(groups),
+                "succeeded": succeeded,
+                "failed": failed
+            }, ensure_ascii=False) + "\n"
+        finally:
+            # Клиент отключился - незавершенная работа больше не нужна
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            close_batch_items(items)
+    
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
+class HashLookupItem(BaseModel):
+    file_hash: str
+    file_name: Optional[str] = None
+    file_size: int = 0
+
+
+class HashLookupRequest(BaseModel):
+    files: List[HashLookupItem]
+
+
+def validate_file_hash(file_hash: str) -> str:
+    """
+    Проверяет SHA256 хэш, посчитанный клиентом
+    
+    Returns:
+        Хэш в нижнем регистре
+    """
+    file_hash = file_hash.lower()
+    if not is_valid_blob_hash(file_hash):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Некорректный SHA256 хэш: {file_hash}"
+        )
+    return file_hash
+
+
+def complete_hash_lookup(
+    file_hash: str,
+    file_name: Optional[str],
+    file_size: int,
+    cached: tuple,
+    model_key: str
+) -> Dict[str, Any]:
+    """Формирует ответ, как у /api/v1/process, для результата, найденного по хэшу"""
+    global total_requests
+    
+    total_requests += 1
+    result, cache_source = cached
+    file_ext = get_file_extension(file_name) if file_name else "unknown"
+    return complete_request(
+        file_name or file_hash, file_ext, file_size, file_hash, datetime.utcnow(),
+        result, file_ext in SUPPORTED_DIAGRAM_FORMATS, cache_source, model_key
+    )
+
+
+@app.get("/api/v1/results/{file_hash}")
+async def get_result_by_hash(file_hash: str, file_name: Optional[str] = None, file_size: int = 0):
+    """
+    Готовый результат по SHA256 содержимого файла
+    
+    Клиент считает хэш сам и загружает файл, только если результата
+    нет (404). Промах не считается запросом.
+    
+    Args:
+        file_hash: SHA256 содержимого файла (hex)
+        file_name: Имя файла для метаданных ответа и лога (опционально)
+        file_size: Размер файла в байтах (опционально)
+    
+    Returns:
+        JSON как у /api/v1/process (metadata.cached = true)
+    """
+    file_hash = validate_file_hash(file_hash)
+    
+    model_key = await get_model_key()
+    if not model_key:
+        raise HTTPException(status_code=503, detail="Информация о модели VLM недоступна")
+    
+    file_ext = get_file_extension(file_name) if file_name else None
+    with stage_timer(STAGE_CACHE_LOOKUP, file_ext, current_model_name()):
+        cached = await lookup_cached_result(file_hash, model_key)
+    if not cached:
+        raise HTTPException(status_code=404, detail="Результат для этого файла не найден")
+    
+    logger.info(f"⚡ Результат найден по хэшу {file_hash[:16]}... ({cached[1]}), загрузка не нужна")
+    return JSONResponse(content=complete_hash_lookup(file_hash, file_name, file_size, cached, model_key))
+
+
+@app.post("/api/v1/results/lookup")
+async def lookup_results(data: HashLookupRequest):
+    """
+    Готовые результаты для нескольких файлов по SHA256
+    
+    Промахи памяти проверяются в БД одним запросом. Клиент загружает
+    (например, в /api/v1/process/batch) только файлы из missing.
+    
+    Returns:
+        {"results": {хэш: ответ как у /api/v1/process}, "missing": [хэши без результата]}
+    """
+    if len(data.files) > BATCH_MAX_FILES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Слишком много файлов: {len(data.files)} (максимум {BATCH_MAX_FILES})"
+        )
+    
+    items = {validate_file_hash(item.file_hash): item for item in data.files}
+    
+    model_key = await get_model_key()
+    if not model_key:
+        # Без версии модели результаты сравнивать не с чем - все файлы нужно загрузить
+        return {"results": {}, "missing": list(items)}
+    
+    with stage_timer(STAGE_CACHE_LOOKUP, None, current_model_name()):
+        found = await lookup_cached_results(list(items), model_key)
+    
+    results = {
+        file_hash: complete_hash_lookup(
+            file_hash, items[file_hash].file_name, items[file_hash].file_size, cached, model_key
+        )
+        for file_hash, cached in found.items()
+    }
+    missing = [file_hash for file_hash in items if file_hash not in found]
+    
+    logger.info(f"⚡ Поиск по хэшам: найдено {len(results)}, нужно загрузить {len(missing)}")
+    return {"results": results, "missing": missing}
+
+
+async def run_job(job: Job) -> Dict[str, Any]:
+    """Обработчик асинхронной задачи"""
+    logger.info("=" * 60)
+    logger.info(f"📥 Задача {job.id}: {job.file_name}")
+    # Задача продолжает трассировку запроса, которым была поставлена
+    with span("job", parent=job.trace_context, root=True, job_id=job.id):
+        return await process_file(
+            job.file_name, job.content_type, job.file, job.file_hash, job.file_size,
+            on_stage=job.set_state, priority=PRIORITY_BATCH
+        )
+
+
+@app.post("/api/v1/jobs", status_code=202)
+async def submit_job(request: Request, file: UploadFile = File(...)):
+    """
+    Ставит файл в очередь на обработку и сразу возвращает id задачи
+    
+    Args:
+        file: Файл диаграммы
+    
+    Returns:
+        id задачи и ссылки на ее состояние, результат и поток событий
+    """
+    # Проверяем формат до постановки в очередь, чтобы не занимать место
+    validate_file_extension(file.filename)
+    try:
+        admission.charge(get_client_id(request))
+    except AdmissionRejected as e:
+        raise admission_error(e)
+    
+    # Задача живет дольше запроса - копируем загрузку во временный файл
+    with stage_timer(STAGE_HASHING, get_file_extension(file.filename), current_model_name()):
+        spooled, file_hash, file_size = await asyncio.to_thread(
+            spool_copy, file.file, UPLOAD_SPOOL_THRESHOLD
+        )
+    
+    try:
+        job = job_manager.submit(
+            file.filename, file.content_type, spooled, file_hash, file_size
+        )
+    except QueueFullError as e:
+        spooled.close()
+        logger.warning(f"⚠️  Очередь задач заполнена, повтор через {e.retry_after}s")
+        raise HTTPException(
+            status_code=429,
+            detail="Очередь задач заполнена, повторите запрос позже",
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    
+    job.trace_context = current_context()
+    logger.info(f"🗂️  Задача {job.id} поставлена в очередь ({file.filename})")
+    
+    return {
+        "job_id": job.id,
+        "status": job.state,
+        "status_url": f"/api/v1/jobs/{job.id}",
+        "result_url": f"/api/v1/jobs/{job.id}/result",
+        "events_url": f"/api/v1/jobs/{job.id}/events"
+    }
+
+
+def get_job_or_404(job_id: str) -> Job:
+    """Возвращает задачу или 404, если ее нет или она уже удалена"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Задача {job_id} не найдена")
+    return job
+
+
+@app.get("/api/v1/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    """Состояние задачи и история переходов"""
+    return get_job_or_404(job_id).to_dict()
+
+
+@app.get("/api/v1/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """
+    Результат задачи
+    
+    Returns:
+        200 с результатом, 202 пока задача выполняется,
+        код исходной ошибки если задача завершилась неудачно
+    """
+    job = get_job_or_404(job_id)
+    
+    if job.state == JOB_DONE:
+        return JSONResponse(content=job.result)
+    if job.state == JOB_FAILED:
+        return JSONResponse(
+            status_code=job.error["status_code"],
+            content={"detail": job.error["detail"], "job_id": job.id}
+        )
+    return JSONResponse(status_code=202, content=job.to_dict())
+
+
+@app.get("/api/v1/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    """
+    Поток событий задачи (Server-Sent Events)
+    
+    Каждое событие - переход состояния: queued, converting, inferring,
+    done или failed. Поток закрывается после финального состояния.
+    """
+    job = get_job_or_404(job_id)
+    
+    async def event_stream():
+        async for event in job.subscribe():
+            data = {"job_id": job.id, **event}
+            if event["state"] == JOB_FAILED:
+                data["error"] = job.error
+            yield format_sse(event["state"], data)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.get("/api/v1/statistics")
+async def get_db_statistics():
+    """
+    Получение статистики из базы данных через DB сервис
+    
+    Returns:
+        Статистика по всем запросам
+    """
+    try:
+        response = await db_client.get("/statistics")
+        if response.status_code == 200:
+            return response.json()
+    except:
+        pass
+    return JSONResponse(content={})
+
+
+@app.get("/api/v1/recent")
+async def get_recent():
+    """
+    Получение последних запросов из базы данных через DB сервис
+    
+    Returns:
+        Список последних 20 запросов
+    """
+    try:
+        response = await db_client.get("/recent", params={"limit": 20})
+        if response.status_code == 200:
+            return response.json()
     except:
         pass
     return JSONResponse(content={"requests": []})
@@ -0,0 +1,148 @@
+"""
+Prometheus метрики Backend API
+Гистограммы длительности этапов обработки запроса по типу файла,
+модели и статусу. Метка есть там, где значение известно: тип файла
+неизвестен, пока тело запроса не прочитано, а пачка логов для БД
+содержит записи разных файлов и моделей.
+"""
+
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from prometheus_client import Counter, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+from tracing import span
+
+# Границы корзин: от миллисекунд (хэш, кэш) до минут (инференс на CPU)
+STAGE_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 20, 30, 60, 120, 300
+)
+
+STAGE_SECONDS = Histogram(
+    "backend_stage_duration_seconds",
+    "Длительность этапа обработки запроса",
+    ["stage", "file_type", "model", "status"],
+    buckets=STAGE_BUCKETS
+)
+
+REQUEST_SECONDS = Histogram(
+    "backend_request_duration_seconds",
+    "Полное время обработки файла",
+    ["file_type", "model", "status"],
+    buckets=STAGE_BUCKETS
+)
+
+UPLOAD_READ_SECONDS = Histogram(
+    "backend_upload_read_duration_seconds",
+    "Время чтения тела запроса от клиента",
+    ["endpoint", "model", "status"],
+    buckets=STAGE_BUCKETS
+)
+
+DB_LOGGING_SECONDS = Histogram(
+    "backend_db_logging_duration_seconds",
+    "Время отправки пачки записей в DB сервис",
+    ["status"],
+    buckets=STAGE_BUCKETS
+)
+
+NEAR_DUPLICATE_HITS = Counter(
+    "backend_near_duplicate_hits_total",
+    "Ответы из кэша для почти одинаковых изображений (по перцептивному хэшу)",
+    ["source"]
+)
+
+CANCELLED_REQUESTS = Counter(
+    "backend_cancelled_requests_total",
+    "Запросы, прерванные по дедлайну или из-за отключения клиента",
+    ["reason"]
+)
+
+# Этапы обработки
+STAGE_HASHING = "hashing"
+STAGE_CACHE_LOOKUP = "cache_lookup"
+STAGE_PERCEPTUAL_HASH = "perceptual_hash"
+STAGE_NEAR_DUPLICATE_LOOKUP = "near_duplicate_lookup"
+STAGE_CONVERSION = "conversion"
+STAGE_VLM_QUEUE_WAIT = "vlm_queue_wait"
+STAGE_VLM_INFERENCE = "vlm_inference"
+
+
+def observe_stage(stage: str, file_type: Optional[str], model: Optional[str], status: str, seconds: float):
+    STAGE_SECONDS.labels(stage, file_type or "unknown", model or "unknown", status).observe(seconds)
+
+
+def observe_request(file_type: Optional[str], model: Optional[str], status: str, seconds: float):
+    REQUEST_SECONDS.labels(file_type or "unknown", model or "unknown", status).observe(seconds)
+
+
+@contextmanager
+def stage_timer(stage: str, file_type: Optional[str], model: Optional[str]):
+    """
+    Замеряет этап в гистограмме и как span трассировки; исключение внутри
+    блока записывается со статусом error
+    """
+    start = time.perf_counter()
+    status = "success"
+    try:
+        with span(stage, file_type=file_type):
+            yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        observe_stage(stage, file_type, model, status, time.perf_counter() - start)
+
+
+def render_metrics() -> tuple:
+    """
+    Returns:
+        Кортеж (тело ответа в формате Prometheus, content type)
+    """
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class UploadTimingMiddleware:
+    """
+    ASGI middleware, замеряющее время получения тела запроса
+
+    Статус success - тело получено целиком, disconnected - клиент закрыл
+    соединение, не отправив его. Модель - текущая модель VLM сервиса
+    (model_name()), тип файла до разбора тела неизвестен.
+    """
+
+    def __init__(self, app, paths: set, model_name: Callable[[], Optional[str]]):
+        self.app = app
+        self.paths = paths
+        self.model_name = model_name
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        started: Optional[float] = None
+        observed = False
+
+        def observe(status: str):
+            nonlocal observed
+            observed = True
+            UPLOAD_READ_SECONDS.labels(
+                scope["path"], self.model_name() or "unknown", status
+            ).observe(time.perf_counter() - started)
+
+        async def timed_receive():
+            nonlocal started
+            if started is None:
+                started = time.perf_counter()
+            message = await receive()
+            if not observed:
+                if message["type"] == "http.request" and not message.get("more_body", False):
+                    observe("success")
+                elif message["type"] == "http.disconnect":
+                    observe("disconnected")
+            return message
+
+        await self.app(scope, timed_receive, send)
@@ -0,0 +1,133 @@
+"""
+Перцептивный хэш изображений для поиска почти одинаковых диаграмм
+SHA256 меняется при пересохранении, масштабировании или правке EXIF,
+а dHash уменьшенной копии изображения - почти нет. Похожесть оценивается
+расстоянием Хэмминга между хэшами.
+"""
+
+from collections import OrderedDict
+from typing import BinaryIO, Dict, Hashable, List, Optional, Set, Tuple
+
+from PIL import Image, ImageOps
+
+# Размер хэша: 8x8 сравнений соседних пикселей = 64 бита
+HASH_SIZE = 8
+
+# Хэш делится на полосы по 8 бит. Если расстояние меньше числа полос,
+# хотя бы одна полоса совпадает точно, поэтому кандидатов можно искать
+# по точному совпадению полос, а не перебором всех хэшей
+PHASH_BANDS = 8
+BAND_BITS = HASH_SIZE * HASH_SIZE // PHASH_BANDS
+MAX_SEARCH_DISTANCE = PHASH_BANDS - 1
+
+
+def compute_dhash(file: BinaryIO) -> Optional[str]:
+    """
+    Вычисляет dHash изображения
+
+    Изображение поворачивается по EXIF, прозрачность заливается белым,
+    затем оно уменьшается до 9x8 в оттенках серого; каждый бит - больше
+    ли пиксель своего правого соседа.
+
+    Returns:
+        64-битный хэш в hex или None, если файл не читается как изображение;
+        позиция файла возвращается в начало
+    """
+    try:
+        file.seek(0)
+        with Image.open(file) as image:
+            # Для JPEG декодер сразу отдает уменьшенную копию
+            image.draft("L", (HASH_SIZE * 16, HASH_SIZE * 16))
+            image = ImageOps.exif_transpose(image)
+            if image.mode in ("RGBA", "LA", "P"):
+                image = image.convert("RGBA")
+                background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+                image = Image.alpha_composite(background, image)
+            thumbnail = image.convert("L").resize(
+                (HASH_SIZE + 1, HASH_SIZE), Image.Resampling.LANCZOS
+            )
+            pixels = list(thumbnail.getdata())
+    except Exception:
+        return None
+    finally:
+        file.seek(0)
+
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f"{value:0{HASH_SIZE * HASH_SIZE // 4}x}"
+
+
+def hamming_distance(a: str, b: str) -> int:
+    """Число различающихся бит двух хэшей в hex"""
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def split_bands(phash: str) -> List[int]:
+    """Разбивает хэш на PHASH_BANDS полос (старшие биты - первая полоса)"""
+    value = int(phash, 16)
+    mask = (1 << BAND_BITS) - 1
+    return [
+        (value >> (BAND_BITS * (PHASH_BANDS - 1 - band))) & mask
+        for band in range(PHASH_BANDS)
+    ]
+
+
+class PerceptualIndex:
+    """
+    In-process индекс перцептивных хэшей с ограничением по количеству
+
+    Хранит соответствие (хэш файла, ключ модели) -> перцептивный хэш и
+    индекс полос для поиска ближайшего хэша той же версии модели.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+        self._bands: Dict[Hashable, Set[str]] = {}
+
+    def add(self, phash: str, model_key: str, file_hash: str):
+        """Запоминает хэш, вытесняя самые старые записи при переполнении"""
+        if self.max_size <= 0:
+            return
+
+        key = (file_hash, model_key)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+
+        self._entries[key] = phash
+        for band, value in enumerate(split_bands(phash)):
+            self._bands.setdefault((model_key, band, value), set()).add(file_hash)
+
+        while len(self._entries) > self.max_size:
+            (old_hash, old_model_key), old_phash = self._entries.popitem(last=False)
+            for band, value in enumerate(split_bands(old_phash)):
+                bucket = self._bands.get((old_model_key, band, value))
+                if bucket is not None:
+                    bucket.discard(old_hash)
+                    if not bucket:
+                        del self._bands[(old_model_key, band, value)]
+
+    def find(self, phash: str, model_key: str, max_distance: int) -> List[Tuple[int, str]]:
+        """
+        Ищет хэши той же версии модели на расстоянии не больше max_distance
+
+        Returns:
+            Список (расстояние, хэш файла), ближайшие первыми
+        """
+        candidates: Set[str] = set()
+        for band, value in enumerate(split_bands(phash)):
+            candidates |= self._bands.get((model_key, band, value), set())
+
+        matches = []
+        for file_hash in candidates:
+            distance = hamming_distance(phash, self._entries[(file_hash, model_key)])
+            if distance <= max_distance:
+                matches.append((distance, file_hash))
+        return sorted(matches)
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,81 @@
+"""
+Single-flight: объединение одновременных одинаковых запросов
+Первый запрос выполняет работу, остальные ждут тот же результат
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class _Call:
+    """Выполняющийся вызов и количество ожидающих его запросов"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Дедупликация одновременных вызовов по ключу
+
+    Работа выполняется в отдельной задаче, поэтому отмена одного из
+    ожидающих запросов не прерывает ее для остальных. Задача отменяется,
+    только если ее перестали ждать все запросы.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        self.coalesced = 0
+
+    def _forget(self, key: Hashable, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    async def do(
+        self,
+        key: Hashable,
+        func: Callable[[], Awaitable[Any]]
+    ) -> Tuple[Any, bool]:
+        """
+        Выполняет func() или присоединяется к уже выполняющемуся вызову
+
+        Returns:
+            Кортеж (результат, был ли результат получен от чужого вызова).
+            Исключение вызова пробрасывается всем ожидающим.
+        """
+        call = self._calls.get(key)
+        shared = call is not None
+
+        if call is None:
+            call = _Call(asyncio.ensure_future(func()))
+            self._calls[key] = call
+
+            def on_done(task: asyncio.Task, key=key, call=call):
+                self._forget(key, call)
+                # Помечаем исключение как полученное, даже если ждать уже некому
+                if not task.cancelled():
+                    task.exception()
+
+            call.task.add_done_callback(on_done)
+        else:
+            self.coalesced += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task), shared
+        except asyncio.CancelledError:
+            if call.waiters == 1 and not call.task.done():
+                # Последний ожидающий ушел - результат никому не нужен
+                self._forget(key, call)
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Выполняется ли сейчас вызов с таким ключом"""
+        return key in self._calls
@@ -0,0 +1,158 @@
+"""
+Работа с загружаемыми файлами без чтения целиком в память
+Ограничение размера тела запроса, потоковое вычисление SHA256 и
+копирование загрузок во временные файлы с переходом на диск
+"""
+
+import json
+import hashlib
+import tempfile
+from typing import BinaryIO, Dict, Optional, Tuple
+
+# Размер блока при чтении загрузок
+CHUNK_SIZE = 1024 * 1024
+
+
+class RequestTooLarge(Exception):
+    """Тело запроса превысило допустимый размер"""
+
+
+def hash_file(file: BinaryIO) -> Tuple[str, int]:
+    """
+    Вычисляет SHA256 и размер файла, читая его блоками
+
+    Returns:
+        Кортеж (хэш, размер в байтах); позиция файла возвращается в начало
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    file.seek(0)
+    while True:
+        chunk = file.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        sha256.update(chunk)
+        size += len(chunk)
+    file.seek(0)
+    return sha256.hexdigest(), size
+
+
+def read_limited(file: BinaryIO, limit: int) -> Optional[bytes]:
+    """
+    Читает файл в память, если он не больше limit байт
+
+    Returns:
+        Содержимое файла или None, если он больше limit; позиция файла
+        возвращается в начало
+    """
+    file.seek(0)
+    content = file.read(limit + 1)
+    file.seek(0)
+    return content if len(content) <= limit else None
+
+
+def spool_copy(source: BinaryIO, spool_threshold: int) -> Tuple[BinaryIO, str, int]:
+    """
+    Копирует поток во временный файл, одновременно считая SHA256
+
+    Файл держится в памяти, пока не превысит spool_threshold байт, затем
+    переносится на диск. Закрыть файл должен вызывающий код.
+
+    Returns:
+        Кортеж (временный файл, хэш, размер в байтах)
+    """
+    target = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        while True:
+            chunk = source.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            target.write(chunk)
+            size += len(chunk)
+    except BaseException:
+        target.close()
+        raise
+    target.seek(0)
+    return target, sha256.hexdigest(), size
+
+
+class BodySizeLimitMiddleware:
+    """
+    ASGI middleware, ограничивающее размер тела запроса
+
+    Запрос с заявленным Content-Length больше лимита отклоняется до чтения
+    тела. Без Content-Length (chunked) прочитанные байты считаются по мере
+    поступления, и запрос обрывается, как только лимит превышен.
+    """
+
+    def __init__(self, app, max_body_size: int, path_limits: Optional[Dict[str, int]] = None):
+        self.app = app
+        self.max_body_size = max_body_size
+        self.path_limits = path_limits or {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        limit = self.path_limits.get(scope["path"], self.max_body_size)
+        if limit <= 0:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        content_length = headers.get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            await self._reject(send, limit)
+            return
+
+        received = 0
+        exceeded = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            if exceeded:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    exceeded = True
+                    raise RequestTooLarge()
+            return message
+
+        async def guarded_send(message):
+            # Ответ приложения на оборванное тело (обычно 400) заменяем на 413
+            if not exceeded:
+                await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except RequestTooLarge:
+            pass
+        except Exception:
+            if not exceeded:
+                raise
+
+        if exceeded:
+            await self._reject(send, limit)
+
+    @staticmethod
+    async def _reject(send, limit: int):
+        body = json.dumps(
+            {"detail": f"Размер запроса превышает {limit / 1024 / 1024:.1f} MB"},
+            ensure_ascii=False
+        ).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"connection", b"close")
+            ]
+        })
+        await send({"type": "http.response.body", "body": body})
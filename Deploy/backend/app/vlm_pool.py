@@ -0,0 +1,214 @@
+"""
+Пул реплик VLM сервиса
+Запрос направляется на реплику с наименьшим числом выполняющихся запросов;
+реплики с разомкнутым circuit breaker исключаются. Опционально запрос
+дублируется (hedging) на свободную реплику, если первая отвечает дольше
+заданного перцентиля задержки
+"""
+
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence
+
+import httpx
+
+from health import CircuitBreaker, CircuitOpenError, CIRCUIT_CLOSED
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(samples: Sequence[float], p: float) -> Optional[float]:
+    """Перцентиль p (0-100) по выборке, None для пустой выборки"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class VLMReplica:
+    """Одна реплика VLM сервиса: клиент, circuit breaker и статистика"""
+
+    def __init__(
+        self,
+        key: str,
+        url: str,
+        client: httpx.AsyncClient,
+        breaker: CircuitBreaker,
+        latency_window: int
+    ):
+        self.key = key
+        self.url = url
+        self.client = client
+        self.breaker = breaker
+
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.hedged = 0
+        self.latencies: deque = deque(maxlen=latency_window)
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики реплики"""
+        p50 = percentile(self.latencies, 50)
+        p95 = percentile(self.latencies, 95)
+        return {
+            "url": self.url,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "hedged_requests": self.hedged,
+            "latency_p50": round(p50, 3) if p50 is not None else None,
+            "latency_p95": round(p95, 3) if p95 is not None else None,
+            "circuit": self.breaker.state
+        }
+
+
+class VLMPool:
+    """Балансировка запросов между репликами VLM сервиса"""
+
+    def __init__(
+        self,
+        replicas: List[VLMReplica],
+        hedge_percentile: float,
+        hedge_min_samples: int,
+        latency_window: int
+    ):
+        self.replicas = replicas
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self._latencies: deque = deque(maxlen=latency_window)
+
+        # Метрики
+        self.hedges_started = 0
+        self.hedges_won = 0
+
+    def select(self) -> VLMReplica:
+        """
+        Выбирает реплику с наименьшим числом выполняющихся запросов
+
+        Raises:
+            CircuitOpenError: все реплики исключены
+        """
+        # Сначала реплики с замкнутой цепью, затем - пробный запрос в half-open
+        closed = [r for r in self.replicas if r.breaker.state == CIRCUIT_CLOSED]
+        for replica in sorted(closed or self.replicas, key=lambda r: (r.in_flight, r.requests)):
+            if replica.breaker.allow():
+                return replica
+
+        retry_after = min(r.breaker.retry_after() for r in self.replicas)
+        raise CircuitOpenError("VLM Service", retry_after)
+
+    def peek(self) -> Optional[VLMReplica]:
+        """Наименее загруженная доступная реплика без учета запроса (для служебных вызовов)"""
+        closed = [r for r in self.replicas if r.breaker.state == CIRCUIT_CLOSED]
+        return min(closed, key=lambda r: r.in_flight) if closed else None
+
+    @asynccontextmanager
+    async def acquire(self, replica: Optional[VLMReplica] = None) -> AsyncIterator[VLMReplica]:
+        """
+        Занимает реплику (по умолчанию - выбранную select()) на время запроса
+        и учитывает его задержку
+
+        Raises:
+            CircuitOpenError: нет доступных реплик
+        """
+        replica = replica or self.select()
+        replica.in_flight += 1
+        replica.requests += 1
+        start = time.monotonic()
+        try:
+            yield replica
+        except asyncio.CancelledError:
+            raise
+        except BaseException:
+            replica.errors += 1
+            raise
+        else:
+            latency = time.monotonic() - start
+            replica.latencies.append(latency)
+            self._latencies.append(latency)
+        finally:
+            replica.in_flight -= 1
+
+    def hedge_delay(self) -> Optional[float]:
+        """Через сколько секунд дублировать запрос, None - hedging выключен"""
+        if self.hedge_percentile <= 0 or len(self.replicas) < 2:
+            return None
+        if len(self._latencies) < self.hedge_min_samples:
+            return None
+        return percentile(self._latencies, self.hedge_percentile)
+
+    def _idle_replica(self, exclude: Sequence[VLMReplica]) -> Optional[VLMReplica]:
+        # Дублируем только на простаивающую реплику, чтобы не увеличивать
+        # нагрузку на пул, когда он и так занят
+        for replica in self.replicas:
+            if (replica not in exclude and replica.in_flight == 0
+                    and replica.breaker.state == CIRCUIT_CLOSED):
+                return replica
+        return None
+
+    async def call(self, send: Callable[[VLMReplica], Awaitable[Any]], hedge: bool = True) -> Any:
+        """
+        Выполняет send(replica) на наименее загруженной реплике
+
+        Если ответ не пришел за hedge_delay(), тот же запрос отправляется на
+        свободную реплику; возвращается первый успешный ответ, второй запрос
+        отменяется. Попытки выполняются одновременно, поэтому send не должен
+        делить между ними один поток данных; hedge=False - без дублирования.
+        """
+        async def attempt(replica: VLMReplica) -> Any:
+            async with self.acquire(replica):
+                return await send(replica)
+
+        primary_replica = self.select()
+        delay = self.hedge_delay() if hedge else None
+        if delay is None:
+            return await attempt(primary_replica)
+
+        primary = asyncio.ensure_future(attempt(primary_replica))
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                hedge_replica = self._idle_replica(exclude=[primary_replica])
+                if hedge_replica is not None:
+                    self.hedges_started += 1
+                    hedge_replica.hedged += 1
+                    logger.info(
+                        f"🔀 Запрос к {primary_replica.url} дольше {delay:.1f}s, "
+                        f"дублируем на {hedge_replica.url}"
+                    )
+                    tasks.append(asyncio.ensure_future(attempt(hedge_replica)))
+
+            # Первый успешный ответ; ошибку возвращаем, только если упали все
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.hedges_won += 1
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики пула"""
+        delay = self.hedge_delay()
+        return {
+            "replicas": {replica.key: replica.stats() for replica in self.replicas},
+            "hedging": {
+                "percentile": self.hedge_percentile,
+                "delay": round(delay, 3) if delay is not None else None,
+                "started": self.hedges_started,
+                "won": self.hedges_won
+            }
+        }
@@ -0,0 +1,130 @@
+"""
+Пакетный клиент Backend API
+Считает SHA256 файлов локально, получает готовые результаты через
+/api/v1/results/lookup и загружает в /api/v1/process/batch только файлы,
+которых еще нет в кэше.
+
+Использование:
+    python batch_client.py diagrams/ extra.bpmn -o results.json
+"""
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+from typing import Any, Dict, List
+
+import requests
+
+BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
+
+SUPPORTED_FORMATS = {'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.bpmn', '.puml', '.mmd', '.drawio'}
+
+# Не больше BATCH_MAX_FILES backend'а в одном запросе
+CHUNK_SIZE = int(os.getenv("BATCH_CLIENT_CHUNK_SIZE", "100"))
+
+
+def collect_files(paths: List[str]) -> List[str]:
+    """Файлы поддерживаемых форматов из аргументов (каталоги обходятся рекурсивно)"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        else:
+            files.append(path)
+    return [path for path in files if os.path.splitext(path)[1].lower() in SUPPORTED_FORMATS]
+
+
+def hash_file(path: str) -> str:
+    """SHA256 файла, читая его блоками"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def lookup(paths: List[str], hashes: Dict[str, str]) -> Dict[str, Any]:
+    """Готовые результаты по хэшам: хэш -> ответ как у /api/v1/process"""
+    response = requests.post(
+        f"{BACKEND_URL}/api/v1/results/lookup",
+        json={"files": [
+            {"file_hash": hashes[path], "file_name": os.path.basename(path), "file_size": os.path.getsize(path)}
+            for path in paths
+        ]},
+        timeout=30
+    )
+    response.raise_for_status()
+    return response.json()["results"]
+
+
+def upload(paths: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Обрабатывает файлы через /api/v1/process/batch
+
+    Returns:
+        Путь -> строка результата из NDJSON ответа
+    """
+    handles = [open(path, "rb") for path in paths]
+    try:
+        files = [("files", (os.path.basename(path), handle)) for path, handle in zip(paths, handles)]
+        with requests.post(
+            f"{BACKEND_URL}/api/v1/process/batch", files=files, stream=True, timeout=(5, 600)
+        ) as response:
+            response.raise_for_status()
+            results = {}
+            for line in response.iter_lines(decode_unicode=True):
+                if not line:
+                    continue
+                item = json.loads(line)
+                if item["type"] == "result":
+                    results[paths[item["index"]]] = item
+            return results
+    finally:
+        for handle in handles:
+            handle.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пакетное распознавание диаграмм")
+    parser.add_argument("paths", nargs="+", help="Файлы или каталоги с диаграммами")
+    parser.add_argument("-o", "--output", default="results.json", help="Файл для результатов (JSON)")
+    args = parser.parse_args()
+
+    paths = collect_files(args.paths)
+    if not paths:
+        print("❌ Нет файлов поддерживаемых форматов")
+        sys.exit(1)
+
+    hashes = {path: hash_file(path) for path in paths}
+    results: Dict[str, Dict[str, Any]] = {}
+    found = uploaded = 0
+
+    for start in range(0, len(paths), CHUNK_SIZE):
+        chunk = paths[start:start + CHUNK_SIZE]
+
+        # 1. Результаты уже обработанных файлов - без загрузки
+        cached = lookup(chunk, hashes)
+        for path in chunk:
+            if hashes[path] in cached:
+                results[path] = {"status": "success", "result": cached[hashes[path]]}
+                found += 1
+
+        # 2. Остальные файлы загружаются
+        missing = [path for path in chunk if path not in results]
+        if missing:
+            for path, item in upload(missing).items():
+                results[path] = {key: item[key] for key in ("status", "result", "error") if key in item}
+            uploaded += len(missing)
+
+        print(f"📦 {min(start + CHUNK_SIZE, len(paths))}/{len(paths)}: найдено по хэшу {found}, загружено {uploaded}")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"✅ Результаты записаны в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
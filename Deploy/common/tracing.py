@@ -0,0 +1,377 @@
+"""
+Трассировка запросов между сервисами
+Span - замер одного этапа с trace_id всего запроса. Контекст передается
+между сервисами заголовком traceparent (W3C Trace Context), id запроса
+возвращается клиенту в X-Request-ID. Завершенные span'ы пишутся в
+фоновом потоке в локальный JSONL файл или отправляются в OTLP/HTTP
+коллектор (OpenTelemetry Collector, Jaeger, Tempo).
+
+Модуль не зависит от кода сервисов и хранится в одном экземпляре: Dockerfile
+каждого сервиса копирует его из common/ рядом с main.py.
+"""
+
+import os
+import json
+import time
+import queue
+import logging
+import secrets
+import threading
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация из переменных окружения
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "jsonl")  # jsonl, otlp или none
+TRACE_JSONL_DIR = os.getenv("TRACE_JSONL_DIR", "/traces")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://otel-collector:4318")
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "10000"))
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "200"))
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", "1"))
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+# (trace_id, span_id) текущего span'а
+_current: ContextVar[Optional[Tuple[str, str]]] = ContextVar("current_span", default=None)
+
+
+def new_trace_id() -> str:
+    return secrets.token_hex(16)
+
+
+def new_span_id() -> str:
+    return secrets.token_hex(8)
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[Tuple[str, str]]:
+    """
+    Разбирает заголовок traceparent: 00-<trace_id>-<span_id>-<flags>
+
+    Returns:
+        (trace_id, span_id) или None, если заголовок некорректен
+    """
+    if not value:
+        return None
+    parts = value.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32:
+        return None
+    return parts[1], parts[2]
+
+
+def current_context() -> Optional[Tuple[str, str]]:
+    """(trace_id, span_id) текущего span'а или None вне запроса"""
+    return _current.get()
+
+
+def current_trace_id() -> Optional[str]:
+    context = _current.get()
+    return context[0] if context else None
+
+
+def trace_headers() -> Dict[str, str]:
+    """Заголовки для передачи контекста в другой сервис"""
+    context = _current.get()
+    if context is None:
+        return {}
+    trace_id, span_id = context
+    return {
+        "traceparent": f"00-{trace_id}-{span_id}-01",
+        REQUEST_ID_HEADER: trace_id
+    }
+
+
+class TraceIdLogFilter(logging.Filter):
+    """Добавляет trace_id текущего запроса в записи лога (поле %(trace_id)s)"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = current_trace_id() or "-"
+        return True
+
+
+class _Exporter:
+    """Фоновая запись span'ов пачками: в JSONL файл или в OTLP/HTTP коллектор"""
+
+    def __init__(self, service: str, kind: str):
+        self.service = service
+        self.kind = kind
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self.path = os.path.join(TRACE_JSONL_DIR, f"{service}.jsonl")
+        self.url = TRACE_OTLP_ENDPOINT.rstrip("/") + "/v1/traces"
+
+        # Метрики
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+
+        if kind == "jsonl":
+            os.makedirs(TRACE_JSONL_DIR, exist_ok=True)
+        self._thread.start()
+
+    def export(self, span: Dict[str, Any]):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            # Трассировка не должна тормозить обработку запросов
+            self.dropped += 1
+
+    def shutdown(self, timeout: float = 5):
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch: List[Dict[str, Any]] = []
+            deadline = time.monotonic() + TRACE_FLUSH_INTERVAL
+            while len(batch) < TRACE_BATCH_SIZE:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            if not batch:
+                continue
+            try:
+                if self.kind == "otlp":
+                    self._send_otlp(batch)
+                else:
+                    self._write_jsonl(batch)
+                self.exported += len(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                logger.warning(f"⚠️  Не удалось экспортировать span'ы ({len(batch)}): {e}")
+
+    def _write_jsonl(self, batch: List[Dict[str, Any]]):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for span in batch:
+                f.write(json.dumps(span, ensure_ascii=False) + "\n")
+
+    def _send_otlp(self, batch: List[Dict[str, Any]]):
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [_otlp_attribute("service.name", self.service)]},
+                "scopeSpans": [{
+                    "scope": {"name": "nexign.tracing"},
+                    "spans": [_otlp_span(span) for span in batch]
+                }]
+            }]
+        }
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST"
+        )
+        with urllib.request.urlopen(request, timeout=5) as response:
+            response.read()
+
+
+def _otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def _otlp_span(span: Dict[str, Any]) -> Dict[str, Any]:
+    result = {
+        "traceId": span["trace_id"],
+        "spanId": span["span_id"],
+        "name": span["name"],
+        # 2 - SERVER для входящего запроса, 1 - INTERNAL
+        "kind": 2 if span["attributes"].get("http.method") else 1,
+        "startTimeUnixNano": str(int(span["start"] * 1e9)),
+        "endTimeUnixNano": str(int(span["end"] * 1e9)),
+        "attributes": [_otlp_attribute(k, v) for k, v in span["attributes"].items() if v is not None],
+        # 1 - OK, 2 - ERROR
+        "status": {"code": 2 if span["status"] == "error" else 1}
+    }
+    if span["parent_id"]:
+        result["parentSpanId"] = span["parent_id"]
+    return result
+
+
+_service = "unknown"
+_exporter: Optional[_Exporter] = None
+
+
+def configure_tracing(service: str):
+    """Включает экспорт span'ов сервиса (TRACE_EXPORTER=none - только контекст)"""
+    global _service, _exporter
+    _service = service
+    if TRACE_EXPORTER in ("jsonl", "otlp") and _exporter is None:
+        try:
+            _exporter = _Exporter(service, TRACE_EXPORTER)
+            target = _exporter.url if TRACE_EXPORTER == "otlp" else _exporter.path
+            logger.info(f"🧭 Трассировка: {TRACE_EXPORTER} -> {target}")
+        except OSError as e:
+            logger.warning(f"⚠️  Трассировка выключена: {e}")
+
+
+def shutdown_tracing():
+    """Дописывает оставшиеся span'ы"""
+    global _exporter
+    if _exporter is not None:
+        _exporter.shutdown()
+        _exporter = None
+
+
+def tracing_stats() -> Dict[str, Any]:
+    """Метрики экспорта"""
+    if _exporter is None:
+        return {"exporter": "none"}
+    return {
+        "exporter": _exporter.kind,
+        "exported": _exporter.exported,
+        "dropped": _exporter.dropped,
+        "failed": _exporter.failed
+    }
+
+
+def record_span(
+    name: str,
+    start: float,
+    end: float,
+    status: str = "ok",
+    parent: Optional[Tuple[str, str]] = None,
+    span_id: Optional[str] = None,
+    **attributes: Any
+) -> Optional[Tuple[str, str]]:
+    """
+    Записывает уже завершившийся этап (время - time.time())
+
+    Args:
+        parent: (trace_id, span_id) родителя; по умолчанию - текущий span
+
+    Returns:
+        (trace_id, span_id) записанного span'а или None вне запроса
+    """
+    parent = parent or _current.get()
+    if parent is None:
+        return None
+    span_id = span_id or new_span_id()
+    if _exporter is not None:
+        _exporter.export({
+            "trace_id": parent[0],
+            "span_id": span_id,
+            "parent_id": parent[1],
+            "service": _service,
+            "name": name,
+            "start": start,
+            "end": end,
+            "duration_ms": round((end - start) * 1000, 3),
+            "status": status,
+            "attributes": attributes
+        })
+    return parent[0], span_id
+
+
+@contextmanager
+def span(
+    name: str,
+    parent: Optional[Tuple[str, str]] = None,
+    root: bool = False,
+    **attributes: Any
+) -> Iterator[Dict[str, Any]]:
+    """
+    Замеряет этап как span и делает его текущим внутри блока
+
+    Вне запроса (нет текущего span'а, parent и root не заданы) ничего не
+    записывает. Исключение внутри блока записывается со статусом error.
+
+    Args:
+        parent: (trace_id, span_id) родителя вместо текущего span'а
+        root: начать новую трассировку, если родителя нет
+
+    Yields:
+        Словарь атрибутов span'а - в него можно дописать значения
+    """
+    parent = parent or _current.get()
+    if parent is None and not root:
+        yield attributes
+        return
+
+    trace_id = parent[0] if parent else new_trace_id()
+    span_id = new_span_id()
+    token = _current.set((trace_id, span_id))
+    start = time.time()
+    status = "ok"
+    try:
+        yield attributes
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        try:
+            _current.reset(token)
+        except ValueError:
+            # Генератор закрыт из другого контекста (например, при отключении клиента)
+            pass
+        if attributes.get("http.status_code", 0) >= 500:
+            status = "error"
+        record_span(
+            name, start, time.time(), status,
+            parent=(trace_id, parent[1] if parent else ""), span_id=span_id,
+            **attributes
+        )
+
+
+class TraceMiddleware:
+    """
+    ASGI middleware: span на каждый HTTP запрос
+
+    Продолжает трассировку из заголовка traceparent или начинает новую и
+    возвращает trace_id клиенту в заголовке X-Request-ID.
+    """
+
+    def __init__(self, app, exclude_paths: Tuple[str, ...] = ("/health", "/metrics")):
+        self.app = app
+        self.exclude_paths = exclude_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.exclude_paths):
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        parent = parse_traceparent(headers.get(b"traceparent", b"").decode("latin-1"))
+
+        with span(
+            f"{scope['method']} {scope['path']}",
+            parent=parent,
+            root=True,
+            **{"http.method": scope["method"], "http.route": scope["path"]}
+        ) as attributes:
+            trace_id = current_trace_id()
+
+            async def traced_send(message):
+                if message["type"] == "http.response.start":
+                    attributes["http.status_code"] = message["status"]
+                    message.setdefault("headers", [])
+                    message["headers"] = [
+                        *message["headers"],
+                        (REQUEST_ID_HEADER.lower().encode(), trace_id.encode())
+                    ]
+                await send(message)
+
+            await self.app(scope, receive, traced_send)
@@ -4,16 +4,21 @@ Frontend UI Service - Streamlit интерфейс для загрузки ди
 """
 
 import os
+import json
+import hashlib
 import requests
 import streamlit as st
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Iterator, Tuple
 
 # Конфигурация
 BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
 API_ENDPOINT = f"{BACKEND_URL}/api/v1/process"
+STREAM_ENDPOINT = f"{BACKEND_URL}/api/v1/process/stream"
+RESULTS_ENDPOINT = f"{BACKEND_URL}/api/v1/results"
 STATISTICS_ENDPOINT = f"{BACKEND_URL}/api/v1/statistics"
 RECENT_ENDPOINT = f"{BACKEND_URL}/api/v1/recent"
+HEALTH_CACHE_TTL = int(os.getenv("HEALTH_CACHE_TTL", "10"))
 
 # Поддерживаемые форматы
 SUPPORTED_FORMATS = [
@@ -70,10 +75,11 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 
+@st.cache_data(ttl=HEALTH_CACHE_TTL, show_spinner=False)
 def check_backend_health() -> bool:
-    """Проверяет доступность backend сервиса"""
+    """Проверяет доступность backend сервиса (результат кэшируется между перерисовками)"""
     try:
-        response = requests.get(f"{BACKEND_URL}/health", timeout=5)
+        response = requests.get(f"{BACKEND_URL}/health", timeout=2)
         return response.status_code == 200
     except:
         return False
@@ -101,24 +107,62 @@ def get_recent_requests() -> Optional[Dict[str, Any]]:
     return None
 
 
-def process_diagram(file) -> Optional[Dict[str, Any]]:
-    """Отправляет файл на обработку в backend"""
+def lookup_result(file) -> Optional[Dict[str, Any]]:
+    """
+    Ищет готовый результат по SHA256 файла, не загружая файл в backend
+    
+    Returns:
+        Ответ как у /api/v1/process или None, если файл нужно обработать
+    """
+    content = file.getvalue()
+    file_hash = hashlib.sha256(content).hexdigest()
     try:
-        files = {"file": (file.name, file.getvalue(), file.type)}
-        response = requests.post(API_ENDPOINT, files=files, timeout=120)
-        
+        response = requests.get(
+            f"{RESULTS_ENDPOINT}/{file_hash}",
+            params={"file_name": file.name, "file_size": len(content)},
+            timeout=5
+        )
         if response.status_code == 200:
             return response.json()
-        else:
-            st.error(f"Ошибка сервера: {response.status_code}")
-            st.error(response.text)
-            return None
+    except:
+        # Поиск - только оптимизация: при ошибке файл просто обрабатывается
+        pass
+    return None
+
+
+def stream_diagram(file) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Отправляет файл на потоковую обработку в backend
+    
+    Yields:
+        Пары (тип события, данные) из потока Server-Sent Events
+    """
+    try:
+        files = {"file": (file.name, file.getvalue(), file.type)}
+        # Таймаут чтения - пауза между событиями, а не время всей обработки
+        with requests.post(STREAM_ENDPOINT, files=files, stream=True, timeout=(5, 120)) as response:
+            if response.status_code != 200:
+                st.error(f"Ошибка сервера: {response.status_code}")
+                st.error(response.text)
+                return
+            
+            response.encoding = "utf-8"
+            event_type = "message"
+            data_lines = []
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event_type = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    data_lines.append(line[len("data:"):].strip())
+                elif not line and data_lines:
+                    # Пустая строка завершает событие
+                    yield event_type, json.loads("\n".join(data_lines))
+                    event_type = "message"
+                    data_lines = []
     except requests.exceptions.Timeout:
         st.error("⏱️ Превышено время ожидания. Попробуйте еще раз.")
-        return None
     except Exception as e:
         st.error(f"❌ Ошибка при обработке: {str(e)}")
-        return None
 
 
 # Заголовок
@@ -223,34 +267,71 @@ with tab1:
         
         # Кнопка обработки
         if st.button("🚀 Распознать диаграмму", type="primary", use_container_width=True):
-            with st.spinner("⏳ Обработка диаграммы... Это может занять до 20 секунд"):
-                result = process_diagram(uploaded_file)
+            status = st.empty()
+            status.info("⏳ Отправка диаграммы...")
+            
+            st.markdown("### 📋 Описание алгоритма")
+            table_placeholder = st.empty()
+            
+            # Файл, который уже распознавался, в backend не отправляется
+            description = ""
+            result = lookup_result(uploaded_file)
+            found_by_hash = result is not None
+            
+            # Таблица отрисовывается по мере генерации
+            if not found_by_hash:
+                for event_type, data in stream_diagram(uploaded_file):
+                    if event_type == "stage":
+                        stage_text = {
+                            "converting": "🔄 Конвертация диаграммы в PNG...",
+                            "inferring": "🧠 Распознавание диаграммы..."
+                        }
+                        status.info(stage_text.get(data.get("stage"), "⏳ Обработка..."))
+                    elif event_type == "token":
+                        description += data.get("text", "")
+                        table_placeholder.markdown(description)
+                    elif event_type == "done":
+                        result = data
+                    elif event_type == "error":
+                        status.empty()
+                        st.error(f"Ошибка сервера: {data.get('status_code')}")
+                        st.error(data.get("detail"))
+            
+            if result:
+                if found_by_hash:
+                    status.success("⚡ Результат найден по хэшу, загрузка не потребовалась")
+                else:
+                    status.success("✅ Диаграмма успешно распознана!")
+                table_placeholder.markdown(result.get("description", ""))
+                
+                # Метаданные
+                st.markdown("### 📊 Метаданные")
+                metadata = result.get("metadata", {})
+                
+                def format_seconds(value) -> str:
+                    return f"{value:.2f}s" if value is not None else "N/A"
+                
+                col1, col2, col3, col4 = st.columns(4)
+                with col1:
+                    st.metric("Время обработки", format_seconds(metadata.get('processing_time', 0)))
+                with col2:
+                    st.metric("Первый токен", format_seconds(metadata.get('time_to_first_token')))
+                with col3:
+                    st.metric("Первая строка", format_seconds(metadata.get('time_to_first_row')))
+                with col4:
+                    st.metric("Время инференса", format_seconds(metadata.get('inference_time', 0)))
+                
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.metric("Модель", (metadata.get('model') or 'N/A').split('/')[-1])
+                with col2:
+                    st.metric("Устройство", metadata.get('device', 'N/A'))
                 
-                if result:
-                    st.success("✅ Диаграмма успешно распознана!")
-                    
-                    # Результат
-                    st.markdown("### 📋 Описание алгоритма")
-                    description = result.get("description", "")
-                    st.markdown(description)
-                    
-                    # Метаданные
-                    st.markdown("### 📊 Метаданные")
-                    metadata = result.get("metadata", {})
-                    
-                    col1, col2, col3, col4 = st.columns(4)
-                    with col1:
-                        st.metric("Время обработки", f"{metadata.get('processing_time', 0):.2f}s")
-                    with col2:
-                        st.metric("Время инференса", f"{metadata.get('inference_time', 0):.2f}s")
-                    with col3:
-                        st.metric("Модель", metadata.get('model', 'N/A').split('/')[-1])
-                    with col4:
-                        st.metric("Устройство", metadata.get('device', 'N/A'))
-                    
-                    # Дополнительная информация
-                    with st.expander("🔍 Подробная информация"):
-                        st.json(metadata)
+                # Дополнительная информация
+                with st.expander("🔍 Подробная информация"):
+                    st.json(metadata)
+            elif description:
+                status.warning("⚠️ Генерация прервана, показан частичный результат")
 
 with tab2:
     st.header("История запросов")
@@ -0,0 +1,147 @@
+"""
+Monolith Service - весь конвейер распознавания в одном процессе
+API совместим с Backend API Service (/api/v1/process), но конвертация,
+инференс и запись в SQLite выполняются без HTTP вызовов между сервисами
+"""
+
+import logging
+from datetime import datetime
+from contextlib import asynccontextmanager
+
+from pipeline import Pipeline, backend, database, vlm
+
+from fastapi import FastAPI, File, UploadFile
+from fastapi.responses import JSONResponse, Response
+from fastapi.middleware.cors import CORSMiddleware
+
+from uploads import BodySizeLimitMiddleware
+from metrics import render_metrics
+from tracing import TraceMiddleware, configure_tracing, shutdown_tracing, tracing_stats, REQUEST_ID_HEADER
+
+logger = logging.getLogger(__name__)
+
+pipeline = Pipeline()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Управление жизненным циклом приложения"""
+    # Startup
+    logger.info("=" * 60)
+    logger.info("🚀 Запуск Monolith Service")
+    logger.info(f"💾 База данных: {database.DB_PATH}")
+    logger.info("=" * 60)
+
+    configure_tracing("monolith")
+    await pipeline.start()
+    logger.info("✅ Monolith Service готов к работе")
+
+    yield
+
+    # Shutdown
+    logger.info("🛑 Остановка Monolith Service")
+    await pipeline.stop()
+    logger.info(f"📊 Всего запросов: {backend.total_requests}")
+    shutdown_tracing()
+
+
+# Создание FastAPI приложения
+app = FastAPI(
+    title="Monolith Service",
+    description="Распознавание диаграмм в одном процессе (Backend + Adapter + VLM + DB)",
+    version="1.0.0",
+    lifespan=lifespan
+)
+
+# Ограничение размера тела запроса (до чтения загрузки целиком)
+app.add_middleware(BodySizeLimitMiddleware, max_body_size=backend.MAX_UPLOAD_SIZE)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=[REQUEST_ID_HEADER],
+)
+
+app.add_middleware(TraceMiddleware)
+
+
+@app.get("/")
+async def root():
+    """Корневой эндпоинт с информацией о сервисе"""
+    return {
+        "service": "Monolith Service",
+        "version": "1.0.0",
+        "status": "running",
+        "endpoints": {
+            "process": "/api/v1/process (POST)",
+            "statistics": "/api/v1/statistics (GET)",
+            "recent": "/api/v1/recent (GET)",
+            "health": "/health (GET)",
+            "metrics": "/metrics (GET)",
+            "metrics_prometheus": "/metrics/prometheus (GET)",
+            "docs": "/docs"
+        }
+    }
+
+
+@app.get("/health")
+async def health_check():
+    """Проверка здоровья: сервис готов, когда модель загружена"""
+    model_loaded = vlm.model is not None
+    return {
+        "status": "healthy" if model_loaded else "degraded",
+        "model_loaded": model_loaded,
+        "timestamp": datetime.utcnow().isoformat()
+    }
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Получение метрик работы сервиса"""
+    return {**pipeline.stats(), "tracing": tracing_stats()}
+
+
+@app.get("/metrics/prometheus")
+async def get_prometheus_metrics():
+    """Метрики всех этапов (backend_*, adapter_*, vlm_*) в формате Prometheus"""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
+@app.post("/api/v1/process")
+async def process_diagram(file: UploadFile = File(...)):
+    """
+    Обработка диаграммы, как в Backend API Service
+
+    Args:
+        file: Файл диаграммы (PNG, JPG, BPMN, PlantUML, Mermaid, Draw.io)
+
+    Returns:
+        JSON с описанием алгоритма и метаданными
+    """
+    logger.info("=" * 60)
+    logger.info(f"📥 Получен запрос на обработку: {file.filename}")
+
+    content = await file.read()
+    response_data = await pipeline.process(file.filename, content)
+    return JSONResponse(content=response_data)
+
+
+@app.get("/api/v1/statistics")
+async def get_statistics():
+    """Статистика по всем запросам из SQLite"""
+    return JSONResponse(content=database.get_statistics())
+
+
+@app.get("/api/v1/recent")
+async def get_recent():
+    """Последние 20 запросов из SQLite"""
+    return JSONResponse(content={"requests": database.get_recent_requests(limit=20)})
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,315 @@
+"""
+Весь конвейер распознавания в одном процессе
+Валидация (Backend), конвертация (Adapter), инференс (VLM Service) и
+логирование в SQLite (DB) вызываются напрямую: без HTTP между сервисами и
+повторного multipart кодирования файла. Используются функции самих
+сервисов, поэтому ответ совпадает с /api/v1/process микросервисного режима.
+
+Использование из кода (пакетные задачи):
+
+    pipeline = Pipeline()
+    await pipeline.start()
+    response = await pipeline.process("diagram.png", content)
+    await pipeline.stop()
+
+Или из командной строки:
+
+    python pipeline.py a.png b.png > results.json
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import importlib.util
+from datetime import datetime
+from types import ModuleType
+from typing import Any, Dict, List, Optional
+
+# Каталог с исходниками сервисов (Deploy/ в репозитории)
+SERVICES_ROOT = os.getenv(
+    "SERVICES_ROOT",
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+)
+SERVICE_DIRS = ["backend", "adapter", "ML-container", "DB"]
+
+# Модули сервисов (cache, quality, database...) импортируются по именам,
+# как внутри контейнеров; общий tracing.py - из common/
+for service_app_dir in [
+    *(os.path.join(SERVICES_ROOT, service, "app") for service in SERVICE_DIRS),
+    os.path.join(SERVICES_ROOT, "common")
+]:
+    if service_app_dir not in sys.path:
+        sys.path.append(service_app_dir)
+
+
+def load_service_module(name: str, service: str) -> ModuleType:
+    """Импортирует main.py сервиса под отдельным именем (у всех сервисов он main)"""
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(SERVICES_ROOT, service, "app", "main.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+backend = load_service_module("backend_main", "backend")
+adapter = load_service_module("adapter_main", "adapter")
+vlm = load_service_module("vlm_main", "ML-container")
+
+import database
+from fastapi import HTTPException
+from cache import build_model_key
+from metrics import stage_timer, STAGE_CACHE_LOOKUP, STAGE_CONVERSION, STAGE_VLM_INFERENCE
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация из переменных окружения
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "50"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1"))
+
+
+class SQLiteLogWriter:
+    """
+    Очередь записей inference_logs с пакетной записью в SQLite в фоне
+
+    Тот же интерфейс enqueue, что у очереди логов Backend, поэтому
+    complete_request Backend'а пишет в БД напрямую.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+        # Метрики
+        self.written = 0
+        self.failed = 0
+
+    def enqueue(self, record: Dict[str, Any]):
+        """Добавляет запись в очередь, не дожидаясь записи в БД"""
+        self._queue.put_nowait(record)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает запись и сбрасывает оставшиеся записи"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        while not self._queue.empty():
+            await self._write(self._drain())
+
+    def _drain(self) -> List[Dict[str, Any]]:
+        batch = []
+        while not self._queue.empty() and len(batch) < self.batch_size:
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _write(self, batch: List[Dict[str, Any]]):
+        if not batch:
+            return
+        try:
+            _, failed = await asyncio.to_thread(database.log_inference_requests_batch, batch)
+            self.written += len(batch) - len(failed)
+            self.failed += len(failed)
+        except Exception as e:
+            self.failed += len(batch)
+            logger.error(f"❌ Не удалось записать логи в БД ({len(batch)}): {e}")
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            await asyncio.sleep(self.flush_interval if self._queue.qsize() < self.batch_size else 0)
+            batch.extend(self._drain())
+            await self._write(batch)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "failed": self.failed
+        }
+
+
+class Pipeline:
+    """Конвейер Backend -> Adapter -> VLM -> DB в одном процессе"""
+
+    def __init__(self):
+        self.log_writer = SQLiteLogWriter(LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL)
+
+    async def start(self):
+        """Создает БД, загружает модель и запускает запись логов"""
+        await asyncio.to_thread(database.init_database)
+        await asyncio.to_thread(vlm.load_model_and_processor)
+        await vlm.start_inference()
+        # Ответы Backend'а логируются сразу в SQLite вместо DB сервиса
+        backend.log_queue = self.log_writer
+        await self.log_writer.start()
+
+    async def stop(self):
+        """Дорабатывает принятые запросы и дописывает логи"""
+        await vlm.stop_inference()
+        await self.log_writer.stop()
+
+    async def lookup_cached_result(self, file_hash: str, model_key: str) -> Optional[tuple]:
+        """
+        Ищет готовый результат: сначала в памяти, затем в SQLite
+
+        Returns:
+            Кортеж (результат VLM, источник) или None при промахе
+        """
+        cache_key = (file_hash, model_key)
+        result = backend.result_cache.get(cache_key)
+        if result is not None:
+            backend.cache_memory_hits += 1
+            return result, "memory"
+
+        if backend.RESULT_CACHE_DB_LOOKUP:
+            row = await asyncio.to_thread(database.get_request_by_hash, file_hash, model_key)
+            if row:
+                result = backend.result_from_db_row(row)
+                backend.result_cache.set(cache_key, result)
+                backend.cache_db_hits += 1
+                return result, "db"
+
+        backend.cache_misses += 1
+        return None
+
+    async def infer(self, file_ext: str, content: bytes, deadline: float) -> tuple:
+        """
+        Конвертирует файл (если нужно) и распознает его
+
+        Returns:
+            Кортеж (ответ VLM, ключ версии модели)
+        """
+        if file_ext in adapter.SUPPORTED_DIAGRAM_FORMATS:
+            with stage_timer(STAGE_CONVERSION, file_ext):
+                content = adapter.convert_content(file_ext, content)
+
+        # Прерывание по дедлайну - HTTPException 504, как у /infer
+        with stage_timer(STAGE_VLM_INFERENCE, file_ext):
+            result = await vlm.run_inference(content, None, deadline)
+
+        # Ключ берем из ответа, как Backend
+        return result, build_model_key(result.get("metadata", {}))
+
+    async def process(
+        self,
+        file_name: str,
+        content: bytes,
+        deadline: Optional[float] = None
+    ) -> Dict[str, Any]:
+        """
+        Полный цикл обработки одного файла
+
+        Args:
+            file_name: Имя файла (по расширению определяется тип)
+            content: Содержимое файла
+            deadline: Момент (time.monotonic()), после которого генерация
+                прерывается; по умолчанию - через REQUEST_TIMEOUT
+
+        Returns:
+            Ответ как у /api/v1/process
+
+        Raises:
+            HTTPException: с тем же кодом, что вернул бы микросервисный режим
+        """
+        backend.total_requests += 1
+        request_start = datetime.utcnow()
+        if deadline is None:
+            deadline = time.monotonic() + backend.REQUEST_TIMEOUT
+        file_hash = hashlib.sha256(content).hexdigest()
+        file_ext = "unknown"
+
+        try:
+            file_ext = backend.validate_file_extension(file_name)
+            vlm.check_model_ready()
+
+            with stage_timer(STAGE_CACHE_LOOKUP, file_ext):
+                model_key = build_model_key(vlm.get_model_info())
+                cached = await self.lookup_cached_result(file_hash, model_key)
+
+            if cached:
+                result, cache_source = cached
+                logger.info(f"⚡ Результат найден в кэше ({cache_source})")
+            else:
+                cache_source = None
+                # Одновременные запросы с тем же файлом ждут один инференс
+                (result, model_key), shared = await backend.inflight_inferences.do(
+                    file_hash, lambda: self.infer(file_ext, content, deadline)
+                )
+                if not shared and not backend.is_degraded(result):
+                    backend.result_cache.set((file_hash, model_key), result)
+
+            return backend.complete_request(
+                file_name, file_ext, len(content), file_hash, request_start,
+                result, file_ext in backend.SUPPORTED_DIAGRAM_FORMATS, cache_source, model_key
+            )
+
+        except Exception as e:
+            backend.failed_requests += 1
+            error = e if isinstance(e, HTTPException) else HTTPException(
+                status_code=500,
+                detail=f"Внутренняя ошибка сервера: {str(e)}"
+            )
+            if error.status_code == 504:
+                backend.record_cancellation("deadline")
+            self.log_writer.enqueue(backend.build_log_data(
+                file_name=file_name,
+                file_ext=file_ext,
+                file_size=len(content),
+                file_hash=file_hash,
+                total_time=(datetime.utcnow() - request_start).total_seconds(),
+                error_message=str(error.detail)
+            ))
+            if error is e:
+                raise
+            logger.error(f"❌ Неожиданная ошибка: {e}")
+            raise error from e
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики конвейера"""
+        return {
+            "total_requests": backend.total_requests,
+            "successful_requests": backend.successful_requests,
+            "failed_requests": backend.failed_requests,
+            "cache": {
+                "memory_hits": backend.cache_memory_hits,
+                "db_hits": backend.cache_db_hits,
+                "misses": backend.cache_misses,
+                "size": len(backend.result_cache)
+            },
+            "coalesced_requests": backend.inflight_inferences.coalesced,
+            "vlm_queue_depth": vlm.waiting_requests(),
+            "quality": vlm.quality_policy.stats(),
+            "db_logging": self.log_writer.stats()
+        }
+
+
+async def process_paths(paths: List[str]) -> Dict[str, Any]:
+    """Обрабатывает файлы по очереди; ошибки сохраняются в результатах"""
+    pipeline = Pipeline()
+    await pipeline.start()
+    results = {}
+    try:
+        for path in paths:
+            with open(path, "rb") as f:
+                content = f.read()
+            try:
+                results[path] = await pipeline.process(os.path.basename(path), content)
+            except HTTPException as he:
+                results[path] = {"error": {"status_code": he.status_code, "detail": he.detail}}
+    finally:
+        await pipeline.stop()
+    return results
+
+
+if __name__ == "__main__":
+    print(json.dumps(asyncio.run(process_paths(sys.argv[1:])), ensure_ascii=False, indent=2))
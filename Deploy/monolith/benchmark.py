@@ -0,0 +1,136 @@
+"""
+Сравнение микросервисного и монолитного режимов
+Отправляет одни и те же файлы в каждый режим и считает задержку
+(среднее, p50, p95) и пропускную способность.
+
+    # Backend (микросервисы) и монолит как HTTP сервисы
+    python benchmark.py --target microservices=http://localhost:8000 \\
+        --target monolith=http://localhost:8010 -n 20 -c 2 diagram.png
+
+    # Конвейер в процессе бенчмарка (без HTTP вообще)
+    python benchmark.py --in-process -n 20 diagram.png
+
+Чтобы измерять полный конвейер, а не кэш, запускайте сервисы (и бенчмарк
+с --in-process) с RESULT_CACHE_SIZE=0 и RESULT_CACHE_DB_LOOKUP=false.
+С включенным кэшем повторы одного файла измеряют накладные расходы
+самого конвейера.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+from typing import Awaitable, Callable, Dict, List
+
+import httpx
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run_load(
+    send: Callable[[str, bytes], Awaitable[None]],
+    files: Dict[str, bytes],
+    requests: int,
+    concurrency: int
+) -> Dict[str, float]:
+    """Выполняет requests запросов (файлы по кругу), не более concurrency одновременно"""
+    names = list(files)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors = 0
+
+    async def one(index: int):
+        nonlocal errors
+        name = names[index % len(names)]
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await send(name, files[name])
+                latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                errors += 1
+                print(f"❌ {name}: {e}", file=sys.stderr)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "requests": requests,
+        "errors": errors,
+        "mean": statistics.mean(latencies) if latencies else 0,
+        "p50": percentile(latencies, 0.5) if latencies else 0,
+        "p95": percentile(latencies, 0.95) if latencies else 0,
+        "throughput": len(latencies) / elapsed if elapsed > 0 else 0
+    }
+
+
+async def benchmark_http(url: str, files: Dict[str, bytes], requests: int, concurrency: int) -> Dict[str, float]:
+    """Запросы к /api/v1/process сервиса по HTTP"""
+    async with httpx.AsyncClient(base_url=url, timeout=600) as client:
+        async def send(name: str, content: bytes):
+            response = await client.post("/api/v1/process", files={"file": (name, content)})
+            response.raise_for_status()
+
+        # Прогрев: первый запрос не учитывается
+        await send(*next(iter(files.items())))
+        return await run_load(send, files, requests, concurrency)
+
+
+async def benchmark_in_process(files: Dict[str, bytes], requests: int, concurrency: int) -> Dict[str, float]:
+    """Вызовы конвейера в этом же процессе"""
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "app"))
+    from pipeline import Pipeline
+
+    pipeline = Pipeline()
+    await pipeline.start()
+    try:
+        async def send(name: str, content: bytes):
+            await pipeline.process(name, content)
+
+        await send(*next(iter(files.items())))
+        return await run_load(send, files, requests, concurrency)
+    finally:
+        await pipeline.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк микросервисного и монолитного режимов")
+    parser.add_argument("files", nargs="+", help="Файлы диаграмм")
+    parser.add_argument("--target", action="append", default=[], metavar="NAME=URL",
+                        help="HTTP сервис с /api/v1/process (можно несколько)")
+    parser.add_argument("--in-process", action="store_true", help="Также измерить конвейер в этом процессе")
+    parser.add_argument("-n", "--requests", type=int, default=20, help="Запросов на режим")
+    parser.add_argument("-c", "--concurrency", type=int, default=1, help="Одновременных запросов")
+    args = parser.parse_args()
+
+    files = {}
+    for path in args.files:
+        with open(path, "rb") as f:
+            files[os.path.basename(path)] = f.read()
+
+    results = {}
+    for target in args.target:
+        name, _, url = target.partition("=")
+        print(f"⏳ {name}: {url}")
+        results[name] = asyncio.run(benchmark_http(url, files, args.requests, args.concurrency))
+    if args.in_process:
+        print("⏳ in-process")
+        results["in-process"] = asyncio.run(benchmark_in_process(files, args.requests, args.concurrency))
+
+    print()
+    print(f"{'Режим':<20} {'Запросов':>8} {'Ошибок':>7} {'Среднее':>9} {'p50':>9} {'p95':>9} {'req/s':>7}")
+    for name, r in results.items():
+        print(
+            f"{name:<20} {r['requests']:>8} {r['errors']:>7} {r['mean']:>8.3f}s "
+            f"{r['p50']:>8.3f}s {r['p95']:>8.3f}s {r['throughput']:>7.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()